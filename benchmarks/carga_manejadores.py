@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Prueba de carga de los manejadores de mensajes con varios usuarios a la vez
+#   antes: el hilo del dispatcher atiende los mensajes uno tras otro, y una
+#          búsqueda lenta en tuenvio.cu retrasa a todos los demás usuarios
+#   después: en_orden_por_chat y atender_chat con dispatcher.run_async sobre un pool de
+#            MANEJADORES_HILOS hilos, en orden dentro de cada chat
+# Los mensajes llegan a ritmo constante y una parte de ellos tarda lo que una búsqueda
+# (--lento), el resto lo que una respuesta corta (--rapido). Se mide la latencia desde
+# que llega cada mensaje hasta que termina su manejador, y se comprueba que cada chat
+# se atendió en el orden de llegada.
+#   python3 benchmarks/carga_manejadores.py --usuarios 20 --mensajes 5 --hilos 8
+import argparse, random, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from types import SimpleNamespace
+
+from comun import cargar_definiciones, mostrar_tabla, resumen_duraciones
+
+
+def generar_mensajes(usuarios, por_usuario, tasa, proporcion_lentos, semilla=1):
+    azar = random.Random(semilla)
+    chats = [ chat_id for chat_id in range(usuarios) for _ in range(por_usuario) ]
+    azar.shuffle(chats)
+    return [ (i / tasa, chat_id, azar.random() < proporcion_lentos) for i, chat_id in enumerate(chats) ]
+
+
+# Entrega los mensajes a manejador en el momento en que llega cada uno, como el hilo
+# del dispatcher, y retorna las latencias y el orden en que se atendió cada chat
+def simular(mensajes, manejador, lento, rapido, esperar=None):
+    latencias = []
+    atendidos = {}
+    lock = threading.Lock()
+
+    def procesar(update, context):
+        time.sleep(lento if update.lento else rapido)
+        with lock:
+            latencias.append(time.monotonic() - update.llegada)
+            atendidos.setdefault(update.effective_chat.id, []).append(update.secuencia)
+
+    inicio = time.monotonic()
+    for secuencia, (momento, chat_id, es_lento) in enumerate(mensajes):
+        pausa = inicio + momento - time.monotonic()
+        if pausa > 0:
+            time.sleep(pausa)
+        update = SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), lento=es_lento,
+                                 secuencia=secuencia, llegada=inicio + momento)
+        manejador(procesar)(update, None)
+    if esperar:
+        esperar()
+    duracion = time.monotonic() - inicio
+    en_orden = all(orden == sorted(orden) for orden in atendidos.values())
+    return latencias, duracion, en_orden
+
+
+def manejador_antes(funcion):
+    return funcion
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latencia de los manejadores con varios usuarios a la vez')
+    parser.add_argument('--usuarios', type=int, default=20)
+    parser.add_argument('--mensajes', type=int, default=5, help='mensajes por usuario')
+    parser.add_argument('--tasa', type=float, default=20, help='mensajes por segundo')
+    parser.add_argument('--lentos', type=float, default=0.2, help='proporción de búsquedas lentas')
+    parser.add_argument('--lento', type=float, default=0.5, help='segundos de una búsqueda')
+    parser.add_argument('--rapido', type=float, default=0.02, help='segundos de una respuesta corta')
+    parser.add_argument('--hilos', type=int, default=8, help='como MANEJADORES_HILOS')
+    args = parser.parse_args()
+
+    mensajes = generar_mensajes(args.usuarios, args.mensajes, args.tasa, args.lentos)
+
+    pool = ThreadPoolExecutor(max_workers=args.hilos)
+    futuros = []
+    dispatcher = SimpleNamespace(run_async=lambda funcion, *a: futuros.append(pool.submit(funcion, *a)))
+    bot = cargar_definiciones(['LOCK_ESTADISTICAS', 'LOCK_COLAS_CHATS', 'COLAS_CHATS', 'LATENCIAS_MANEJADORES',
+                               'en_orden_por_chat', 'atender_chat'],
+                              { 'threading': threading, 'time': time, 'deque': deque, 'wraps': wraps,
+                                'dispatcher': dispatcher, 'debug_print': print })
+
+    def esperar_pool():
+        while futuros:
+            futuros.pop().result()
+
+    filas = []
+    for nombre, manejador, esperar in (('antes', manejador_antes, None),
+                                       ('después', bot['en_orden_por_chat'], esperar_pool)):
+        latencias, duracion, en_orden = simular(mensajes, manejador, args.lento, args.rapido, esperar)
+        resumen = resumen_duraciones(latencias)
+        filas.append([ nombre, len(latencias), f'{duracion:.1f}', f'{len(latencias) / duracion:.1f}',
+                       f'{resumen["p50"] * 1000:.0f}', f'{resumen["p99"] * 1000:.0f}', 'sí' if en_orden else 'no' ])
+    pool.shutdown()
+
+    print(f'{args.usuarios} usuarios, {len(mensajes)} mensajes a {args.tasa:g}/s, '
+          f'{args.lentos:.0%} de búsquedas de {args.lento:g} s, {args.hilos} hilos\n')
+    mostrar_tabla(['versión', 'mensajes', 'segundos', 'mensajes/s', 'p50 (ms)', 'p99 (ms)', 'en orden'], filas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Utilidades compartidas por las mediciones de benchmarks/
+# tuenviofinder.py arranca el bot al importarlo, así que las mediciones no lo importan:
+# cargar_definiciones compila solo las funciones y variables que se le piden, con el
+# entorno que se le pase, y así se mide el mismo código que ejecuta el bot.
+import ast, os, statistics, time
+from pathlib import Path
+
+DIRECTORY = Path(os.path.dirname(os.path.realpath(__file__)))
+ARCHIVO_BOT = DIRECTORY.parent / 'tuenviofinder.py'
+
+
+# Retorna un diccionario con las definiciones de primer nivel de tuenviofinder.py cuyos
+# nombres se indican, ejecutadas en el orden del archivo sobre una copia de entorno
+def cargar_definiciones(nombres, entorno=None):
+    arbol = ast.parse(ARCHIVO_BOT.read_text(encoding='utf8'), str(ARCHIVO_BOT))
+    nodos = []
+    encontrados = set()
+    for nodo in arbol.body:
+        if isinstance(nodo, ast.FunctionDef) and nodo.name in nombres:
+            nodos.append(nodo)
+            encontrados.add(nodo.name)
+        elif isinstance(nodo, ast.Assign):
+            destinos = { t.id for t in nodo.targets if isinstance(t, ast.Name) } & set(nombres)
+            if destinos:
+                nodos.append(nodo)
+                encontrados.update(destinos)
+    faltan = set(nombres) - encontrados
+    if faltan:
+        raise NameError(f'No se encontraron en {ARCHIVO_BOT.name}: {", ".join(sorted(faltan))}')
+    espacio = dict(entorno or {})
+    exec(compile(ast.Module(body=nodos, type_ignores=[]), str(ARCHIVO_BOT), 'exec'), espacio)
+    return espacio
+
+
+# Conexión a la base de datos de pruebas BENCH_BD_NOMBRE, con el usuario y servidor del
+# .env del bot. Nunca se usa la base de datos del bot porque las mediciones borran tablas.
+def conexion_bench():
+    import mysql.connector
+    from dotenv import load_dotenv
+
+    load_dotenv(dotenv_path=ARCHIVO_BOT.parent / '.env')
+    nombre = os.getenv('BENCH_BD_NOMBRE', 'tuenviofinder_bench')
+    if nombre == os.getenv('BD_NOMBRE', 'tuenviofinder'):
+        raise SystemExit('BENCH_BD_NOMBRE no puede ser la base de datos del bot')
+    config = {
+        'user': os.getenv('BD_USUARIO', 'root'),
+        'password': os.getenv('BD_CLAVE', 'admin'),
+        'host': os.getenv('BD_HOST', '127.0.0.1'),
+        'port': int(os.getenv('BD_PUERTO', 3306)),
+    }
+    conn = mysql.connector.connect(**config)
+    cursor = conn.cursor()
+    cursor.execute(f'CREATE DATABASE IF NOT EXISTS `{nombre}`')
+    cursor.close()
+    conn.database = nombre
+    config['database'] = nombre
+    return conn, config
+
+
+# Ejecuta funcion repeticiones veces y retorna la lista de duraciones en segundos
+def cronometrar(funcion, repeticiones):
+    duraciones = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        duraciones.append(time.perf_counter() - inicio)
+    return duraciones
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p / 100))]
+
+
+def resumen_duraciones(duraciones):
+    return {
+        'media': statistics.mean(duraciones),
+        'p50': percentil(duraciones, 50),
+        'p99': percentil(duraciones, 99),
+    }
+
+
+# Imprime una tabla con los encabezados y filas dados, alineada por columnas
+def mostrar_tabla(encabezados, filas):
+    filas = [ [ str(valor) for valor in fila ] for fila in filas ]
+    anchos = [ max(len(str(e)), *(len(f[i]) for f in filas)) for i, e in enumerate(encabezados) ]
+    print('  '.join(str(e).ljust(a) for e, a in zip(encabezados, anchos)).rstrip())
+    print('  '.join('-' * a for a in anchos))
+    for fila in filas:
+        print('  '.join(v.ljust(a) for v, a in zip(fila, anchos)).rstrip())
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+# Conexiones y consultas a la BD para leer y cobrar los datos del usuario en cada
+# búsqueda de texto
+#   antes: existe_registro_usuario, obtener_ajustes_usuario (cinco veces entre
+#          procesar_palabra, enviar_mensaje_productos_encontrados y obtener_soup),
+#          obtener_credito_usuario, numero_busquedas_ultima_hora, obtener_ajuste_bot y
+#          deducir_credito_usuario, cada una con su conexión
+#   después: sesion_usuario, que carga la sesión en una consulta y guarda los débitos
+#            al terminar, con las mismas funciones de tuenviofinder.py
+# No hace falta MySQL: las consultas se cuentan en una conexión simulada que responde
+# con un usuario registrado con crédito. La búsqueda en sí es la misma en las dos
+# versiones: por cada tienda se guardan la búsqueda y sus resultados en una transacción
+# desde un hilo del pool, como actualizar_resultados_busqueda en POOL_TIENDAS.
+#   python3 benchmarks/consultas_sesion.py --mensajes 100 --tiendas 3
+import argparse, datetime, threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from types import SimpleNamespace
+
+from comun import cargar_definiciones, mostrar_tabla
+
+UID = 1234
+AJUSTES = (UID, 'pr', 'tienda_pr', 3, 46089, None)
+
+
+# Conexión y cursor simulados que cuentan las conexiones y las sentencias ejecutadas
+CONTADORES = { 'conexiones': 0, 'consultas': 0 }
+LOCK_CONTADORES = threading.Lock()
+CONEXION_HILO = threading.local()
+POOL_TIENDAS = ThreadPoolExecutor(max_workers=4)
+
+
+# Filas con que responde la conexión simulada según el comienzo de la consulta
+RESPUESTAS = [
+    ('SELECT usuario.credito', (10, 'normal', *AJUSTES)),
+    ('SELECT * FROM ajustes_usuario', AJUSTES),
+    ('SELECT * FROM usuario', (UID, 'usuario', 10, 'normal')),
+    ('SELECT credito', (10, )),
+    ('SELECT @saldo', (10, )),
+    ('SELECT valor FROM ajustes_bot', ('10', )),
+]
+
+
+def crear_cursor():
+    estado = { 'fila': None }
+
+    def execute(sql, parametros=()):
+        with LOCK_CONTADORES:
+            CONTADORES['consultas'] += 1
+        sql = ' '.join(sql.split())
+        estado['fila'] = next((fila for inicio, fila in RESPUESTAS if sql.startswith(inicio)), None)
+
+    def executemany(sql, parametros):
+        # mysql.connector agrupa los INSERT de executemany en una sola sentencia
+        with LOCK_CONTADORES:
+            CONTADORES['consultas'] += 1
+
+    return SimpleNamespace(execute=execute, executemany=executemany, rowcount=1, lastrowid=1,
+                           fetchone=lambda: estado['fila'],
+                           fetchall=lambda: [estado['fila']] if estado['fila'] else [])
+
+
+@contextmanager
+def conexion_bd():
+    contador = getattr(CONEXION_HILO, 'contador', None)
+    with LOCK_CONTADORES:
+        if contador is not None:
+            contador['accesos'] += 1
+        CONTADORES['conexiones'] += 1
+    yield (SimpleNamespace(commit=lambda: None), crear_cursor())
+
+
+# Las lecturas y el cobro de una búsqueda antes de la sesión, una conexión por llamada
+def consultar(sql, parametros):
+    with conexion_bd() as (conn, cursor):
+        cursor.execute(sql, parametros)
+        return cursor.fetchone()
+
+
+# La búsqueda, sus productos y sus resultados de una tienda en una transacción
+def guardar_busqueda(idchat, tid):
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''INSERT INTO busqueda(uid, criterio, fecha, tid) VALUES(%s, %s, %s, %s)''',
+                       (idchat, 'pollo', datetime.datetime.now(), tid))
+        cursor.executemany('''INSERT INTO producto(pid, nombre, precio, enlace, did) VALUES(%s, %s, %s, %s, %s)''', [])
+        cursor.executemany('''INSERT INTO resultado(bid, pid) VALUES(%s, %s)''', [])
+        conn.commit()
+
+
+def buscar_en_tiendas(idchat, tiendas, envolver=lambda funcion: funcion):
+    guardar = envolver(guardar_busqueda)
+    futuros = [ POOL_TIENDAS.submit(guardar, idchat, tid) for tid in range(tiendas) ]
+    for futuro in futuros:
+        futuro.result()
+
+
+def buscar_antes(idchat, tiendas):
+    consultar('''SELECT * FROM usuario WHERE uid=%s''', (idchat, ))                          # existe_registro_usuario
+    consultar('''SELECT * FROM ajustes_usuario WHERE uid=%s''', (idchat, ))                  # procesar_palabra
+    consultar('''SELECT credito FROM usuario WHERE uid=%s''', (idchat, ))                    # obtener_credito_usuario
+    consultar('''SELECT * FROM busqueda WHERE timestampdiff(SECOND, fecha, now()) < 3600 and uid=%s''', (idchat, ))
+    consultar('''SELECT valor FROM ajustes_bot WHERE clave = %s''', ('max_busquedas_por_hora', ))
+    # enviar_mensaje_productos_encontrados
+    consultar('''SELECT * FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
+    for _ in range(3):
+        consultar('''SELECT * FROM ajustes_usuario WHERE uid=%s''', (idchat, ))              # obtener_soup
+    buscar_en_tiendas(idchat, tiendas)
+    with conexion_bd() as (conn, cursor):                                                    # deducir_credito_usuario
+        cursor.execute('''UPDATE usuario SET credito = credito - %s WHERE uid = %s and credito > 0''', (1, idchat))
+        cursor.execute('''INSERT INTO operacion_credito(uid, descripcion, tipo, monto, fecha) \
+                          VALUES(%s, %s, %s, %s, %s)''',
+                       (idchat, 'Deducción por búsqueda', 'débito', 1, datetime.datetime.now()))
+        conn.commit()
+    consultar('''SELECT credito FROM usuario WHERE uid=%s''', (idchat, ))                    # ¿se agotó?
+
+
+def buscar_despues(bot, idchat, tiendas):
+    with bot['sesion_usuario'](idchat) as sesion:
+        if sesion['registrado'] and bot['obtener_ajustes_usuario'](idchat):
+            bot['obtener_credito_usuario'](idchat)
+            bot['rebasa_limite_busquedas'](idchat, sesion['tipo'], sesion['credito'])
+            for _ in range(4):
+                bot['obtener_ajustes_usuario'](idchat)
+            buscar_en_tiendas(idchat, tiendas, bot['con_contador_bd'])
+            bot['deducir_credito_usuario'](None, idchat)
+
+
+def medir(nombre, buscar, mensajes, tiendas):
+    CONTADORES.update(conexiones=0, consultas=0)
+    for _ in range(mensajes):
+        buscar(UID, tiendas)
+    return [ nombre, mensajes, CONTADORES['conexiones'], CONTADORES['consultas'],
+             f'{CONTADORES["conexiones"] / mensajes:.1f}', f'{CONTADORES["consultas"] / mensajes:.1f}' ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consultas a la BD por búsqueda antes y después de la sesión '
+                                                 'de usuario')
+    parser.add_argument('--mensajes', type=int, default=100)
+    parser.add_argument('--tiendas', type=int, default=3, help='tiendas de la provincia en que se busca')
+    args = parser.parse_args()
+
+    entorno = {
+        'threading': threading, 'time': time, 'datetime': datetime, 'deque': deque,
+        'contextmanager': contextmanager, 'wraps': wraps, 'conexion_bd': conexion_bd, 'CONEXION_HILO': CONEXION_HILO,
+        'enviar_mensaje': lambda *args, **kwargs: None, 'PRIORIDAD_RESPUESTA': 0,
+        'debug_print': lambda *args, **kwargs: None, 'LIMITE_BUSQUEDAS_VIP': 0,
+        # Los ajustes del bot se leen del catálogo en memoria
+        'obtener_ajuste_bot': lambda clave: '10',
+    }
+    bot = cargar_definiciones(['LOCK_ESTADISTICAS', 'contar_estadistica', 'copiar_estadisticas',
+                               'SESION_HILO', 'ESTADISTICAS_SESIONES', 'cargar_sesion_usuario', 'sesion_actual',
+                               'guardar_sesion_usuario', 'sesion_usuario', 'con_contador_bd', 'estadisticas_sesiones',
+                               'obtener_ajustes_usuario', 'LOCK_CREDITOS', 'CREDITOS', 'ESTADISTICAS_CREDITOS',
+                               'guardar_credito_en_cache', 'debitar_credito', 'obtener_credito_usuario',
+                               'deducir_credito_usuario', 'VENTANA_BUSQUEDAS', 'LOCK_BUSQUEDAS_USUARIOS',
+                               'BUSQUEDAS_USUARIOS', 'ESTADISTICAS_LIMITES', 'numero_busquedas_ultima_hora',
+                               'limite_busquedas_por_hora', 'rebasa_limite_busquedas'], entorno)
+
+    filas = [
+        medir('antes', buscar_antes, args.mensajes, args.tiendas),
+        medir('después', lambda idchat, tiendas: buscar_despues(bot, idchat, tiendas), args.mensajes, args.tiendas),
+    ]
+    POOL_TIENDAS.shutdown()
+    mostrar_tabla(['versión', 'búsquedas', 'conexiones', 'consultas', 'conexiones/búsqueda', 'consultas/búsqueda'],
+                  filas)
+    # El mismo valor que muestra /estado en el bot, que cuenta también los hilos del pool
+    accesos = bot['estadisticas_sesiones']()['accesos_por_mensaje']
+    print(f'\naccesos_por_mensaje según estadisticas_sesiones: {accesos:.1f}')
+
+
+if __name__ == '__main__':
+    main()
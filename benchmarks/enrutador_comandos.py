@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+# Latencia y memoria de los comandos con ID (/credito_<uid>, /eliminar_sub_<sid>, ...)
+#   antes: un CommandHandler por cada ID, que el dispatcher compara uno tras otro
+#   después: COMANDOS_CON_ID y enrutar_comando_con_id, una búsqueda por prefijo
+# python-telegram-bot no hace falta: la lista de manejadores se emula con la misma
+# comparación que hace CommandHandler.check_update, así que la memoria de "antes" es
+# menor que la de los CommandHandler reales.
+#   python3 benchmarks/enrutador_comandos.py --usuarios 2000 --subscripciones 5000 --productos 20000
+import argparse, random, time, tracemalloc
+from collections import namedtuple
+from types import SimpleNamespace
+
+from comun import cargar_definiciones, cronometrar, mostrar_tabla, resumen_duraciones
+
+Manejador = namedtuple('Manejador', ['comandos', 'funcion'])
+
+
+def no_hacer_nada(update, context):
+    pass
+
+
+def comandos_con_id(usuarios, subscripciones, productos):
+    comandos = [ f'credito_{uid}' for uid in range(usuarios) ]
+    for sid in range(subscripciones):
+        comandos += [ f'eliminar_sub_{sid}', f'cambiar_frec_{sid}', f'activar_{sid}' ]
+    comandos += [ f'subscribirse_a_{pid}' for pid in range(productos) ]
+    return comandos
+
+
+# Como se registraban antes: un manejador por comando en el grupo 1 del dispatcher
+def registrar_antes(comandos):
+    return [ Manejador([comando.lower()], no_hacer_nada) for comando in comandos ]
+
+
+# Como Dispatcher.process_update con CommandHandler: el primero cuyo comando coincide
+def despachar_antes(manejadores, update):
+    comando = update.message.text.split()[0][1:].split('@')[0].lower()
+    for manejador in manejadores:
+        if comando in manejador.comandos:
+            manejador.funcion(update, None)
+            return
+
+
+def registrar_despues(bot):
+    for prefijo in ('credito_', 'eliminar_sub_', 'cambiar_frec_', 'activar_', 'subscribirse_a_'):
+        bot['registrar_comando_con_id'](prefijo, no_hacer_nada)
+    return bot
+
+
+def memoria(funcion):
+    tracemalloc.start()
+    inicio = time.perf_counter()
+    resultado = funcion()
+    segundos = time.perf_counter() - inicio
+    actual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return resultado, actual, segundos
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latencia y memoria de los comandos con ID')
+    parser.add_argument('--usuarios', type=int, default=2000)
+    parser.add_argument('--subscripciones', type=int, default=5000)
+    parser.add_argument('--productos', type=int, default=20000)
+    parser.add_argument('--mensajes', type=int, default=2000)
+    args = parser.parse_args()
+
+    comandos = comandos_con_id(args.usuarios, args.subscripciones, args.productos)
+    azar = random.Random(1)
+    updates = [ SimpleNamespace(message=SimpleNamespace(text=f'/{azar.choice(comandos)}'))
+                for _ in range(args.mensajes) ]
+
+    manejadores, memoria_antes, registro_antes = memoria(lambda: registrar_antes(comandos))
+    bot = cargar_definiciones(['COMANDOS_CON_ID', 'registrar_comando_con_id', 'separar_comando_con_id',
+                               'enrutar_comando_con_id'])
+    bot, memoria_despues, registro_despues = memoria(lambda: registrar_despues(bot))
+    enrutar = bot['enrutar_comando_con_id']
+
+    mensajes = iter(updates)
+    antes = resumen_duraciones(cronometrar(lambda: despachar_antes(manejadores, next(mensajes)), len(updates)))
+    mensajes = iter(updates)
+    despues = resumen_duraciones(cronometrar(lambda: enrutar(next(mensajes), None), len(updates)))
+
+    print(f'{len(comandos)} comandos con ID, {len(updates)} mensajes\n')
+    filas = []
+    for nombre, duraciones, registro, bytes_ in (('antes', antes, registro_antes, memoria_antes),
+                                                 ('después', despues, registro_despues, memoria_despues)):
+        filas.append([ nombre, f'{registro * 1000:.1f}', f'{bytes_ / 1024:.0f}',
+                       f'{duraciones["p50"] * 1e6:.1f}', f'{duraciones["p99"] * 1e6:.1f}' ])
+    mostrar_tabla(['versión', 'registro (ms)', 'memoria (KiB)', 'p50 (µs)', 'p99 (µs)'], filas)
+
+
+if __name__ == '__main__':
+    main()
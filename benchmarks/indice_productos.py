@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+# Búsqueda del listado "📦 Productos" en un catálogo grande
+#   antes: nombre LIKE '%a%b%' sobre toda la tabla producto
+#   después: el índice invertido en memoria de buscar_en_indice_productos
+# Sin MySQL, el LIKE se emula con un recorrido de todos los nombres con la misma
+# expresión (sin mayúsculas ni tildes, como la colación de la tabla). Con --mysql se
+# guarda el catálogo en la tabla producto de BENCH_BD_NOMBRE y se mide la consulta real.
+#   python3 benchmarks/indice_productos.py --productos 200000 [--mysql]
+import argparse, bisect, heapq, os, random, re, threading, time, unicodedata
+
+from comun import cargar_definiciones, cronometrar, mostrar_tabla, resumen_duraciones
+
+TIPOS = ['Pollo', 'Aceite', 'Arroz', 'Refresco', 'Jabón', 'Detergente', 'Café', 'Azúcar', 'Leche',
+         'Galletas', 'Pasta', 'Salchichas', 'Picadillo', 'Queso', 'Jamón', 'Champú', 'Puré',
+         'Mayonesa', 'Spaghetti', 'Atún', 'Compota', 'Yogurt', 'Cerveza', 'Malta', 'Sazón']
+VARIANTES = ['troceado', 'de soya', 'en polvo', 'molido', 'de tomate', 'de girasol', 'líquido',
+             'de res', 'de cerdo', 'integral', 'ahumado', 'condensada', 'de fresa', 'de mango',
+             'para niños', 'familiar', 'light', 'gouda', 'vegetal', 'en lata']
+ENVASES = ['caja', 'paquete', 'botella', 'lata', 'bolsa', 'pomo', 'frasco', 'sobre']
+UNIDADES = ['g', 'kg', 'ml', 'L', 'u']
+
+BUSQUEDAS = ['pollo', 'aceite soya', 'jabon', 'cafe molido', 'picad', 'leche polvo',
+             'pure tomate lata', 'cerveza', 'queso gouda', 'producto inexistente']
+
+
+def generar_catalogo(cantidad, semilla=1):
+    azar = random.Random(semilla)
+    productos = []
+    for pid in range(cantidad):
+        nombre = (f'{azar.choice(TIPOS)} {azar.choice(VARIANTES)} '
+                  f'({azar.choice(ENVASES)} {azar.randint(1, 999)} {azar.choice(UNIDADES)})')
+        productos.append( (nombre, f'$ {azar.randint(100, 9999) / 100:.2f}', '', str(pid)) )
+    return productos
+
+
+def normalizar(texto):
+    texto = unicodedata.normalize('NFKD', texto.lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+# Recorre todos los nombres como el LIKE anterior y se queda con los 10 primeros
+def buscar_antes(nombres, palabra):
+    patron = re.compile('.*'.join(re.escape(p) for p in normalizar(palabra).split()))
+    resultado = []
+    for pid, nombre, normalizado, precio in nombres:
+        if patron.search(normalizado):
+            resultado.append( (pid, nombre, precio) )
+            if len(resultado) == 10:
+                break
+    return resultado
+
+
+def nombres_que_contienen(nombres, palabra):
+    patron = re.compile('.*'.join(re.escape(p) for p in normalizar(palabra).split()))
+    return [ pid for pid, nombre, normalizado, precio in nombres if patron.search(normalizado) ]
+
+
+def guardar_catalogo_mysql(productos):
+    from comun import conexion_bench
+
+    conn, _ = conexion_bench()
+    cursor = conn.cursor()
+    cursor.execute('DROP TABLE IF EXISTS producto')
+    cursor.execute('''CREATE TABLE producto (pid VARCHAR(32) NOT NULL PRIMARY KEY, nombre VARCHAR(255), \
+                      precio VARCHAR(32), enlace VARCHAR(512), did VARCHAR(32))''')
+    for i in range(0, len(productos), 5000):
+        cursor.executemany('''INSERT INTO producto(pid, nombre, precio, enlace, did) VALUES(%s, %s, %s, %s, %s)''',
+                           [ (pid, nombre, precio, plink, '0') for nombre, precio, plink, pid in productos[i:i + 5000] ])
+    conn.commit()
+    return conn, cursor
+
+
+def buscar_antes_mysql(cursor, palabra):
+    criterio = '%'.join(palabra.split())
+    cursor.execute('''SELECT pid, nombre, precio FROM producto WHERE nombre like %s limit 10''', (f'%{criterio}%', ))
+    return cursor.fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Búsqueda de productos con LIKE y con el índice invertido')
+    parser.add_argument('--productos', type=int, default=200000)
+    parser.add_argument('--repeticiones', type=int, default=20, help='veces que se repite cada búsqueda')
+    parser.add_argument('--mysql', action='store_true', help='medir también la consulta LIKE en MySQL')
+    args = parser.parse_args()
+
+    productos = generar_catalogo(args.productos)
+    bot = cargar_definiciones(['LOCK_ESTADISTICAS', 'contar_estadistica', 'LOCK_INDICE_PRODUCTOS', 'INDICE_PRODUCTOS',
+                               'ENTRADAS_INDICE', 'PALABRAS_INDICE', 'PRODUCTOS_INDEXADOS', 'ESTADISTICAS_INDICE',
+                               'INDICE_PREFIJO_MINIMO', 'INDICE_PREFIJO_MAXIMO', 'normalizar_texto', 'palabras_de',
+                               'indexar_producto', 'indexar_productos', 'palabras_con_prefijo', 'productos_con_palabras',
+                               'buscar_en_indice_productos'],
+                              { 'threading': threading, 'unicodedata': unicodedata, 're': re, 'bisect': bisect,
+                                'heapq': heapq, 'time': time, 'os': os })
+    inicio = time.perf_counter()
+    bot['indexar_productos'](productos)
+    indexado = time.perf_counter() - inicio
+    buscar_despues = bot['buscar_en_indice_productos']
+
+    nombres = [ (pid, nombre, normalizar(nombre), precio) for nombre, precio, plink, pid in productos ]
+    metodos = [ ('antes (recorrido)', lambda palabra: buscar_antes(nombres, palabra)) ]
+    if args.mysql:
+        conn, cursor = guardar_catalogo_mysql(productos)
+        metodos.append( ('antes (LIKE en MySQL)', lambda palabra: buscar_antes_mysql(cursor, palabra)) )
+    metodos.append( ('después (índice)', buscar_despues) )
+
+    print(f'{args.productos} productos, {len(bot["INDICE_PRODUCTOS"])} palabras, '
+          f'índice construido en {indexado:.1f} s\n')
+    # Una fila por búsqueda con la mediana de cada versión, y al final el total
+    filas = []
+    todas = { nombre: [] for nombre, buscar in metodos }
+    for palabra in BUSQUEDAS:
+        fila = [ palabra, len(nombres_que_contienen(nombres, palabra)) ]
+        for nombre, buscar in metodos:
+            duraciones = cronometrar(lambda: buscar(palabra), args.repeticiones)
+            todas[nombre] += duraciones
+            fila.append(f'{resumen_duraciones(duraciones)["p50"] * 1000:.3f}')
+        filas.append(fila)
+    filas.append([ 'p99 de todas', '' ] + [ f'{resumen_duraciones(todas[nombre])["p99"] * 1000:.3f}'
+                                              for nombre, buscar in metodos ])
+    mostrar_tabla(['búsqueda', 'coinciden'] + [ f'{nombre} ms' for nombre, buscar in metodos ], filas)
+    if args.mysql:
+        cursor.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
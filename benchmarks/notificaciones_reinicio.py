@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Mensajes que envían las subscripciones cuando el bot se reinicia entre escaneos
+#   antes: lo visto por cada subscripción solo está en memoria y tras reiniciar se
+#          notifica de nuevo todo el listado
+#   después: lo visto se guarda en subscripcion_vistos y se carga con
+#            programar_subscripcion, así que tras reiniciar solo se notifican los cambios
+# Se usan productos_nuevos y programar_subscripcion de tuenviofinder.py; la tabla se
+# emula con un diccionario de JSON como el que se guarda. Cada ciclo una parte de los
+# productos de cada criterio cambia de precio, se agota o aparece.
+#   python3 benchmarks/notificaciones_reinicio.py --subscripciones 500 --ciclos 48 --reinicios 4
+import argparse, datetime, heapq, json, random, threading
+
+from comun import cargar_definiciones, mostrar_tabla
+
+NOMBRES = ['pollo', 'aceite', 'arroz', 'refresco', 'jabon', 'detergente', 'cafe', 'leche']
+
+
+def generar_listados(criterios, productos, ciclos, cambios, semilla=1):
+    azar = random.Random(semilla)
+    listados = []
+    actuales = { criterio: { f'{criterio}{i}': f'$ {azar.randint(100, 999) / 100:.2f}' for i in range(productos) }
+                 for criterio in range(criterios) }
+    siguiente = productos
+    for _ in range(ciclos):
+        for criterio, listado in actuales.items():
+            for pid in list(listado):
+                sorteo = azar.random()
+                if sorteo < cambios / 3:
+                    listado[pid] = f'$ {azar.randint(100, 999) / 100:.2f}'
+                elif sorteo < 2 * cambios / 3:
+                    del listado[pid]
+                elif sorteo < cambios:
+                    listado[f'{criterio}{siguiente}'] = f'$ {azar.randint(100, 999) / 100:.2f}'
+                    siguiente += 1
+        listados.append({ criterio: [ (NOMBRES[criterio % len(NOMBRES)], precio, '', pid)
+                                      for pid, precio in listado.items() ]
+                          for criterio, listado in actuales.items() })
+    return listados
+
+
+# Arranca el bot: definiciones nuevas y las subscripciones con lo guardado en la tabla
+def arrancar(subscripciones, tabla, criterios):
+    bot = cargar_definiciones(['COND_PLANIFICADOR', 'GRUPOS_PROGRAMADOS', 'GRUPO_DE_SUBSCRIPCION', 'PROXIMO_ESCANEO',
+                               'MONTICULO_ESCANEOS', 'proximo_escaneo', 'reprogramar_grupo', 'programar_subscripcion',
+                               'productos_nuevos'],
+                              { 'threading': threading, 'heapq': heapq, 'datetime': datetime, 'json': json })
+    ahora = datetime.datetime.now()
+    for sid in range(subscripciones):
+        bot['programar_subscripcion'](sid, sid, sid % criterios, 1, ahora, 3600, ahora, tabla.get(sid))
+    return bot
+
+
+def simular(listados, subscripciones, criterios, reinicios, persistir):
+    tabla = {}
+    momentos = { len(listados) * (i + 1) // (reinicios + 1) for i in range(reinicios) }
+    mensajes = productos = tras_reinicio = 0
+    bot = arrancar(subscripciones, tabla, criterios)
+    for ciclo, listado in enumerate(listados):
+        if ciclo in momentos:
+            bot = arrancar(subscripciones, tabla, criterios)
+        for grupo in bot['GRUPOS_PROGRAMADOS'].values():
+            for sid, subscripcion in grupo.items():
+                actuales = listado[sid % criterios]
+                nuevos = bot['productos_nuevos'](subscripcion, actuales)
+                if nuevos:
+                    mensajes += 1
+                    productos += len(nuevos)
+                    if ciclo in momentos:
+                        tras_reinicio += 1
+                subscripcion['vistos'] = { pid: precio for producto, precio, plink, pid in actuales }
+                if persistir:
+                    tabla[sid] = json.dumps(subscripcion['vistos'])
+    return mensajes, productos, tras_reinicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mensajes de las subscripciones con reinicios del bot')
+    parser.add_argument('--subscripciones', type=int, default=500)
+    parser.add_argument('--criterios', type=int, default=50)
+    parser.add_argument('--productos', type=int, default=20, help='productos en el listado de cada criterio')
+    parser.add_argument('--ciclos', type=int, default=48, help='escaneos de cada subscripción')
+    parser.add_argument('--reinicios', type=int, default=4)
+    parser.add_argument('--cambios', type=float, default=0.01,
+                        help='proporción de productos que cambian, se agotan o aparecen por ciclo')
+    args = parser.parse_args()
+
+    listados = generar_listados(args.criterios, args.productos, args.ciclos, args.cambios)
+    filas = []
+    for nombre, persistir in (('antes', False), ('después', True)):
+        mensajes, productos, tras_reinicio = simular(listados, args.subscripciones, args.criterios,
+                                                     args.reinicios, persistir)
+        filas.append([ nombre, mensajes, productos, tras_reinicio ])
+
+    print(f'{args.subscripciones} subscripciones a {args.criterios} criterios, {args.ciclos} ciclos, '
+          f'{args.reinicios} reinicios, {args.cambios:.0%} de cambios por ciclo\n')
+    mostrar_tabla(['versión', 'mensajes', 'productos notificados', 'mensajes tras reiniciar'], filas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# Filas por segundo al guardar los productos y resultados de una búsqueda
+#   antes: una conexión, un SELECT y un INSERT por producto y un commit por resultado
+#   después: registrar_productos (un INSERT ... ON DUPLICATE KEY UPDATE) y un
+#            executemany de los resultados en una sola transacción
+# Usa la base de datos BENCH_BD_NOMBRE (ver benchmarks/comun.py), donde crea y borra
+# sus propias tablas producto, resultado y busqueda.
+#   python3 benchmarks/persistencia_productos.py --busquedas 50 --productos 40
+import argparse, datetime, random, time
+
+import mysql.connector
+
+from comun import cargar_definiciones, conexion_bench, mostrar_tabla
+
+
+def crear_tablas(cursor):
+    for tabla in ('resultado', 'producto', 'busqueda'):
+        cursor.execute(f'DROP TABLE IF EXISTS {tabla}')
+    cursor.execute('''CREATE TABLE producto (pid VARCHAR(32) NOT NULL PRIMARY KEY, nombre VARCHAR(255), \
+                      precio VARCHAR(32), enlace VARCHAR(512), did VARCHAR(32))''')
+    cursor.execute('''CREATE TABLE busqueda (bid INT NOT NULL AUTO_INCREMENT PRIMARY KEY, uid BIGINT, \
+                      criterio VARCHAR(255), did VARCHAR(32), fecha DATETIME, tid VARCHAR(64))''')
+    cursor.execute('''CREATE TABLE resultado (bid INT NOT NULL, pid VARCHAR(32) NOT NULL, KEY (bid))''')
+
+
+# Páginas de productos inventadas, con pids repetidos entre páginas como en tuenvio.cu
+def generar_paginas(busquedas, por_pagina, semilla=1):
+    azar = random.Random(semilla)
+    pids = [ str(pid) for pid in range(1000, 1000 + busquedas * por_pagina // 2) ]
+    paginas = []
+    for _ in range(busquedas):
+        pagina = []
+        for pid in azar.sample(pids, min(por_pagina, len(pids))):
+            precio = f'$ {azar.randint(100, 5000) / 100:.2f}'
+            pagina.append( (f'Producto {pid}', precio, f'https://www.tuenvio.cu/tienda/Item?ProdPid={pid}', pid) )
+        paginas.append(pagina)
+    return paginas
+
+
+# Como se guardaban los productos antes del guardado en lote
+def guardar_antes(config, conn, cursor, productos, ahora):
+    cursor.execute('''INSERT INTO busqueda(uid, criterio, fecha, tid) VALUES(%s, %s, %s, %s)''',
+                   (1, 'bench', ahora, 'tienda'))
+    bid = cursor.lastrowid
+    conn.commit()
+    for nombre, precio, plink, pid in productos:
+        conn_producto = mysql.connector.connect(**config)
+        cursor_producto = conn_producto.cursor()
+        cursor_producto.execute('''SELECT pid FROM producto WHERE pid=%s''', (pid, ))
+        if not cursor_producto.fetchall():
+            cursor_producto.execute('''INSERT INTO producto(pid, nombre, precio, enlace, did) VALUES(%s, %s, %s, %s, %s)''',
+                                    (pid, nombre, precio, plink, '0'))
+            conn_producto.commit()
+        conn_producto.close()
+        cursor.execute('''INSERT INTO resultado(bid, pid) VALUES(%s, %s)''', (bid, pid))
+        conn.commit()
+
+
+def guardar_despues(registrar_productos, conn, cursor, productos, ahora):
+    cursor.execute('''INSERT INTO busqueda(uid, criterio, fecha, tid) VALUES(%s, %s, %s, %s)''',
+                   (1, 'bench', ahora, 'tienda'))
+    bid = cursor.lastrowid
+    registrar_productos(cursor, productos, '0')
+    cursor.executemany('''INSERT INTO resultado(bid, pid) VALUES(%s, %s)''',
+                       [ (bid, pid) for nombre, precio, plink, pid in productos ])
+    conn.commit()
+
+
+def medir(nombre, guardar, paginas):
+    conn, config = conexion_bench()
+    cursor = conn.cursor()
+    crear_tablas(cursor)
+    ahora = datetime.datetime.now()
+    inicio = time.perf_counter()
+    for productos in paginas:
+        guardar(config, conn, cursor, productos, ahora)
+    segundos = time.perf_counter() - inicio
+    cursor.close()
+    conn.close()
+    # Igual que ESTADISTICAS_PERSISTENCIA: la búsqueda, sus productos y sus resultados
+    filas = sum(1 + 2 * len(productos) for productos in paginas)
+    return [ nombre, len(paginas), filas, f'{segundos:.2f}', f'{filas / segundos:.0f}' ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Filas por segundo al guardar los productos de cada búsqueda')
+    parser.add_argument('--busquedas', type=int, default=50)
+    parser.add_argument('--productos', type=int, default=40, help='productos por página')
+    args = parser.parse_args()
+
+    registrar_productos = cargar_definiciones(['registrar_productos'])['registrar_productos']
+    paginas = generar_paginas(args.busquedas, args.productos)
+    filas = [
+        medir('antes', guardar_antes, paginas),
+        medir('después', lambda config, *resto: guardar_despues(registrar_productos, *resto), paginas),
+    ]
+    mostrar_tabla(['versión', 'búsquedas', 'filas', 'segundos', 'filas/s'], filas)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Parsers de las páginas de tuenvio.cu
+# Cada tipo de página tiene un parser con BeautifulSoup, que es la referencia, y otro
+# con lxml que debe devolver exactamente lo mismo y se usa si lxml está instalado.
+from bs4 import BeautifulSoup
+
+# lxml es opcional, si está instalado se usa para parsear más rápido las páginas de tuenvio.cu
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+LXML_DISPONIBLE = lxml is not None
+
+
+# Definir una funcion para cada tipo de elemento a parsear
+def parsear_productos(soup, url_base):
+    try:
+        productos = []
+        thumb_setting = soup.select('div.thumbSetting')             
+        for child in thumb_setting:
+            enlace = child.select('div.thumbTitle a')[0]
+            producto = str(enlace.contents[0])
+            phref = enlace['href']
+            pid = phref.split('&')[0].split('=')[1]
+            plink = f'{url_base}/{phref}'
+            precio = str(child.select('div.thumbPrice span')[0].contents[0])
+            productos.append( (producto, precio, plink, pid) )
+        return productos
+    except Exception as ex:
+        print('parsear_productos', ex)    
+
+
+def parsear_categorias_menu(soup):
+    deps = {}
+    navbar = soup.select('.mainNav .navbar .nav > li:not(:first-child)')
+    for child in navbar:
+        cat = str(child.select('a')[0].contents[0])
+        deps[cat] = {}
+        for d in child.select('div > ul > li'):
+            enlace = d.select('a')[0]
+            d_id = enlace['href'].split('=')[1]
+            d_nombre = str(enlace.contents[0])
+            deps[cat][d_id] = d_nombre
+    return deps
+
+
+# Versiones con lxml de los parsers anteriores, con las expresiones XPath compiladas
+# una sola vez. Deben devolver exactamente lo mismo que las de BeautifulSoup.
+def xpath_clase(clase):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {clase} ')"
+
+
+if lxml:
+    XPATH_PRODUCTOS = lxml.etree.XPath(f'//div[{xpath_clase("thumbSetting")}]')
+    XPATH_TITULO_PRODUCTO = lxml.etree.XPath(f'.//div[{xpath_clase("thumbTitle")}]//a')
+    XPATH_PRECIO_PRODUCTO = lxml.etree.XPath(f'.//div[{xpath_clase("thumbPrice")}]//span')
+    XPATH_CATEGORIAS_MENU = lxml.etree.XPath(f'//*[{xpath_clase("mainNav")}]//*[{xpath_clase("navbar")}]'
+                                             f'//*[{xpath_clase("nav")}]/li[preceding-sibling::*]')
+    XPATH_DEPARTAMENTOS_MENU = lxml.etree.XPath('.//div/ul/li')
+    XPATH_ENLACES = lxml.etree.XPath('.//a')
+
+
+def primer_texto(elemento):
+    # Equivalente a elemento.contents[0] cuando el primer nodo es texto, en otro caso
+    # se lanza una excepción para que se use BeautifulSoup
+    if elemento.text is None:
+        raise ValueError(f'<{elemento.tag}> no comienza con texto')
+    return elemento.text
+
+
+def parsear_productos_lxml(data, url_base):
+    productos = []
+    for child in XPATH_PRODUCTOS(lxml.html.document_fromstring(data)):
+        enlace = XPATH_TITULO_PRODUCTO(child)[0]
+        producto = primer_texto(enlace)
+        phref = enlace.get('href')
+        pid = phref.split('&')[0].split('=')[1]
+        plink = f'{url_base}/{phref}'
+        precio = primer_texto(XPATH_PRECIO_PRODUCTO(child)[0])
+        productos.append( (producto, precio, plink, pid) )
+    return productos
+
+
+def parsear_categorias_menu_lxml(data):
+    deps = {}
+    for child in XPATH_CATEGORIAS_MENU(lxml.html.document_fromstring(data)):
+        cat = primer_texto(XPATH_ENLACES(child)[0])
+        deps[cat] = {}
+        for d in XPATH_DEPARTAMENTOS_MENU(child):
+            enlace = XPATH_ENLACES(d)[0]
+            d_id = enlace.get('href').split('=')[1]
+            d_nombre = primer_texto(enlace)
+            deps[cat][d_id] = d_nombre
+    return deps
+
+
+# Parser a usar para cada tipo de página: (rápido, referencia)
+PARSERS = {
+    'productos': (parsear_productos_lxml,
+                  lambda data, url_base: parsear_productos(BeautifulSoup(data, 'html.parser'), url_base)),
+    'menu': (parsear_categorias_menu_lxml,
+             lambda data: parsear_categorias_menu(BeautifulSoup(data, 'html.parser'))),
+}
@@ -0,0 +1,56 @@
+# El parser de lxml solo se usa si devuelve exactamente lo mismo que el de
+# BeautifulSoup, que es la referencia. Las páginas de tests/paginas reproducen la
+# estructura de las de tuenvio.cu (menú de categorías y listado de productos).
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('bs4')
+pytest.importorskip('lxml')
+
+from parsers import PARSERS
+
+PAGINAS = Path(__file__).resolve().parent / 'paginas'
+URL_BASE = 'https://www.tuenvio.cu/carlos3'
+
+
+def leer_pagina(nombre):
+    return (PAGINAS / nombre).read_text(encoding='utf8')
+
+
+@pytest.mark.parametrize('nombre', sorted(pagina.name for pagina in PAGINAS.glob('*.html')))
+def test_productos_lxml_igual_que_bs4(nombre):
+    data = leer_pagina(nombre)
+    rapido, referencia = PARSERS['productos']
+    assert rapido(data, URL_BASE) == referencia(data, URL_BASE)
+
+
+@pytest.mark.parametrize('nombre', sorted(pagina.name for pagina in PAGINAS.glob('*.html')))
+def test_menu_lxml_igual_que_bs4(nombre):
+    data = leer_pagina(nombre)
+    rapido, referencia = PARSERS['menu']
+    assert rapido(data) == referencia(data)
+
+
+def test_productos_de_busqueda():
+    rapido, referencia = PARSERS['productos']
+    productos = referencia(leer_pagina('productos_busqueda.html'), URL_BASE)
+    assert len(productos) == 6
+    assert productos[0] == ('Pollo troceado (caja 10 kg)', '$ 25.00',
+                            f'{URL_BASE}/Item?ProdPid=2735&depPid=46089', '2735')
+    assert productos[1][0] == 'Muslo de pollo & contramuslo'
+
+
+def test_pagina_sin_productos():
+    rapido, referencia = PARSERS['productos']
+    data = leer_pagina('productos_vacia.html')
+    assert referencia(data, URL_BASE) == []
+    assert rapido(data, URL_BASE) == []
+
+
+def test_menu_sin_la_primera_opcion():
+    rapido, referencia = PARSERS['menu']
+    deps = referencia(leer_pagina('productos_departamento.html'))
+    assert list(deps) == ['Alimentos', 'Aseo', 'Combos']
+    assert deps['Alimentos'] == {'46089': 'Cárnicos', '46090': 'Lácteos', '46091': 'Despensa & granos'}
+    assert deps['Combos'] == {}
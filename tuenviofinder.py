@@ -1,15 +1,24 @@
 #!/usr/bin/python3
-import datetime, os, mysql.connector, sys, timeago
+import datetime, os, mysql.connector, sys, timeago, threading, queue, time, atexit, heapq, hashlib, itertools, re, unicodedata, bisect, json, gzip
 from pathlib import Path
-from collections import Counter
+from collections import Counter, namedtuple, OrderedDict, deque
+from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from urllib.parse import urlparse
+from mysql.connector import errorcode
 
 import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from telegram import ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
 # Python wrapper imports
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, JobQueue
 
+# Parsers de las páginas de tuenvio.cu, con lxml si está instalado
+from parsers import PARSERS, LXML_DISPONIBLE
+
 DIRECTORY = Path(os.path.dirname(os.path.realpath(__file__)))
 
 env_path = DIRECTORY / '.env'
@@ -18,6 +27,122 @@ load_dotenv(dotenv_path=env_path)
 TOKEN = os.getenv('TOKEN')
 URL = f'https://api.telegram.org/bot{TOKEN}/'
 
+# Datos de acceso a la base de datos, se pueden definir en el .env
+BD_CONFIG = {
+    'user': os.getenv('BD_USUARIO', 'root'),
+    'password': os.getenv('BD_CLAVE', 'admin'),
+    'host': os.getenv('BD_HOST', '127.0.0.1'),
+    'port': int(os.getenv('BD_PUERTO', 3306)),
+    'database': os.getenv('BD_NOMBRE', 'tuenviofinder'),
+}
+
+# Cantidad máxima de conexiones abiertas a la vez y segundos a esperar por una libre
+BD_TAMANO_POOL = int(os.getenv('BD_TAMANO_POOL', 8))
+BD_ESPERA_POOL = float(os.getenv('BD_ESPERA_POOL', 30))
+
+# Segundos que se mantienen en memoria los datos de referencia (provincias, tiendas, ...)
+CATALOGO_TTL = int(os.getenv('CATALOGO_TTL', 600))
+# Segundos que se sigue usando el catálogo anterior tras un fallo al recargarlo
+CATALOGO_REINTENTO = int(os.getenv('CATALOGO_REINTENTO', 30))
+
+# Segundos que es válido el menú de departamentos de una tienda antes de descargarlo de
+# nuevo en segundo plano, y cuántos menús se descargan a la vez
+MENU_TTL = int(os.getenv('MENU_TTL', 86400))
+MENU_HILOS = int(os.getenv('MENU_HILOS', 4))
+
+# Escritura del log en segundo plano: capacidad de la cola, cada cuántos milisegundos
+# o registros se escribe un lote y qué hacer si la cola se llena ('descartar' o 'bloquear')
+LOG_TAMANO_COLA = int(os.getenv('LOG_TAMANO_COLA', 10000))
+LOG_INTERVALO_MS = int(os.getenv('LOG_INTERVALO_MS', 500))
+LOG_TAMANO_LOTE = int(os.getenv('LOG_TAMANO_LOTE', 200))
+LOG_COLA_LLENA = os.getenv('LOG_COLA_LLENA', 'descartar')
+
+# Descargas de tuenvio.cu: hilos para procesar tiendas en paralelo, peticiones simultáneas
+# máximas a un mismo servidor y segundos de espera por cada petición
+DESCARGA_HILOS = int(os.getenv('DESCARGA_HILOS', 8))
+DESCARGA_HILOS_POR_HOST = int(os.getenv('DESCARGA_HILOS_POR_HOST', 4))
+DESCARGA_TIMEOUT = float(os.getenv('DESCARGA_TIMEOUT', 20))
+
+# Cantidad de búsquedas (criterio o departamento en una tienda) que se guardan en memoria
+CACHE_RESULTADOS_TAMANO = int(os.getenv('CACHE_RESULTADOS_TAMANO', 2000))
+
+# Listado de "📦 Productos": letras mínimas de una palabra para buscarla como prefijo y
+# cuántas palabras del índice puede abarcar como mucho cada prefijo
+INDICE_PREFIJO_MINIMO = int(os.getenv('INDICE_PREFIJO_MINIMO', 3))
+INDICE_PREFIJO_MAXIMO = int(os.getenv('INDICE_PREFIJO_MAXIMO', 50))
+
+# Parser de las páginas de tuenvio.cu ('lxml' o 'bs4') y cada cuántas páginas se comprueba
+# que el resultado de lxml coincide con el de BeautifulSoup (0 para no comprobar nunca)
+PARSER_HTML = os.getenv('PARSER_HTML', 'lxml')
+PARSER_VERIFICAR = int(os.getenv('PARSER_VERIFICAR', 50))
+
+# Cantidad de páginas de tuenvio.cu de las que se recuerda la huella (ETag, Last-Modified
+# y hash del listado de productos) para saber si cambiaron desde la última visita
+HUELLAS_TAMANO = int(os.getenv('HUELLAS_TAMANO', 5000))
+
+# Cada cuántos segundos se envía a los administradores el resumen de notificaciones
+DIGESTO_INTERVALO = int(os.getenv('DIGESTO_INTERVALO', 3600))
+
+# Cómo se buscan los criterios de las subscripciones: 'busqueda' hace una búsqueda en cada
+# tienda por criterio y 'departamentos' recorre una vez los departamentos de cada tienda
+# y busca en ellos todos los criterios a la vez
+ESCANEO_MODO = os.getenv('ESCANEO_MODO', 'busqueda')
+# Páginas de departamentos que se descargan a la vez en el modo 'departamentos'
+ESCANEO_HILOS = int(os.getenv('ESCANEO_HILOS', 2))
+
+# Búsquedas por hora permitidas a los usuarios vip (0 para no limitarlas); el resto
+# usa el ajuste max_busquedas_por_hora
+LIMITE_BUSQUEDAS_VIP = int(os.getenv('LIMITE_BUSQUEDAS_VIP', 0))
+
+# Recorrido de todas las tiendas en segundo plano: cada cuántos segundos (0 para no
+# hacerlo) y cuántas páginas de departamentos se descargan a la vez
+RASTREO_INTERVALO = int(os.getenv('RASTREO_INTERVALO', 0))
+RASTREO_HILOS = int(os.getenv('RASTREO_HILOS', 2))
+
+# Cada cuántos segundos se suman las búsquedas nuevas en la tabla mas_buscados
+MAS_BUSCADOS_INTERVALO = int(os.getenv('MAS_BUSCADOS_INTERVALO', 3600))
+# Solo se suman las búsquedas con más de estos segundos, para no saltarse las que aún
+# se estaban guardando con un bid menor
+MAS_BUSCADOS_MARGEN = int(os.getenv('MAS_BUSCADOS_MARGEN', 300))
+
+# Retención: cada cuántos segundos se borran las filas viejas (0 para no hacerlo), días
+# que se guardan las búsquedas (con sus resultados) y el log (0 para no borrarlos),
+# filas por lote, pausa entre lotes y directorio donde archivarlas antes ('' para no hacerlo)
+RETENCION_INTERVALO = int(os.getenv('RETENCION_INTERVALO', 86400))
+RETENCION_BUSQUEDA_DIAS = int(os.getenv('RETENCION_BUSQUEDA_DIAS', 0))
+RETENCION_LOG_DIAS = int(os.getenv('RETENCION_LOG_DIAS', 0))
+RETENCION_LOTE = int(os.getenv('RETENCION_LOTE', 1000))
+RETENCION_PAUSA_MS = int(os.getenv('RETENCION_PAUSA_MS', 500))
+RETENCION_ARCHIVO = os.getenv('RETENCION_ARCHIVO', '')
+
+# Cada cuántos segundos se comparan los saldos de crédito en memoria con los de la BD
+CREDITO_CONCILIACION = int(os.getenv('CREDITO_CONCILIACION', 600))
+
+# Mensajes que se envían a través de la cola de salida: máximo por segundo en total y por
+# chat (límites de Telegram) y cuántas veces se reintenta un mensaje si falla la red
+SALIDA_MENSAJES_POR_SEGUNDO = float(os.getenv('SALIDA_MENSAJES_POR_SEGUNDO', 30))
+SALIDA_MENSAJES_POR_CHAT = float(os.getenv('SALIDA_MENSAJES_POR_CHAT', 1))
+SALIDA_REINTENTOS = int(os.getenv('SALIDA_REINTENTOS', 5))
+
+# Cómo se reciben las actualizaciones de Telegram ('polling' o 'webhook') e hilos que
+# atienden los mensajes de los usuarios. En modo webhook se escucha en WEBHOOK_ESCUCHA:
+# WEBHOOK_PUERTO y Telegram envía las actualizaciones a WEBHOOK_URL/WEBHOOK_RUTA
+MODO_BOT = os.getenv('MODO_BOT', 'polling')
+MANEJADORES_HILOS = int(os.getenv('MANEJADORES_HILOS', 8))
+WEBHOOK_ESCUCHA = os.getenv('WEBHOOK_ESCUCHA', '127.0.0.1')
+WEBHOOK_PUERTO = int(os.getenv('WEBHOOK_PUERTO', 8443))
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_RUTA = os.getenv('WEBHOOK_RUTA', TOKEN)
+
+# Telegram solo envía actualizaciones a direcciones https, sin WEBHOOK_URL el bot
+# arrancaría sin recibir ningún mensaje
+if MODO_BOT == 'webhook':
+    WEBHOOK_URL = WEBHOOK_URL.rstrip('/')
+    url_webhook = urlparse(WEBHOOK_URL)
+    if url_webhook.scheme != 'https' or not url_webhook.netloc:
+        sys.exit(f'Error: con MODO_BOT=webhook se debe definir WEBHOOK_URL con una dirección https, '
+                 f'por ejemplo https://ejemplo.com (valor actual: {WEBHOOK_URL!r})')
+
 # En caso de usar un proxy
 REQUEST_KWARGS={
     'proxy_url': 'http://172.26.1.10:3128/',
@@ -66,6 +191,44 @@ LOGOS = {
 }
 
 session = requests.Session()  
+session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=DESCARGA_HILOS))
+
+# Hilos que descargan y procesan las tiendas de una búsqueda a la vez
+POOL_TIENDAS = ThreadPoolExecutor(max_workers=DESCARGA_HILOS, thread_name_prefix='tienda')
+
+LOCK_HOSTS = threading.Lock()
+SEMAFOROS_HOSTS = {}
+
+
+# Limita cuántas peticiones simultáneas se le hacen a un mismo servidor
+def semaforo_host(url):
+    host = urlparse(url).netloc
+    with LOCK_HOSTS:
+        if host not in SEMAFOROS_HOSTS:
+            SEMAFOROS_HOSTS[host] = threading.BoundedSemaphore(DESCARGA_HILOS_POR_HOST)
+        return SEMAFOROS_HOSTS[host]
+
+
+# Descarga una página de tuenvio.cu y retorna su contenido como texto
+def descargar_pagina(url):
+    with semaforo_host(url):
+        respuesta = session.get(url, headers=HEADERS, timeout=DESCARGA_TIMEOUT)
+    return respuesta.content.decode('utf8')
+
+
+# Igual que descargar_pagina pero enviando las cabeceras condicionales indicadas
+# Retorna (contenido, cabeceras), el contenido es None si el servidor respondió 304
+def descargar_pagina_condicional(url, etag=None, last_modified=None):
+    cabeceras = dict(HEADERS)
+    if etag:
+        cabeceras['If-None-Match'] = etag
+    if last_modified:
+        cabeceras['If-Modified-Since'] = last_modified
+    with semaforo_host(url):
+        respuesta = session.get(url, headers=cabeceras, timeout=DESCARGA_TIMEOUT)
+    if respuesta.status_code == 304:
+        return None, respuesta.headers
+    return respuesta.content.decode('utf8'), respuesta.headers
 
 TEXTO_AYUDA = f'<b>¡Bienvenido a la {BOTONES["AYUDA"]}!</b>\n\nEl bot cuenta con varias opciones para su manejo, siéntase libre de consultar esta \
 Ayuda siempre que lo considere necesario. \n\n<b>{BOTONES["INICIO"]}</b>: Reinicia el bot a sus opciones por defecto.\n\n<b>{BOTONES["INFO"]}</b>: \
@@ -77,9 +240,47 @@ aquella donde se realizarán las búsquedas.\n\n<b>{BOTONES["CATEGORIAS"]}</b>:
  Los comandos de selección manual de provincia son:\n/pr, /ar, /my, /lh, /mt, /cf, /ss, /ca, /cm, /lt, /hl, /gr, /sc, /gt, /ij.'
 
 
-def inicializar_bd():
+# Todos los contadores internos del bot comparten este lock
+LOCK_ESTADISTICAS = threading.Lock()
+
+
+def contar_estadistica(estadisticas, clave, cantidad=1):
+    with LOCK_ESTADISTICAS:
+        estadisticas[clave] += cantidad
+        return estadisticas[clave]
+
+
+def copiar_estadisticas(estadisticas):
+    with LOCK_ESTADISTICAS:
+        return dict(estadisticas)
+
+
+# Pool de conexiones a la base de datos
+# Cada elemento de la cola es una conexión abierta o None si aún no se ha creado,
+# así nunca hay más de BD_TAMANO_POOL conexiones y solo se abren las que hacen falta.
+# Un hilo que ya tiene una conexión la reutiliza en las llamadas anidadas para no
+# bloquearse esperando por otra. Si el hilo tiene un contador (el del mensaje que se
+# atiende) cada uso de conexion_bd se suma en él.
+POOL_BD = queue.LifoQueue(maxsize=BD_TAMANO_POOL)
+CONEXION_HILO = threading.local()
+ESTADISTICAS_BD = {
+    'creadas': 0,
+    'reutilizadas': 0,
+    'esperas': 0,
+    'fallidas': 0,
+}
+
+
+def estadisticas_pool_bd():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_BD)
+    estadisticas['libres'] = POOL_BD.qsize()
+    estadisticas['tamano'] = BD_TAMANO_POOL
+    return estadisticas
+
+
+def crear_conexion_bd():
     try:
-        conn = mysql.connector.connect(user='root', password='admin', host='127.0.0.1',database='tuenviofinder')
+        return mysql.connector.connect(**BD_CONFIG)
     except mysql.connector.Error as err:
         if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
             print('Usuario o contraseña incorrectos.')
@@ -87,60 +288,453 @@ def inicializar_bd():
             print('La base de datos no existe.')
         else:
             print(err)
-    
-    cursor = conn.cursor()
-    return (conn, cursor)  
+        raise
+
+
+def inicializar_bd():
+    for i in range(BD_TAMANO_POOL):
+        POOL_BD.put(None)
+
+
+def obtener_conexion_bd():
+    try:
+        conn = POOL_BD.get_nowait()
+    except queue.Empty:
+        contar_estadistica(ESTADISTICAS_BD, 'esperas')
+        try:
+            conn = POOL_BD.get(timeout=BD_ESPERA_POOL)
+        except queue.Empty:
+            contar_estadistica(ESTADISTICAS_BD, 'fallidas')
+            raise RuntimeError(f'No se obtuvo una conexión libre en {BD_ESPERA_POOL} segundos')
+    try:
+        if conn is None:
+            conn = crear_conexion_bd()
+            contar_estadistica(ESTADISTICAS_BD, 'creadas')
+        else:
+            if not conn.is_connected():
+                conn.reconnect(attempts=3, delay=1)
+            contar_estadistica(ESTADISTICAS_BD, 'reutilizadas')
+    except Exception:
+        # Se devuelve el hueco al pool para que otro hilo lo pueda intentar
+        POOL_BD.put(None)
+        contar_estadistica(ESTADISTICAS_BD, 'fallidas')
+        raise
+    return conn
+
+
+def liberar_conexion_bd(conn):
+    try:
+        # Lo que no se haya confirmado se descarta, igual que al cerrar la conexión,
+        # y así la próxima transacción no ve una instantánea vieja
+        conn.rollback()
+    except mysql.connector.Error:
+        conn.close()
+        conn = None
+    POOL_BD.put(conn)
+
+
+# Uso: with conexion_bd() as (conn, cursor): ...
+# La conexión vuelve al pool al salir del bloque aunque se produzca una excepción
+@contextmanager
+def conexion_bd():
+    contador = getattr(CONEXION_HILO, 'contador', None)
+    if contador is not None:
+        contar_estadistica(contador, 'accesos')
+    if getattr(CONEXION_HILO, 'profundidad', 0):
+        conn = CONEXION_HILO.conn
+        CONEXION_HILO.profundidad += 1
+        cursor = conn.cursor(buffered=True)
+        try:
+            yield (conn, cursor)
+        finally:
+            cursor.close()
+            CONEXION_HILO.profundidad -= 1
+        return
+
+    conn = obtener_conexion_bd()
+    CONEXION_HILO.conn = conn
+    CONEXION_HILO.profundidad = 1
+    try:
+        cursor = conn.cursor(buffered=True)
+        try:
+            yield (conn, cursor)
+        finally:
+            cursor.close()
+    finally:
+        CONEXION_HILO.profundidad = 0
+        CONEXION_HILO.conn = None
+        liberar_conexion_bd(conn)
+
+
+inicializar_bd()
+
+
+# Catálogo en memoria de los datos de referencia
+# Provincias, tiendas, categorías, departamentos, mensajes, frecuencias y ajustes del bot
+# casi nunca cambian, así que se leen todos de una vez y se vuelven a leer cuando pasan
+# CATALOGO_TTL segundos o cuando el propio bot inserta filas nuevas (invalidar_catalogo).
+Tienda = namedtuple('Tienda', ['tid', 'nombre', 'prov_id'])
+Departamento = namedtuple('Departamento', ['did', 'nombre', 'cid'])
+
+LOCK_CATALOGO = threading.Lock()
+CATALOGO = {
+    'datos': None,
+    'cargado': 0,
+    # Se pone a False para forzar la recarga sin depender del reloj monotónico
+    'vigente': False,
+    # Momento del último intento de recarga fallido, None si no ha fallado
+    'fallo': None,
+}
+ESTADISTICAS_CATALOGO = {
+    'aciertos': 0,
+    'fallos': 0,
+    'recargas': 0,
+}
+
+
+def cargar_catalogo():
+    datos = {
+        'provincias': {},
+        'tiendas': {},
+        'tiendas_por_provincia': {},
+        'categorias': {},
+        'categorias_por_id': {},
+        'departamentos': {},
+        'mensajes': {},
+        'frecuencias': {},
+        'ajustes_bot': {},
+        'comandos_tienda': {},
+    }
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT prov_id, nombre FROM provincia''')
+        for (prov_id, nombre) in cursor:
+            datos['provincias'][prov_id] = nombre
+        cursor.execute('''SELECT tid, nombre, prov_id FROM tienda''')
+        for (tid, nombre, prov_id) in cursor:
+            datos['tiendas'][tid] = Tienda(tid, nombre, prov_id)
+            datos['tiendas_por_provincia'].setdefault(prov_id, []).append( (tid, nombre) )
+        cursor.execute('''SELECT cid, nombre FROM categoria''')
+        for (cid, nombre) in cursor:
+            datos['categorias'][nombre] = cid
+            datos['categorias_por_id'][cid] = nombre
+        cursor.execute('''SELECT did, nombre, cid FROM departamento''')
+        for (did, nombre, cid) in cursor:
+            # Los ids llegan como texto en los callbacks de los teclados
+            datos['departamentos'][str(did)] = Departamento(did, nombre, cid)
+        cursor.execute('''SELECT mid, texto FROM mensaje''')
+        for (mid, texto) in cursor:
+            datos['mensajes'][mid] = texto
+        cursor.execute('''SELECT frecuencia, texto FROM frecuencia_escaneo''')
+        for (frecuencia, texto) in cursor:
+            datos['frecuencias'][int(frecuencia)] = texto
+        cursor.execute('''SELECT clave, valor FROM ajustes_bot''')
+        for (clave, valor) in cursor:
+            datos['ajustes_bot'][clave] = valor
+        cursor.execute('''SELECT comando, tid FROM comandos_tienda''')
+        for (comando, tid) in cursor:
+            datos['comandos_tienda'][comando] = tid
+    return datos
+
+
+def catalogo_vencido():
+    if CATALOGO['datos'] is None:
+        return True
+    # Con la BD caída no se reintenta en cada acceso, se sirve el catálogo anterior
+    if CATALOGO['fallo'] is not None and time.monotonic() - CATALOGO['fallo'] < CATALOGO_REINTENTO:
+        return False
+    return not CATALOGO['vigente'] or time.monotonic() - CATALOGO['cargado'] > CATALOGO_TTL
+
+
+def obtener_catalogo():
+    if catalogo_vencido():
+        with LOCK_CATALOGO:
+            # Otro hilo pudo haberlo recargado mientras se esperaba por el lock
+            if catalogo_vencido():
+                try:
+                    CATALOGO['datos'] = cargar_catalogo()
+                    CATALOGO['cargado'] = time.monotonic()
+                    CATALOGO['vigente'] = True
+                    CATALOGO['fallo'] = None
+                    contar_estadistica(ESTADISTICAS_CATALOGO, 'recargas')
+                except Exception as ex:
+                    # Si ya había un catálogo se sigue usando hasta el próximo intento
+                    if CATALOGO['datos'] is None:
+                        raise
+                    CATALOGO['fallo'] = time.monotonic()
+                    print('obtener_catalogo:', ex)
+    return CATALOGO['datos']
+
+
+# Obliga a releer el catálogo en el próximo acceso
+def invalidar_catalogo():
+    with LOCK_CATALOGO:
+        CATALOGO['vigente'] = False
+
+
+def buscar_en_catalogo(tabla, clave, defecto=None):
+    valores = obtener_catalogo()[tabla]
+    if clave in valores:
+        contar_estadistica(ESTADISTICAS_CATALOGO, 'aciertos')
+        return valores[clave]
+    contar_estadistica(ESTADISTICAS_CATALOGO, 'fallos')
+    return defecto
+
+
+def estadisticas_catalogo():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_CATALOGO)
+    estadisticas['edad'] = int(time.monotonic() - CATALOGO['cargado']) if CATALOGO['datos'] else None
+    return estadisticas
 
 
 def obtener_ajuste_bot(clave):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT valor FROM ajustes_bot WHERE clave = %s''', (clave, ))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return result[0]
+    valor = buscar_en_catalogo('ajustes_bot', clave)
+    if valor is not None:
+        return valor
     else:
         debug_print(f'obtener_ajuste_bot: clave {clave} inexistente')
     return False
 
 
+# Registro del log en segundo plano
+# debug_print solo encola el registro; un hilo escritor los inserta por lotes con
+# executemany cuando se juntan LOG_TAMANO_LOTE o pasan LOG_INTERVALO_MS desde el primero.
+COLA_LOG = queue.Queue(maxsize=LOG_TAMANO_COLA)
+ESTADISTICAS_LOG = {
+    'encolados': 0,
+    'escritos': 0,
+    'descartados': 0,
+}
+# Marca de fin para el hilo escritor
+FIN_LOG = object()
+
+
 def debug_print(message, tipo='estado'):
     print(message)
-    conn, cursor = inicializar_bd()
-    fecha = datetime.datetime.now()
-    cursor.execute('''INSERT INTO log(mensaje, fecha, tipo) VALUES(%s, %s, %s)''', (message, fecha, tipo))
-    conn.commit()
-    conn.close()
+    registro = (str(message), datetime.datetime.now(), tipo)
+    if LOG_COLA_LLENA == 'bloquear':
+        COLA_LOG.put(registro)
+    else:
+        try:
+            COLA_LOG.put_nowait(registro)
+        except queue.Full:
+            contar_estadistica(ESTADISTICAS_LOG, 'descartados')
+            return
+    contar_estadistica(ESTADISTICAS_LOG, 'encolados')
+
+
+def escribir_lote_log(lote):
+    try:
+        with conexion_bd() as (conn, cursor):
+            cursor.executemany('''INSERT INTO log(mensaje, fecha, tipo) VALUES(%s, %s, %s)''', lote)
+            conn.commit()
+        contar_estadistica(ESTADISTICAS_LOG, 'escritos', len(lote))
+    except Exception as ex:
+        print('escribir_lote_log:', ex)
+        contar_estadistica(ESTADISTICAS_LOG, 'descartados', len(lote))
+
+
+def escritor_log():
+    intervalo = LOG_INTERVALO_MS / 1000
+    terminar = False
+    while not terminar:
+        registro = COLA_LOG.get()
+        if registro is FIN_LOG:
+            break
+        lote = [registro]
+        limite = time.monotonic() + intervalo
+        while len(lote) < LOG_TAMANO_LOTE:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                registro = COLA_LOG.get(timeout=restante)
+            except queue.Empty:
+                break
+            if registro is FIN_LOG:
+                terminar = True
+                break
+            lote.append(registro)
+        escribir_lote_log(lote)
+
+    # Se vacía lo que quede en la cola antes de salir
+    lote = []
+    while True:
+        try:
+            registro = COLA_LOG.get_nowait()
+        except queue.Empty:
+            break
+        if registro is not FIN_LOG:
+            lote.append(registro)
+    for i in range(0, len(lote), LOG_TAMANO_LOTE):
+        escribir_lote_log(lote[i:i + LOG_TAMANO_LOTE])
+
+
+HILO_LOG = threading.Thread(target=escritor_log, name='escritor_log', daemon=True)
+
+
+def iniciar_escritor_log():
+    HILO_LOG.start()
+
+
+# Al terminar el programa se escriben los registros pendientes
+def detener_escritor_log():
+    if HILO_LOG.is_alive():
+        COLA_LOG.put(FIN_LOG)
+        HILO_LOG.join(timeout=30)
+
+
+def estadisticas_log():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_LOG)
+    estadisticas['pendientes'] = COLA_LOG.qsize()
+    return estadisticas
+
+
+iniciar_escritor_log()
+atexit.register(detener_escritor_log)
+
+
+# Cola de salida de mensajes
+# Las notificaciones y mensajes que no son la respuesta inmediata a un comando se encolan
+# con enviar_mensaje y los envía un hilo aparte, así las búsquedas programadas no esperan
+# por la red. Se atienden primero las respuestas a usuarios (PRIORIDAD_RESPUESTA) y se
+# respetan los límites de Telegram con una cubeta de fichas global y otra por chat.
+# Si Telegram responde 429 se espera lo que indique retry_after y se vuelve a intentar.
+PRIORIDAD_RESPUESTA = 0
+PRIORIDAD_NOTIFICACION = 1
+PRIORIDAD_RESUMEN = 2
+
+Envio = namedtuple('Envio', ['chat_id', 'texto', 'opciones', 'encolado', 'intentos'])
+
+COLA_SALIDA = queue.PriorityQueue()
+SECUENCIA_SALIDA = itertools.count()
+FIN_SALIDA = (float('inf'), float('inf'), None)
+ESTADISTICAS_SALIDA = {
+    'encolados': 0,
+    'enviados': 0,
+    'reintentos': 0,
+    'fallidos': 0,
+    'latencia_total': 0.0,
+    'latencia_maxima': 0.0,
+    'demorados': 0,
+}
+
+
+def enviar_mensaje(chat_id, texto, prioridad=PRIORIDAD_NOTIFICACION, **opciones):
+    envio = Envio(chat_id, texto, opciones, time.monotonic(), 0)
+    COLA_SALIDA.put( (prioridad, next(SECUENCIA_SALIDA), envio) )
+    contar_estadistica(ESTADISTICAS_SALIDA, 'encolados')
+
+
+# Cubeta de fichas: {'fichas', 'actualizado'}. Retorna 0 si se pudo tomar una ficha
+# o los segundos que faltan para que haya una
+def tomar_ficha(cubeta, tasa, ahora):
+    cubeta['fichas'] = min(tasa, cubeta['fichas'] + (ahora - cubeta['actualizado']) * tasa)
+    cubeta['actualizado'] = ahora
+    if cubeta['fichas'] >= 1:
+        cubeta['fichas'] -= 1
+        return 0
+    return (1 - cubeta['fichas']) / tasa
+
+
+def nueva_cubeta(tasa):
+    return {'fichas': max(1, tasa), 'actualizado': time.monotonic()}
+
+
+def enviador_mensajes():
+    cubeta_global = nueva_cubeta(SALIDA_MENSAJES_POR_SEGUNDO)
+    cubetas_chats = {}
+    # Mensajes que esperan por el límite de su chat o por un reintento: (listo_en, elemento)
+    demorados = []
+    while True:
+        ahora = time.monotonic()
+        while demorados and demorados[0][0] <= ahora:
+            COLA_SALIDA.put(heapq.heappop(demorados)[1])
+        with LOCK_ESTADISTICAS:
+            ESTADISTICAS_SALIDA['demorados'] = len(demorados)
+        try:
+            elemento = COLA_SALIDA.get(timeout=demorados[0][0] - ahora if demorados else None)
+        except queue.Empty:
+            continue
+        if elemento is FIN_SALIDA:
+            break
+        prioridad, secuencia, envio = elemento
+
+        ahora = time.monotonic()
+        # Las cubetas llenas de chats sin actividad reciente no hacen falta
+        if len(cubetas_chats) > 10000:
+            cubetas_chats = { chat: cubeta for chat, cubeta in cubetas_chats.items() if ahora - cubeta['actualizado'] < 60 }
+        cubeta_chat = cubetas_chats.setdefault(envio.chat_id, nueva_cubeta(SALIDA_MENSAJES_POR_CHAT))
+        espera = tomar_ficha(cubeta_chat, SALIDA_MENSAJES_POR_CHAT, ahora)
+        if espera:
+            heapq.heappush(demorados, (ahora + espera, elemento))
+            continue
+        espera = tomar_ficha(cubeta_global, SALIDA_MENSAJES_POR_SEGUNDO, ahora)
+        while espera:
+            time.sleep(espera)
+            espera = tomar_ficha(cubeta_global, SALIDA_MENSAJES_POR_SEGUNDO, time.monotonic())
+
+        try:
+            updater.bot.send_message(chat_id=envio.chat_id, text=envio.texto, **envio.opciones)
+            latencia = time.monotonic() - envio.encolado
+            contar_estadistica(ESTADISTICAS_SALIDA, 'enviados')
+            contar_estadistica(ESTADISTICAS_SALIDA, 'latencia_total', latencia)
+            with LOCK_ESTADISTICAS:
+                ESTADISTICAS_SALIDA['latencia_maxima'] = max(ESTADISTICAS_SALIDA['latencia_maxima'], latencia)
+        except BadRequest as ex:
+            # BadRequest hereda de NetworkError pero no tiene sentido reintentarlo
+            contar_estadistica(ESTADISTICAS_SALIDA, 'fallidos')
+            debug_print(f'enviador_mensajes: {envio.chat_id}: {ex}', 'error')
+        except (RetryAfter, TimedOut, NetworkError) as ex:
+            if envio.intentos >= SALIDA_REINTENTOS:
+                contar_estadistica(ESTADISTICAS_SALIDA, 'fallidos')
+                debug_print(f'enviador_mensajes: descartado mensaje a {envio.chat_id} tras {envio.intentos} reintentos: {ex}', 'error')
+                continue
+            # Telegram indica cuánto esperar, en otro caso se espera cada vez más
+            espera = ex.retry_after if isinstance(ex, RetryAfter) else 2 ** envio.intentos
+            contar_estadistica(ESTADISTICAS_SALIDA, 'reintentos')
+            heapq.heappush(demorados, (time.monotonic() + espera,
+                                       (prioridad, secuencia, envio._replace(intentos=envio.intentos + 1))))
+        except Exception as ex:
+            # Chat bloqueado, inexistente, texto incorrecto... no tiene sentido reintentar
+            contar_estadistica(ESTADISTICAS_SALIDA, 'fallidos')
+            debug_print(f'enviador_mensajes: {envio.chat_id}: {ex}', 'error')
+
+
+HILO_SALIDA = threading.Thread(target=enviador_mensajes, name='enviador_mensajes', daemon=True)
+
+
+def iniciar_enviador_mensajes():
+    HILO_SALIDA.start()
+
+
+# Al terminar el programa se intentan enviar los mensajes que ya están listos
+def detener_enviador_mensajes():
+    if HILO_SALIDA.is_alive():
+        COLA_SALIDA.put(FIN_SALIDA)
+        HILO_SALIDA.join(timeout=30)
+
+
+def estadisticas_salida():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_SALIDA)
+    estadisticas['pendientes'] = COLA_SALIDA.qsize() + estadisticas['demorados']
+    enviados = estadisticas['enviados']
+    estadisticas['latencia_media'] = estadisticas['latencia_total'] / enviados if enviados else 0
+    return estadisticas
 
 
 # Retorna una lista con tuplas de id de tienda y su nombre dada una provincia
 def obtener_tiendas(prov):
-    conn, cursor = inicializar_bd()
-    tiendas = []
-    cursor.execute('''SELECT tid, nombre FROM tienda WHERE prov_id=%s''', (prov, ))
-    for (tid, nombre) in cursor:
-        tiendas.append( (tid, nombre) )
-    conn.close()
-    return tiendas
+    return list(buscar_en_catalogo('tiendas_por_provincia', prov, []))
 
 def obtener_todas_las_tiendas():
-    conn, cursor = inicializar_bd()
-    tiendas = []
-    cursor.execute('''SELECT tid FROM tienda''')
-    for (tid, ) in cursor:
-        tiendas.append(tid)
-    conn.close()
-    return tiendas   
+    return list(obtener_catalogo()['tiendas'])
 
 
 def obtener_nombre_tienda(tid):
     try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT nombre FROM tienda WHERE tid=%s''', (tid, ))
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            return result[0]
+        tienda = buscar_en_catalogo('tiendas', tid)
+        if tienda:
+            return tienda.nombre
         return False
     except Exception as ex:
          print('obtener_nombre_tienda', ex)
@@ -148,12 +742,8 @@ def obtener_nombre_tienda(tid):
 
 def obtener_nombre_provincia(prov_id):
     try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT nombre FROM provincia WHERE prov_id=%s''', (prov_id, ))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0]
-    except:
+        return buscar_en_catalogo('provincias', prov_id)
+    except Exception as ex:
          print('obtener_nombre_provincia', ex)
 
 
@@ -162,86 +752,177 @@ def obtener_logo_provincia(prov_id):
 
 
 def obtener_ids_provincias():
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT prov_id FROM provincia''')
-    provincias = []
-    for (prov_id) in cursor:
-        provincias.append(prov_id)
-    conn.close()
-    return provincias
+    return list(obtener_catalogo()['provincias'])
 
 
 def obtener_nombre_logo_provincia(prov_id):
     return ( obtener_nombre_provincia(prov_id), obtener_logo_provincia(prov_id) )    
 
 
+# Sesión de usuario de cada mensaje
+# Al atender un mensaje de texto se leen en una sola consulta el registro del usuario,
+# sus ajustes, su crédito y su tipo. Mientras se atiende el
+# mensaje las funciones que consultan esos datos los toman de la sesión del hilo, y
+# los débitos de crédito se acumulan y se guardan juntos al terminar.
+SESION_HILO = threading.local()
+ESTADISTICAS_SESIONES = {
+    'mensajes': 0,
+    'accesos_bd': 0,
+}
+
+
+def cargar_sesion_usuario(idchat):
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT usuario.credito, usuario.tipo, ajustes_usuario.uid, ajustes_usuario.prov_id, \
+                          ajustes_usuario.tid, ajustes_usuario.cid, ajustes_usuario.did, \
+                          ajustes_usuario.cat_kb_message_id \
+                          FROM usuario LEFT JOIN ajustes_usuario ON ajustes_usuario.uid = usuario.uid \
+                          WHERE usuario.uid=%s''', (idchat, ))
+        fila = cursor.fetchone()
+    sesion = {
+        'uid': idchat,
+        'registrado': fila is not None,
+        'ajustes': False,
+        'credito': 0,
+        'tipo': None,
+        'debitos': [],
+    }
+    if fila:
+        credito, tipo, uid_ajustes, prov_id, tid, cid, did, cat_kb_message_id = fila
+        sesion['credito'] = credito or 0
+        guardar_credito_en_cache(idchat, credito)
+        sesion['tipo'] = tipo
+        if uid_ajustes is not None:
+            sesion['ajustes'] = {
+                'prov_id': prov_id,
+                'tid': tid,
+                'cid': cid,
+                'did': did,
+                'cat_kb_message_id': cat_kb_message_id
+            }
+    return sesion
+
+
+# Retorna la sesión que se está atendiendo en este hilo si es la del usuario indicado
+def sesion_actual(idchat):
+    sesion = getattr(SESION_HILO, 'sesion', None)
+    if sesion and sesion['uid'] == idchat:
+        return sesion
+    return None
+
+
+# Los ajustes se vuelven a leer de la BD la próxima vez que se consulten
+def olvidar_ajustes_sesion(idchat):
+    sesion = sesion_actual(idchat)
+    if sesion:
+        sesion['ajustes'] = None
+
+
+# Guarda en una transacción los débitos de crédito acumulados durante el mensaje
+def guardar_sesion_usuario(sesion):
+    if not sesion['debitos']:
+        return
+    uid = sesion['uid']
+    if debitar_credito(uid, sesion['debitos']) == 0:
+        enviar_mensaje(uid, 'Su crédito se ha agotado, por favor, recargue 👍.', PRIORIDAD_RESPUESTA, parse_mode='HTML')
+        debug_print(f'Agotado el crédito del usuario {uid}')
+
+
+# Uso: with sesion_usuario(idchat) as sesion: ...
+# Los accesos a la BD del mensaje se cuentan en su contador, que también usan los hilos
+# que trabajan para él (ver con_contador_bd)
+@contextmanager
+def sesion_usuario(idchat):
+    contador = { 'accesos': 0 }
+    CONEXION_HILO.contador = contador
+    SESION_HILO.sesion = cargar_sesion_usuario(idchat)
+    try:
+        yield SESION_HILO.sesion
+    finally:
+        sesion = SESION_HILO.sesion
+        SESION_HILO.sesion = None
+        try:
+            guardar_sesion_usuario(sesion)
+        except Exception as ex:
+            debug_print(f'guardar_sesion_usuario {idchat}: {ex}', 'error')
+        CONEXION_HILO.contador = None
+        contar_estadistica(ESTADISTICAS_SESIONES, 'mensajes')
+        contar_estadistica(ESTADISTICAS_SESIONES, 'accesos_bd', contador['accesos'])
+
+
+# Envuelve funcion para ejecutarla en otro hilo (como los de POOL_TIENDAS) contando sus
+# accesos a la BD en el mensaje que se atiende en este hilo
+def con_contador_bd(funcion):
+    contador = getattr(CONEXION_HILO, 'contador', None)
+
+    @wraps(funcion)
+    def envoltura(*args, **kwargs):
+        CONEXION_HILO.contador = contador
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            CONEXION_HILO.contador = None
+    return envoltura
+
+
+def estadisticas_sesiones():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_SESIONES)
+    mensajes = estadisticas['mensajes']
+    estadisticas['accesos_por_mensaje'] = estadisticas['accesos_bd'] / mensajes if mensajes else 0
+    return estadisticas
+
+
 def obtener_ajustes_usuario(idchat):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT * FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
-    au = cursor.fetchone()
-    conn.close()
+    sesion = sesion_actual(idchat)
+    if sesion and sesion['ajustes'] is not None:
+        return sesion['ajustes']
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT * FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
+        au = cursor.fetchone()
+    ajustes = False
     if au:
-        return {
+        ajustes = {
             'prov_id': au[1],
             'tid': au[2],
             'cid': au[3],
             'did': au[4],
             'cat_kb_message_id': au[5]
         }
-    return False
+    if sesion:
+        sesion['ajustes'] = ajustes
+    return ajustes
 
 
 def obtener_nombre_categoria(cid):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT nombre FROM categoria WHERE cid=%s''', (cid, ))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0]
+    return buscar_en_catalogo('categorias_por_id', cid)
 
 
 def obtener_nombre_departamento(did):
     try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT nombre FROM departamento WHERE did=%s''', (did, ))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0]
-    except:
+        return buscar_en_catalogo('departamentos', str(did)).nombre
+    except Exception as ex:
          print('obtener_nombre_departamento', ex)
 
 
 # Determina si el argumento pasado es un id de provincia
 def es_id_de_provincia(prov_id):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT * FROM provincia WHERE prov_id=%s''', (prov_id, ))
-    result = len(cursor.fetchall())
-    conn.close()
-    return result
+    return buscar_en_catalogo('provincias', prov_id) is not None
 
 
 def es_categoria(cat):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT * FROM categoria WHERE nombre=%s''', (cat, ))
-    result = len(cursor.fetchall())
-    conn.close()
-    return result
+    return buscar_en_catalogo('categorias', cat) is not None
 
 
 def es_departamento(did):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT * FROM departamento WHERE did=%s''', (did, ))
-    result = len(cursor.fetchall())
-    conn.close()
-    return result  
+    return buscar_en_catalogo('departamentos', str(did)) is not None
 
 
 def obtener_departamentos():
-    conn, cursor = inicializar_bd()
-    cursor.execute('SELECT nombre FROM departamentos')
     deps = []
-    for row in cursor.fetchall():
-        deps.append(row[0])
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('SELECT nombre FROM departamentos')
+        for row in cursor.fetchall():
+            deps.append(row[0])
     return deps
 
 
@@ -259,19 +940,68 @@ def mensaje_seleccion_provincia(prov):
 
 
 def obtener_mensaje(clave):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT texto FROM mensaje WHERE mid=%s''', (clave, ))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0]     
+    return buscar_en_catalogo('mensajes', clave)
 
 
 # Inicializar todo
-updater = Updater(TOKEN, use_context=True)
-#updater = Updater(TOKEN, use_context=True, request_kwargs=REQUEST_KWARGS)
+updater = Updater(TOKEN, use_context=True, workers=MANEJADORES_HILOS)
+#updater = Updater(TOKEN, use_context=True, workers=MANEJADORES_HILOS, request_kwargs=REQUEST_KWARGS)
 dispatcher = updater.dispatcher
 
 
+# Los manejadores se ejecutan con run_async en los hilos del dispatcher para que una
+# búsqueda lenta no detenga a los demás usuarios. Los mensajes de un mismo chat se
+# atienden de uno en uno y en el orden en que llegaron: cada chat tiene su cola y
+# solo un hilo a la vez la vacía.
+LOCK_COLAS_CHATS = threading.Lock()
+COLAS_CHATS = {}
+LATENCIAS_MANEJADORES = deque(maxlen=1000)
+
+
+def en_orden_por_chat(funcion):
+    @wraps(funcion)
+    def manejador(update, context):
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        with LOCK_COLAS_CHATS:
+            cola = COLAS_CHATS.get(chat_id)
+            nueva = cola is None
+            if nueva:
+                cola = COLAS_CHATS[chat_id] = deque()
+            cola.append( (funcion, update, context, time.monotonic()) )
+        if nueva:
+            dispatcher.run_async(atender_chat, chat_id)
+    return manejador
+
+
+def atender_chat(chat_id):
+    while True:
+        with LOCK_COLAS_CHATS:
+            cola = COLAS_CHATS[chat_id]
+            if not cola:
+                del COLAS_CHATS[chat_id]
+                return
+            funcion, update, context, recibido = cola.popleft()
+        try:
+            funcion(update, context)
+        except Exception as ex:
+            debug_print(f'{funcion.__name__}: {ex}', 'error')
+        with LOCK_ESTADISTICAS:
+            LATENCIAS_MANEJADORES.append(time.monotonic() - recibido)
+
+
+def estadisticas_manejadores():
+    with LOCK_ESTADISTICAS:
+        latencias = sorted(LATENCIAS_MANEJADORES)
+    with LOCK_COLAS_CHATS:
+        chats = len(COLAS_CHATS)
+    percentil = lambda p: latencias[min(len(latencias) - 1, int(p * len(latencias)))] if latencias else 0
+    return {
+        'chats_en_curso': chats,
+        'p50': percentil(0.5),
+        'p99': percentil(0.99),
+    }
+
+
 # Pequeña función para generar un menu para teclado
 def construir_menu(buttons,
                    n_cols,
@@ -289,15 +1019,15 @@ def construir_menu(buttons,
 def start(update, context):
     iniciar_aplicacion(update, context)
 
-dispatcher.add_handler( CommandHandler('start', start) )
+dispatcher.add_handler( CommandHandler('start', en_orden_por_chat(start)) )
 
 
 def resetear_ajustes_usuario(uid):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''DELETE FROM ajustes_usuario WHERE uid=%s''', (uid, ))
-    cursor.execute('''INSERT INTO ajustes_usuario(uid) values (%s)''', (uid, ))
-    conn.commit()
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''DELETE FROM ajustes_usuario WHERE uid=%s''', (uid, ))
+        cursor.execute('''INSERT INTO ajustes_usuario(uid) values (%s)''', (uid, ))
+        conn.commit()
+    olvidar_ajustes_sesion(uid)
 
 
 def iniciar_aplicacion(update, context):
@@ -331,16 +1061,15 @@ def ayuda(update, context):
                              parse_mode='HTML')
 
 
-dispatcher.add_handler(CommandHandler('ayuda', ayuda))
+dispatcher.add_handler(CommandHandler('ayuda', en_orden_por_chat(ayuda)))
 
 
 def ultimos_registros_bot(update, context):
     texto_respuesta = ''
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT lid, mensaje FROM log ORDER BY fecha DESC LIMIT 10''')
-    for (lid, mensaje) in cursor:
-        texto_respuesta += f'{lid}. 📜 {mensaje}\n'
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT lid, mensaje FROM log ORDER BY fecha DESC LIMIT 10''')
+        for (lid, mensaje) in cursor:
+            texto_respuesta += f'{lid}. 📜 {mensaje}\n'
     if texto_respuesta:
         texto_respuesta = 'Últimos registros del log:\n\n' + texto_respuesta
         context.bot.send_message(chat_id=update.effective_chat.id,
@@ -352,19 +1081,19 @@ def ultimos_registros_bot(update, context):
                              parse_mode='HTML')
 
 
-dispatcher.add_handler(CommandHandler('log', ultimos_registros_bot))
+dispatcher.add_handler(CommandHandler('log', en_orden_por_chat(ultimos_registros_bot)))
 
 
 def credito_usuarios(update, context):
     try:
         idchat = update.effective_chat.id
         if idchat in SUPER_ADMINS:
-            conn, cursor = inicializar_bd()
-            cursor.execute('''SELECT uid, nombre, credito FROM usuario WHERE credito > 0 ORDER BY credito DESC LIMIT 10''')
             texto_respuesta = ''
-            for (uid, nombre, credito) in cursor:
-                cup = credito / 80
-                texto_respuesta += f'{uid}. 👤{nombre} 💰{credito} = ${cup}\n'
+            with conexion_bd() as (conn, cursor):
+                cursor.execute('''SELECT uid, nombre, credito FROM usuario WHERE credito > 0 ORDER BY credito DESC LIMIT 10''')
+                for (uid, nombre, credito) in cursor:
+                    cup = credito / 80
+                    texto_respuesta += f'{uid}. 👤{nombre} 💰{credito} = ${cup}\n'
             if texto_respuesta:
                 texto_respuesta = '<b>Top 10 usuarios con crédito</b>\n\n' + texto_respuesta
                 context.bot.send_message(chat_id=idchat,
@@ -373,21 +1102,19 @@ def credito_usuarios(update, context):
             else:
                 context.bot.send_message(chat_id=idchat,
                                          text='Nadie con crédito disponible.')
-            conn.close()
     except Exception as ex:
         debug_print(f'credito_usuarios: {ex}', 'error')
 
 
-dispatcher.add_handler(CommandHandler('credito', credito_usuarios))
+dispatcher.add_handler(CommandHandler('credito', en_orden_por_chat(credito_usuarios)))
 
 
 def ultimas_subscripciones(update, context):
     texto_respuesta = ''
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT sid, criterio, nombre, frecuencia FROM subscripcion join usuario WHERE subscripcion.uid = usuario.uid  ORDER BY fecha DESC LIMIT 10''')
-    for (sid, criterio, nombre, frecuencia) in cursor:
-        texto_respuesta += f'{sid}. 📜{criterio} 👤{nombre} ⏰{frecuencia}\n'
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT sid, criterio, nombre, frecuencia FROM subscripcion join usuario WHERE subscripcion.uid = usuario.uid  ORDER BY fecha DESC LIMIT 10''')
+        for (sid, criterio, nombre, frecuencia) in cursor:
+            texto_respuesta += f'{sid}. 📜{criterio} 👤{nombre} ⏰{frecuencia}\n'
     if texto_respuesta:
         texto_respuesta = 'Últimas subscripciones:\n\n' + texto_respuesta
         context.bot.send_message(chat_id=update.effective_chat.id,
@@ -399,44 +1126,140 @@ def ultimas_subscripciones(update, context):
                              parse_mode='HTML')
 
 
-dispatcher.add_handler(CommandHandler('subs', ultimas_subscripciones))
+dispatcher.add_handler(CommandHandler('subs', en_orden_por_chat(ultimas_subscripciones)))
+
+
+# Muestra a los administradores los contadores internos del bot
+def estado_bot(update, context):
+    try:
+        idchat = update.effective_chat.id
+        if idchat in SUPER_ADMINS:
+            pool = estadisticas_pool_bd()
+            catalogo = estadisticas_catalogo()
+            log = estadisticas_log()
+            resultados = estadisticas_cache_resultados()
+            descargas = copiar_estadisticas(ESTADISTICAS_DESCARGAS)
+            parser = copiar_estadisticas(ESTADISTICAS_PARSER)
+            persistencia = estadisticas_persistencia()
+            escaneo = copiar_estadisticas(ESTADISTICAS_ESCANEO)
+            planificador = estadisticas_planificador()
+            huellas = copiar_estadisticas(ESTADISTICAS_HUELLAS)
+            salida = estadisticas_salida()
+            manejadores = estadisticas_manejadores()
+            indice = estadisticas_indice_productos()
+            rastreo = copiar_estadisticas(ESTADISTICAS_RASTREO)
+            menus = estadisticas_menus()
+            sesiones = estadisticas_sesiones()
+            limites = estadisticas_limites()
+            creditos = estadisticas_creditos()
+            criterios_contados = len(CONTEO_CRITERIOS)
+            retencion = copiar_estadisticas(ESTADISTICAS_RETENCION)
+            retenidas = copiar_estadisticas(FILAS_RETENIDAS)
+            fotos = estadisticas_disponibilidad()
+            proximo = f'{planificador["proximo"]:.0f} s' if planificador['proximo'] is not None else '-'
+            lineas = [
+                f'🗄 <b>Pool BD:</b> {pool["libres"]}/{pool["tamano"]} libres, {pool["creadas"]} creadas, '
+                f'{pool["reutilizadas"]} reutilizadas, {pool["esperas"]} esperas, {pool["fallidas"]} fallidas',
+                f'📚 <b>Catálogo:</b> {catalogo["aciertos"]} aciertos, {catalogo["fallos"]} fallos, '
+                f'{catalogo["recargas"]} recargas, edad {catalogo["edad"]} s',
+                f'📜 <b>Log:</b> {log["encolados"]} encolados, {log["escritos"]} escritos, '
+                f'{log["descartados"]} descartados, {log["pendientes"]} pendientes',
+                f'🔎 <b>Resultados:</b> {resultados["proporcion_aciertos"]:.0%} aciertos '
+                f'({resultados["aciertos_memoria"]} memoria, {resultados["aciertos_bd"]} BD, '
+                f'{resultados["fallos"]} fallos), '
+                f'{resultados["entradas"]} entradas, {resultados["expulsados"]} expulsadas',
+                f'🌐 <b>Descargas:</b> {descargas["realizadas"]} realizadas, {descargas["compartidas"]} compartidas',
+                f'🧩 <b>Parser:</b> {parser["lxml"]} lxml, {parser["bs4"]} BeautifulSoup, '
+                f'{parser["verificados"]} verificadas, {parser["diferencias"]} diferencias, '
+                f'{parser["errores"]} errores',
+                f'💾 <b>Persistencia:</b> {persistencia["lotes"]} búsquedas, {persistencia["filas"]} filas, '
+                f'{persistencia["filas_por_segundo"]:.0f} filas/s',
+                f'⏱ <b>Subscripciones:</b> {escaneo["ciclos"]} ciclos, {escaneo["grupos"]} grupos, '
+                f'{escaneo["busquedas"]} búsquedas, {escaneo["notificados"]} notificados, '
+                f'{escaneo["mensajes"]} mensajes, {escaneo["productos_notificados"]} productos notificados y '
+                f'{escaneo["productos_repetidos"]} repetidos omitidos, '
+                f'{escaneo["paginas_rastreadas"]} páginas de departamentos ({ESCANEO_MODO}), '
+                f'último ciclo {escaneo["ultimo_ciclo"]:.2f} s',
+                f'📅 <b>Planificador:</b> {planificador["subscripciones"]} subscripciones en '
+                f'{planificador["grupos"]} grupos, próximo escaneo en {proximo}',
+                f'🖐 <b>Huellas:</b> {huellas["no_modificadas"]} no modificadas (304), {huellas["iguales"]} iguales, '
+                f'{huellas["cambiadas"]} cambiadas, {huellas["escrituras_evitadas"]} escrituras y '
+                f'{huellas["notificaciones_evitadas"]} notificaciones evitadas',
+                f'📤 <b>Salida:</b> {salida["pendientes"]} pendientes, {salida["enviados"]} enviados, '
+                f'{salida["reintentos"]} reintentos, {salida["fallidos"]} fallidos, latencia media '
+                f'{salida["latencia_media"]:.1f} s (máxima {salida["latencia_maxima"]:.1f} s)',
+                f'⚙️ <b>Manejadores ({MODO_BOT}):</b> {manejadores["chats_en_curso"]} chats en curso, '
+                f'p50 {manejadores["p50"]:.2f} s, p99 {manejadores["p99"]:.2f} s',
+                f'📦 <b>Índice de productos:</b> {indice["productos"]} productos, {indice["palabras"]} palabras, '
+                f'{indice["consultas"]} consultas, {indice["ms_por_consulta"]:.2f} ms por consulta'
+                f'{"" if indice["cargado"] else " (cargando)"}',
+                f'🛒 <b>Rastreo del catálogo:</b> {len(fotos)} tiendas con foto, {rastreo["recorridos"]} recorridos, '
+                f'{rastreo["fallidas"]} tiendas fallidas, {rastreo["aciertos"]} búsquedas respondidas con la foto '
+                f'(detalle en /rastreo)',
+                f'🔰 <b>Menús:</b> {menus["tiendas"]} tiendas ({menus["vencidos"]} vencidos), '
+                f'{menus["aciertos"]} aciertos, '
+                f'{menus["cargados_bd"]} cargados de la BD, {menus["descargados"]} descargados, '
+                f'{menus["refrescos"]} refrescos en segundo plano, {menus["errores"]} errores',
+                f'👤 <b>Sesiones:</b> {sesiones["mensajes"]} mensajes, '
+                f'{sesiones["accesos_por_mensaje"]:.1f} accesos a la BD por mensaje',
+                f'🚦 <b>Límite de búsquedas:</b> {limites["usuarios"]} usuarios en la ventana, '
+                f'{limites["comprobaciones"]} comprobaciones, {limites["rechazadas"]} rechazadas',
+                f'💰 <b>Créditos:</b> {creditos["usuarios"]} saldos en memoria, {creditos["aciertos"]} aciertos, '
+                f'{creditos["lecturas_bd"]} lecturas de la BD, {creditos["debitos"]} débitos, '
+                f'{creditos["conciliaciones"]} conciliaciones con {creditos["diferencias"]} diferencias',
+                f'🔍 <b>Más buscados:</b> {criterios_contados} criterios contados'
+                f'{"" if MAS_BUSCADOS_CARGADO.is_set() else " (cargando)"}',
+                f'🧹 <b>Retención:</b> {retencion["ejecuciones"]} ejecuciones, {retenidas["busqueda"]} búsquedas, '
+                f'{retenidas["resultado"]} resultados y {retenidas["log"]} registros del log borrados '
+                f'({retencion["particiones"]} particiones), {retencion["archivadas"]} filas archivadas, '
+                f'~{retencion["bytes"] / 1048576:.1f} MB liberados, '
+                f'última ejecución {retencion["ultima_ejecucion"]:.1f} s',
+            ]
+            texto_respuesta = '<b>Estado del bot</b>\n\n' + '\n'.join(lineas)
+            context.bot.send_message(chat_id=idchat,
+                                     text=texto_respuesta,
+                                     parse_mode='HTML')
+    except Exception as ex:
+        debug_print(f'estado_bot: {ex}', 'error')
+
+
+dispatcher.add_handler(CommandHandler('estado', en_orden_por_chat(estado_bot)))
 
 
 def resetear_provincia_usuario(idchat, prov):
     try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''DELETE FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
-        cursor.execute('''INSERT INTO ajustes_usuario(uid, prov_id) values (%s, %s)''', (idchat, prov))
-        conn.commit()
-        conn.close()
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''DELETE FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
+            cursor.execute('''INSERT INTO ajustes_usuario(uid, prov_id) values (%s, %s)''', (idchat, prov))
+            conn.commit()
+        olvidar_ajustes_sesion(idchat)
     except Exception as ex:
         print('resetear_provincia_usuario', ex)
 
 
 def actualizar_categoria_seleccionada(idchat, cat):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT cid FROM categoria WHERE nombre=%s''', (cat, ))
-    cid = cursor.fetchone()[0]
-    cursor.execute('''UPDATE ajustes_usuario SET cid=%s WHERE uid=%s''', (cid, idchat))
-    conn.commit()
-    conn.close()
+    cid = buscar_en_catalogo('categorias', cat)
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''UPDATE ajustes_usuario SET cid=%s WHERE uid=%s''', (cid, idchat))
+        conn.commit()
+    olvidar_ajustes_sesion(idchat)
 
 
 def actualizar_departamento_seleccionado(idchat, dep):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''UPDATE ajustes_usuario SET did=%s WHERE uid=%s''', (dep, idchat))
-    conn.commit()
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''UPDATE ajustes_usuario SET did=%s WHERE uid=%s''', (dep, idchat))
+        conn.commit()
+    olvidar_ajustes_sesion(idchat)
 
 
 def enviar_registro_escaneos_subscripciones(update, context, idchat):
-    conn, cursor = inicializar_bd()
     cadena_busqueda = f'%búsqueda programada%{idchat}%'
-    cursor.execute('''SELECT lid, mensaje, fecha FROM log WHERE mensaje LIKE %s ORDER BY fecha desc limit 10''', (cadena_busqueda, ))
     texto_respuesta = ''
-    for (lid, mensaje, fecha) in cursor:
-        desde = timeago.format(fecha, datetime.datetime.now(), 'es')
-        texto_respuesta += f'{lid}. <i>{mensaje}</i> {desde}\n'
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT lid, mensaje, fecha FROM log WHERE mensaje LIKE %s ORDER BY fecha desc limit 10''', (cadena_busqueda, ))
+        for (lid, mensaje, fecha) in cursor:
+            desde = timeago.format(fecha, datetime.datetime.now(), 'es')
+            texto_respuesta += f'{lid}. <i>{mensaje}</i> {desde}\n'
     if texto_respuesta:
         texto_respuesta = 'Registros de escaneos recientes:\n\n' + texto_respuesta
         context.bot.send_message(text=texto_respuesta,
@@ -446,28 +1269,23 @@ def enviar_registro_escaneos_subscripciones(update, context, idchat):
         context.bot.send_message(text='Aún no hay registros de escaneo de subscripciones.',
                                  chat_id=idchat,
                                  parse_mode='HTML')                
-    conn.close()
 
 
 def formatear_frecuencia(frecuencia):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT texto FROM frecuencia_escaneo WHERE frecuencia = %s''', (frecuencia, ))
-    texto_frec = cursor.fetchone()[0]
-    conn.close()
+    texto_frec = buscar_en_catalogo('frecuencias', int(frecuencia))
     return f'cada ⏰ {texto_frec}'
 
 
 def enviar_subscripciones_procesadas(update, context):
     try:
         idchat = update.effective_chat.id
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT max(sid) as sid, criterio, prov_id, max(ultimo_escaneo) as ultimo \
-                        FROM subscripcion where uid=%s group by criterio, prov_id \
-                        order by ultimo desc limit 10''', (idchat, ))
         texto_respuesta = ''
-        for (sid, criterio, prov_id, ultimo_esc) in cursor:
-            texto_respuesta += f'{sid}. <i>{criterio}</i> [{prov_id}] /activar_{sid}\n'
-        conn.close()
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT max(sid) as sid, criterio, prov_id, max(ultimo_escaneo) as ultimo \
+                            FROM subscripcion where uid=%s group by criterio, prov_id \
+                            order by ultimo desc limit 10''', (idchat, ))
+            for (sid, criterio, prov_id, ultimo_esc) in cursor:
+                texto_respuesta += f'{sid}. <i>{criterio}</i> [{prov_id}] /activar_{sid}\n'
         if texto_respuesta:
             texto_respuesta = '<b>Historial de subscripciones procesadas:</b>\n\n' + texto_respuesta        
             context.bot.send_message(text=texto_respuesta,
@@ -536,10 +1354,10 @@ def manejador_teclados_inline(update, context):
             else:
                 context.bot.send_message(chat_id=idchat, 
                                      text=f'🎩 Bot en mantenimiento. Gracias por su apoyo.')
+        # Provincias, categorías y departamentos se resuelven en el catálogo en memoria
         elif es_id_de_provincia(query.data):
             try:
                 prov = query.data
-                provincia = obtener_nombre_provincia(prov)
                 resetear_provincia_usuario(idchat, prov)
                 texto_respuesta = mensaje_seleccion_provincia(prov)
                 context.bot.edit_message_text(text=texto_respuesta,
@@ -564,7 +1382,7 @@ def manejador_teclados_inline(update, context):
         print('manejador_teclados_inline:', ex)
 
 
-dispatcher.add_handler(CallbackQueryHandler(manejador_teclados_inline))
+dispatcher.add_handler(CallbackQueryHandler(en_orden_por_chat(manejador_teclados_inline)))
 
 
 # Definicion del comando /prov
@@ -573,20 +1391,16 @@ def prov(update, context):
     generar_teclado_provincias(update, context)
 
 
-dispatcher.add_handler(CommandHandler('prov', prov))
+dispatcher.add_handler(CommandHandler('prov', en_orden_por_chat(prov)))
 
 
 def generar_teclado_provincias(update, context):
     try:
         botones_provincias = []
-        conn, cursor = inicializar_bd()
-        cursor.execute('SELECT prov_id, nombre FROM provincia')
-        for (prov_id, nombre) in cursor:
+        for prov_id, nombre in obtener_catalogo()['provincias'].items():
             logo = obtener_logo_provincia(prov_id)
             botones_provincias.append(InlineKeyboardButton(f'{logo} {nombre}', callback_data=prov_id))
 
-        conn.close()
-
         teclado = construir_menu(botones_provincias, n_cols=3)
 
         reply_markup = InlineKeyboardMarkup(teclado)
@@ -602,7 +1416,7 @@ def generar_teclado_provincias(update, context):
 def dptos(update, context):
     generar_teclado_departamentos(update, context)
 
-dispatcher.add_handler(CommandHandler('dptos', dptos))
+dispatcher.add_handler(CommandHandler('dptos', en_orden_por_chat(dptos)))
 
 
 # Generar el teclado con las categorías
@@ -610,22 +1424,22 @@ def generar_teclado_categorias(update, context, nuevo=False):
     try:
         botones = []
         idchat = update.effective_chat.id
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT tid FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
-        result = cursor.fetchone()
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT tid, cat_kb_message_id FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
+            result = cursor.fetchone()
+            if result:
+                tid = result[0]
+                cat_kb_message_id = result[1]
         if result:
-            tid = result[0]
-            nombre_tienda = obtener_nombre_tienda(tid)
-            cursor.execute('''SELECT nombre FROM tienda_categoria JOIN categoria WHERE tienda_categoria.cid=categoria.cid and tid=%s''', (tid,))
-            for (cat, ) in cursor:
+            for cat in obtener_menu_tienda(tid):
                 botones.append(InlineKeyboardButton(cat, callback_data=cat))
+            nombre_tienda = obtener_nombre_tienda(tid)
 
             if botones:
                 teclado = construir_menu( botones, n_cols=2 )
                 reply_markup = InlineKeyboardMarkup(teclado)
                 texto_respuesta = f'Categorías disponibles en 🏬 <b>{nombre_tienda}</b>'
-                cursor.execute('''SELECT cat_kb_message_id FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
-                result = cursor.fetchone()[0]
+                result = cat_kb_message_id
                 if result and not nuevo:
                     context.bot.edit_message_text(chat_id=idchat,
                                                   text=texto_respuesta,
@@ -638,8 +1452,10 @@ def generar_teclado_categorias(update, context, nuevo=False):
                                                        reply_markup=reply_markup,
                                                        parse_mode='HTML')
                     # Se almacena el id del mensaje enviado para editarlo despues
-                    cursor.execute('''UPDATE ajustes_usuario SET cat_kb_message_id=%s WHERE uid=%s''', (message.message_id, idchat))
-                    conn.commit()
+                    with conexion_bd() as (conn, cursor):
+                        cursor.execute('''UPDATE ajustes_usuario SET cat_kb_message_id=%s WHERE uid=%s''', (message.message_id, idchat))
+                        conn.commit()
+                    olvidar_ajustes_sesion(idchat)
             else:
                 message = context.bot.send_message(chat_id=idchat,
                                          text=f'⛔️ No se encontraron categorías en <b>{nombre_tienda}</b>. <b>¿Quizás está offline?</b>',
@@ -648,7 +1464,6 @@ def generar_teclado_categorias(update, context, nuevo=False):
             message = context.bot.send_message(chat_id=idchat,
                                          text=f'⛔️ Debe seleccionar una tienda antes de consultar las categorías.',
                                          parse_mode='HTML')
-        conn.close()
     except Exception as ex:
         print('generar_teclado_categorias:', ex)
 
@@ -658,24 +1473,24 @@ def cat(update, context):
     parsear_menu_departamentos(update.effective_chat.id)
     generar_teclado_categorias(update, context, nuevo=True)
 
-dispatcher.add_handler(CommandHandler('cat', cat))
+dispatcher.add_handler(CommandHandler('cat', en_orden_por_chat(cat)))
 
 
 # Generar el teclado con los departamentos
 def generar_teclado_departamentos(update, context):
     botones = []
     idchat = update.effective_chat.id
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT cid, tid FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
-    result = cursor.fetchone()
-    cid = result[0]
-    tid = result[1]
-    cursor.execute('''SELECT did, nombre FROM departamento WHERE cid=%s''', (cid, ))
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT cid, tid, cat_kb_message_id FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
+        result = cursor.fetchone()
+        cid = result[0]
+        tid = result[1]
+        cat_kb_message_id = result[2]
+        cursor.execute('''SELECT did, nombre FROM departamento WHERE cid=%s''', (cid, ))
+        for (did, nombre) in cursor:
+            botones.append(InlineKeyboardButton(nombre, callback_data=did))
 
     texto_respuesta = 'Seleccione un departamento para ver los productos disponibles.'
-    
-    for (did, nombre) in cursor:
-        botones.append(InlineKeyboardButton(nombre, callback_data=did))
 
     teclado = construir_menu( botones, n_cols=2)
     teclado.append( [InlineKeyboardButton('👈 Atrás', callback_data='cat_atras')] )
@@ -683,12 +1498,10 @@ def generar_teclado_departamentos(update, context):
     reply_markup = InlineKeyboardMarkup(teclado)
 
     # Reemplazar el teclado
-    cursor.execute('''SELECT cat_kb_message_id FROM ajustes_usuario WHERE uid=%s''', (idchat, ))
-    result = cursor.fetchone()
-    if result[0]:
+    if cat_kb_message_id:
         context.bot.edit_message_text(chat_id=idchat, 
                                  text=texto_respuesta,
-                                 message_id=result[0],                            
+                                 message_id=cat_kb_message_id,                            
                                  reply_markup=reply_markup)
     elif tid and cid:
         context.bot.send_message(chat_id=idchat, 
@@ -697,7 +1510,6 @@ def generar_teclado_departamentos(update, context):
     else:
         context.bot.send_message(chat_id=idchat, 
                                  text='⛔️ Debe seleccionar una tienda y una categoría antes de mostrar los departamentos.')
-    conn.close()
 
 
 
@@ -726,20 +1538,22 @@ def generar_teclado_opciones_subscripcion(update, context):
 
 
 def subscripciones_activas(idchat):
-    conn, cursor = inicializar_bd()
     subs = []
-    cursor.execute('''SELECT criterio, fecha, prov_id, sid, frecuencia FROM subscripcion WHERE uid=%s and estado=%s''', (idchat, 'activa'))
-    for (criterio, fecha, prov_id, sid, frecuencia) in cursor:
-        subs.append( (criterio, fecha, prov_id, sid, frecuencia) )
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT criterio, fecha, prov_id, sid, frecuencia FROM subscripcion WHERE uid=%s and estado=%s''', (idchat, 'activa'))
+        for (criterio, fecha, prov_id, sid, frecuencia) in cursor:
+            subs.append( (criterio, fecha, prov_id, sid, frecuencia) )
     return subs
 
 
 def eliminar_subscripciones_activas(idchat):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''DELETE FROM subscripcion WHERE uid=%s and estado=%s''', (idchat, 'activa'))
-    conn.commit()
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''DELETE subscripcion_vistos FROM subscripcion_vistos JOIN subscripcion \
+                          ON subscripcion.sid = subscripcion_vistos.sid WHERE uid=%s and estado=%s''',
+                       (idchat, 'activa'))
+        cursor.execute('''DELETE FROM subscripcion WHERE uid=%s and estado=%s''', (idchat, 'activa'))
+        conn.commit()
+    desprogramar_subscripciones_usuario(idchat)
 
 
 # Definicion del comando sub
@@ -788,16 +1602,47 @@ def sub(update, context):
                                      parse_mode='HTML')
 
 
-dispatcher.add_handler(CommandHandler('sub', sub))
+dispatcher.add_handler(CommandHandler('sub', en_orden_por_chat(sub)))
+
+
+# Comandos que terminan con un ID (/credito_<uid>, /subscribirse_a_<pid>, /eliminar_sub_<sid>, ...)
+# En lugar de registrar un CommandHandler por cada ID se guarda una función por prefijo
+# y un único manejador la busca a partir del texto del comando.
+COMANDOS_CON_ID = {}
+
+
+def registrar_comando_con_id(prefijo, funcion):
+    COMANDOS_CON_ID[prefijo] = funcion
+
+
+# Retorna (prefijo, id) si el texto es un comando con ID registrado, si no None
+def separar_comando_con_id(texto):
+    comando = texto.split()[0][1:].split('@')[0] if texto else ''
+    prefijo, separador, id_ = comando.rpartition('_')
+    prefijo = f'{prefijo}{separador}'
+    if id_ and prefijo in COMANDOS_CON_ID:
+        return prefijo, id_
+    return None
+
+
+def enrutar_comando_con_id(update, context):
+    comando = separar_comando_con_id(update.message.text)
+    if comando:
+        prefijo, id_ = comando
+        COMANDOS_CON_ID[prefijo](update, context)
+
+
+dispatcher.add_handler(MessageHandler(Filters.command, en_orden_por_chat(enrutar_comando_con_id)), 1)
 
 
 def eliminar_subscripcion_unica(update, context):
     try:
-        conn, cursor = inicializar_bd()
         sid = update.message.text.split('_')[-1]
-        cursor.execute('''DELETE FROM subscripcion WHERE sid=%s''', (sid, ))
-        conn.commit()
-        conn.close()
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''DELETE FROM subscripcion_vistos WHERE sid=%s''', (sid, ))
+            cursor.execute('''DELETE FROM subscripcion WHERE sid=%s''', (sid, ))
+            conn.commit()
+        desprogramar_subscripciones([int(sid)])
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=f'⚠️ ¡Subscripción eliminada correctamente! Envíe <b>/sub</b> para ver sus subscripciones activas.',
                                  parse_mode='HTML')
@@ -805,6 +1650,9 @@ def eliminar_subscripcion_unica(update, context):
         print('eliminar_subscripcion_unica:', ex)
 
 
+registrar_comando_con_id('eliminar_sub_', eliminar_subscripcion_unica)
+
+
 
 def cambiar_frecuencia_subscripcion(update, context):
     try:
@@ -815,52 +1663,27 @@ def cambiar_frecuencia_subscripcion(update, context):
         print('cambiar_frecuencia_subscripcion:', ex)
 
 
-# Retorna una lista con las subscripciones en un estado dado
-def obtener_subscripciones_segun_estado(estado):
-    try:
-        conn, cursor = inicializar_bd()
-        subscripciones = []
-        cursor.execute('''SELECT sid FROM subscripcion WHERE estado=%s''', (estado, ))
-        for (sid, ) in cursor:
-            subscripciones.append(sid)
-        conn.close()
-        return subscripciones
-    except Exception as ex:
-        print('obtener_subscripciones_segun_estado:', ex)
+registrar_comando_con_id('cambiar_frec_', cambiar_frecuencia_subscripcion)
 
 
 def activar_subscripcion_procesada(update, context):
     sid = update.message.text.split('_')[-1]
-    conn, cursor = inicializar_bd()
-    cursor.execute('''UPDATE subscripcion SET estado=%s WHERE sid=%s''', ('activa', sid))
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''UPDATE subscripcion SET estado=%s WHERE sid=%s''', ('activa', sid))
+        conn.commit()
+    cargar_subscripciones_programadas(sid)
     context.bot.send_message(text='Subscripción activada con éxito. Pulse /sub para chequear sus subscripciones.',
                              chat_id=update.effective_chat.id)
-    dispatcher.add_handler(CommandHandler(f'cambiar_frec_{sid}', cambiar_frecuencia_subscripcion), 1)
-    dispatcher.add_handler(CommandHandler(f'eliminar_sub_{sid}', eliminar_subscripcion_unica), 1)
-    conn.commit()
-    conn.close() 
 
 
-def cargar_comandos_subscripcion():
-    try:        
-        for sid in obtener_subscripciones_segun_estado('activa'):
-            dispatcher.add_handler(CommandHandler(f'eliminar_sub_{sid}', eliminar_subscripcion_unica), 1)
-            dispatcher.add_handler(CommandHandler(f'cambiar_frec_{sid}', cambiar_frecuencia_subscripcion), 1)
-        for sid in obtener_subscripciones_segun_estado('procesada'):
-            dispatcher.add_handler(CommandHandler(f'activar_{sid}', activar_subscripcion_procesada), 1)
-    except Exception as ex:
-        print('cargar_comandos_subscripcion:', ex)
-
-
-cargar_comandos_subscripcion()
+registrar_comando_con_id('activar_', activar_subscripcion_procesada)
 
 
 def es_admin(uid):
     try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT tipo FROM usuario WHERE uid=%s''', ('uid', ))
-        result = cursor.fetchone()
-        conn.close()
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT tipo FROM usuario WHERE uid=%s''', ('uid', ))
+            result = cursor.fetchone()
         if result:
             if result[0]:
                 return result[0] == 'admin'
@@ -873,7 +1696,8 @@ def consultar_credito_usuario(update, context):
     try:
         idchat = update.effective_chat.id
         #es_admin(idchat)
-        uid = update.message.text.split('_')[-1]
+        # Los saldos en memoria se guardan con el uid numérico
+        uid = int(update.message.text.split('_')[-1])
         credito = obtener_credito_usuario(uid)
         context.bot.send_message(chat_id=update.effective_chat.id, 
                                  text=f'El monto del usuario con id: <b>{uid}</b> es de <b>{credito} TEF</b>.',
@@ -882,57 +1706,132 @@ def consultar_credito_usuario(update, context):
         debug_print('consultar_credito_usuario', ex)
 
 
-def cargar_comandos_credito():
-    try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT uid FROM usuario''')
-        for (uid, ) in cursor:
-            dispatcher.add_handler(CommandHandler(f'credito_{uid}', consultar_credito_usuario), 1)
-        conn.close()
-    except Exception as ex:
-        print('cargar_comandos_credito:', ex)
-
-cargar_comandos_credito()
+registrar_comando_con_id('credito_', consultar_credito_usuario)
 
 
 
 def desactivar_notificacion(uid, criterio, prov_id):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''UPDATE subscripcion SET estado=%s WHERE uid=%s and criterio=%s and prov_id=%s''',
-                     ('procesada', uid, criterio, prov_id))
-    sid = cursor.lastrowid
-    dispatcher.add_handler(CommandHandler(f'activar_{sid}', activar_subscripcion_procesada), 1)
-    conn.commit()
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''UPDATE subscripcion SET estado=%s WHERE uid=%s and criterio=%s and prov_id=%s''',
+                         ('procesada', uid, criterio, prov_id))
+        conn.commit()
+    desprogramar_subscripciones_usuario(uid, criterio, prov_id)
+
+
+# Saldos de crédito
+# El crédito de los usuarios se guarda en memoria al leerlo o modificarlo en la BD. Los
+# débitos se hacen con un solo UPDATE que deja el saldo nuevo en una variable de la
+# conexión, así no hace falta volver a leer la fila para saber si se agotó. Cada
+# CREDITO_CONCILIACION segundos se comparan los saldos en memoria con los de la BD.
+LOCK_CREDITOS = threading.Lock()
+CREDITOS = {}
+ESTADISTICAS_CREDITOS = {
+    'aciertos': 0,
+    'lecturas_bd': 0,
+    'debitos': 0,
+    'conciliaciones': 0,
+    'diferencias': 0,
+}
+
+
+def guardar_credito_en_cache(uid, credito):
+    with LOCK_CREDITOS:
+        CREDITOS[uid] = credito or 0
+
+
+# El próximo acceso al crédito del usuario lo lee de la BD
+def olvidar_credito_usuario(uid):
+    with LOCK_CREDITOS:
+        CREDITOS.pop(uid, None)
+
+
+# Descuenta montos (lista de débitos) del crédito del usuario en una transacción, con
+# una fila de operacion_credito por débito. Retorna el saldo nuevo, o None si el usuario
+# ya no tenía crédito y no se debitó nada.
+def debitar_credito(uid, montos, descripcion='Deducción por búsqueda', ahora=None):
+    ahora = ahora or datetime.datetime.now()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SET @saldo := NULL''')
+        cursor.execute('''UPDATE usuario SET credito = (@saldo := GREATEST(credito - %s, 0)) \
+                          WHERE uid = %s and credito > 0''', (sum(montos), uid))
+        if cursor.rowcount == 0:
+            # Sin crédito (o sin usuario) no hay nada que registrar en operacion_credito
+            saldo = None
+        else:
+            cursor.executemany('''INSERT INTO operacion_credito(uid, descripcion, tipo, monto, fecha) VALUES(%s, %s, %s, %s, %s)''',
+                               [ (uid, descripcion, 'débito', monto, ahora) for monto in montos ])
+            cursor.execute('''SELECT @saldo''')
+            saldo = cursor.fetchone()[0]
+            conn.commit()
+    if saldo is None:
+        guardar_credito_en_cache(uid, 0)
+        return None
+    contar_estadistica(ESTADISTICAS_CREDITOS, 'debitos')
+    guardar_credito_en_cache(uid, saldo)
+    return saldo
 
 
 def obtener_credito_usuario(idchat):
-    try:        
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT credito FROM usuario WHERE uid=%s''', (idchat, ))
-        result = cursor.fetchone()
-        conn.close()        
+    try:
+        sesion = sesion_actual(idchat)
+        if sesion:
+            return sesion['credito']
+        with LOCK_CREDITOS:
+            if idchat in CREDITOS:
+                contar_estadistica(ESTADISTICAS_CREDITOS, 'aciertos')
+                return CREDITOS[idchat]
+        contar_estadistica(ESTADISTICAS_CREDITOS, 'lecturas_bd')
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT credito FROM usuario WHERE uid=%s''', (idchat, ))
+            result = cursor.fetchone()
+        credito = result[0] if result and result[0] else 0
         if result:
-            if result[0]:
-                return result[0]
-        return 0
+            guardar_credito_en_cache(idchat, credito)
+        return credito
     except Exception as ex:
         print('obtener_credito_usuario:', ex)
 
 
+# Compara los saldos en memoria con los de la BD, por si se modificaron por fuera del bot
+def conciliar_creditos(context):
+    try:
+        with LOCK_CREDITOS:
+            uids = list(CREDITOS)
+        for i in range(0, len(uids), 500):
+            lote = uids[i:i + 500]
+            marcadores = ', '.join(['%s'] * len(lote))
+            with conexion_bd() as (conn, cursor):
+                cursor.execute(f'''SELECT uid, credito FROM usuario WHERE uid IN ({marcadores})''', tuple(lote))
+                saldos = { uid: credito or 0 for uid, credito in cursor }
+            with LOCK_CREDITOS:
+                for uid in lote:
+                    if uid not in saldos:
+                        CREDITOS.pop(uid, None)
+                    elif uid in CREDITOS and CREDITOS[uid] != saldos[uid]:
+                        CREDITOS[uid] = saldos[uid]
+                        contar_estadistica(ESTADISTICAS_CREDITOS, 'diferencias')
+        contar_estadistica(ESTADISTICAS_CREDITOS, 'conciliaciones')
+    except Exception as ex:
+        debug_print(f'conciliar_creditos: {ex}', 'error')
+
+
+def estadisticas_creditos():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_CREDITOS)
+    estadisticas['usuarios'] = len(CREDITOS)
+    return estadisticas
+
+
 def registrar_subscripcion(idchat, prov_id, palabras, frec):
     try:
         subs_act = subscripciones_activas(idchat)
         if len(subs_act) < int(obtener_ajuste_bot('max_subscripciones_permitidas')) or obtener_credito_usuario(idchat) > 0:
-            conn, cursor = inicializar_bd()
             ahora = datetime.datetime.now()
-            cursor.execute('''INSERT INTO subscripcion(uid, criterio, fecha, prov_id, frecuencia, ultimo_escaneo) VALUES(%s, %s, %s, %s, %s, %s)''', 
-                            (idchat, palabras, ahora, prov_id, frec, ahora))
-            sid = cursor.lastrowid
-            dispatcher.add_handler(CommandHandler(f'eliminar_sub_{sid}', eliminar_subscripcion_unica), 1)
-            dispatcher.add_handler(CommandHandler(f'cambiar_frec_{sid}', cambiar_frecuencia_subscripcion), 1)            
-            conn.commit()
-            conn.close()
+            with conexion_bd() as (conn, cursor):
+                cursor.execute('''INSERT INTO subscripcion(uid, criterio, fecha, prov_id, frecuencia, ultimo_escaneo) VALUES(%s, %s, %s, %s, %s, %s)''', 
+                                (idchat, palabras, ahora, prov_id, frec, ahora))
+                sid = cursor.lastrowid
+                conn.commit()
+            programar_subscripcion(sid, idchat, palabras, prov_id, ahora, frec, ahora)
             return True
         else:
             return False
@@ -944,12 +1843,9 @@ def registrar_subscripcion(idchat, prov_id, palabras, frec):
 def generar_teclado_provincias_subscripcion(update, context, pid):
     try:
         botones_provincias = []
-        conn, cursor = inicializar_bd()
-        cursor.execute('SELECT prov_id, nombre FROM provincia')
-        for (prov_id, nombre) in cursor:
+        for prov_id in obtener_catalogo()['provincias']:
             logo = obtener_logo_provincia(prov_id)
             botones_provincias.append(InlineKeyboardButton(f'{logo} {prov_id}', callback_data=f'sub-prod:{prov_id}<-->{pid}'))
-        conn.close()
 
 
 
@@ -970,16 +1866,9 @@ def sub_a(update, context):
     except Exception as ex:
         print('sub_a:', ex)
 
-       
-def cargar_comandos_subscripcion_a_producto():
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT pid FROM producto''')
-    for (pid, ) in cursor:
-        dispatcher.add_handler(CommandHandler(f'subscribirse_a_{pid}', sub_a), 1)
-    conn.close()    
 
-cargar_comandos_subscripcion_a_producto()         
-    
+registrar_comando_con_id('subscribirse_a_', sub_a)
+
 
 # Generar masivamente los comandos de selección de provincia
 # TODO: Responder cuando se pasa como argumento el producto
@@ -1002,24 +1891,19 @@ def seleccionar_provincia(update, context):
 
 
 for prov in obtener_ids_provincias():
-    dispatcher.add_handler(CommandHandler(prov, seleccionar_provincia))
+    dispatcher.add_handler(CommandHandler(prov, en_orden_por_chat(seleccionar_provincia)))
 
 
 def obtener_tienda_a_partir_de_comando(comando):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT tid FROM comandos_tienda WHERE comando=%s''', (comando, ))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0]  
+    return buscar_en_catalogo('comandos_tienda', comando)
 
 
 def usuarios_vip():
     u_perm = []
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT uid FROM usuario WHERE tipo = %s''', ('vip', ))
-    for (uid, ) in cursor:
-        u_perm.append(uid)
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT uid FROM usuario WHERE tipo = %s''', ('vip', ))
+        for (uid, ) in cursor:
+            u_perm.append(uid)
     return u_perm
 
 
@@ -1030,57 +1914,56 @@ def acreditar_usuario(update, context):
             context.bot.send_message(chat_id=idchat, text='Error, número incorrecto de parámetros')
         else:
             try:
-                conn, cursor = inicializar_bd()
                 uid = context.args[0]
                 monto = context.args[1]
                 ahora = datetime.datetime.now()
-                cursor.execute('''UPDATE usuario SET credito = credito + %s WHERE uid=%s''', (monto, uid))
-                cursor.execute('''INSERT INTO operacion_credito(uid, descripcion, tipo, monto, fecha) VALUES(%s, %s, %s, %s, %s)''',
-                              (idchat, 'Recarga', 'crédito', monto, ahora))
-                conn.commit()
-                conn.close()
+                with conexion_bd() as (conn, cursor):
+                    cursor.execute('''UPDATE usuario SET credito = credito + %s WHERE uid=%s''', (monto, uid))
+                    cursor.execute('''INSERT INTO operacion_credito(uid, descripcion, tipo, monto, fecha) VALUES(%s, %s, %s, %s, %s)''',
+                                  (idchat, 'Recarga', 'crédito', monto, ahora))
+                    conn.commit()
+                olvidar_credito_usuario(int(uid))
                 context.bot.send_message(chat_id=idchat, 
                                          text=f'Monto acreditado correctamente, pulse /credito_{uid} para consultar el saldo del usuario acreditado.')
                 # Notificar al usuario que recibe la acreditación
                 context.bot.send_message(chat_id=uid, 
                                          text=f'Se han acreditado {monto} TEF a su cuenta de usuario. Consulte {BOTONES["INFO"]} para conocer su crédito.')
                 debug_print(f'Acreditados {monto} TEF a la cuenta de usuario {uid}')
-                dispatcher.add_handler(CommandHandler(f'credito_{uid}', consultar_credito_usuario), 1)
+                reactivar_subscripciones_usuario(uid)
             except Exception as ex:
                 debug_print(f'acreditar_usuario: {ex}', 'error')                      
 
 
-dispatcher.add_handler(CommandHandler('acreditar', acreditar_usuario))
+dispatcher.add_handler(CommandHandler('acreditar', en_orden_por_chat(acreditar_usuario)))
 
 
 def solicitar_credito(update, context):
     try:
         idchat = update.effective_chat.id
-        context.bot.send_message(chat_id=idchat, 
-                                 text=f'Se ha enviado una solicitud de depósito de crédito, en breve será atendido.')
+        enviar_mensaje(idchat, 'Se ha enviado una solicitud de depósito de crédito, en breve será atendido.',
+                       PRIORIDAD_RESPUESTA)
         for admin in SUPER_ADMINS:
-            context.bot.send_message(chat_id=admin, 
-                                     text=f'El usuario {idchat} ha solicitado un depósito de crédito.')
+            enviar_mensaje(admin, f'El usuario {idchat} ha solicitado un depósito de crédito.')
     except Exception as ex:
         debug_print(f'solicitar_credito: {ex}', 'error') 
 
 
-dispatcher.add_handler(CommandHandler('solicitar_credito', solicitar_credito))
+dispatcher.add_handler(CommandHandler('solicitar_credito', en_orden_por_chat(solicitar_credito)))
 
 
 def seleccionar_categorias_tienda(update, context):
     idchat = update.effective_chat.id
     try:
         if obtener_credito_usuario(idchat):
-            conn, cursor = inicializar_bd()
             comando = update.message.text.split('/')[1]
             tid = obtener_tienda_a_partir_de_comando(comando)        
-            cursor.execute('''UPDATE ajustes_usuario SET tid=%s WHERE uid=%s''', (tid, idchat))
-            conn.commit()
+            with conexion_bd() as (conn, cursor):
+                cursor.execute('''UPDATE ajustes_usuario SET tid=%s WHERE uid=%s''', (tid, idchat))
+                conn.commit()
+            olvidar_ajustes_sesion(idchat)
             nombre_tienda = obtener_nombre_tienda(tid)
             texto_respuesta = f'Espere mientras se obtienen las categorías para: 🏬 <b>{nombre_tienda}</b>'    
             context.bot.send_message(chat_id=idchat, text=texto_respuesta, parse_mode='HTML')
-            conn.close()
             parsear_menu_departamentos(idchat)
             generar_teclado_categorias(update, context, nuevo=True)
         else:
@@ -1092,16 +1975,18 @@ def seleccionar_categorias_tienda(update, context):
 
 
 def actualizar_comandos_tienda(dispatcher):
-    conn, cursor = inicializar_bd()
-    for tid in obtener_todas_las_tiendas():
-        comando = f'ver_categorias_{tid}'.replace('-', '_')
-        cursor.execute('''SELECT * FROM comandos_tienda WHERE tid=%s''', (tid, ))
-        result = cursor.fetchall()
-        if not result:
-            cursor.execute('''INSERT INTO comandos_tienda(tid, comando) VALUES(%s, %s)''', (tid, comando))
-            conn.commit()  
-        dispatcher.add_handler(CommandHandler(comando, seleccionar_categorias_tienda))
-    cursor.close()
+    tiendas_con_comando = set(obtener_catalogo()['comandos_tienda'].values())
+    nuevos = False
+    with conexion_bd() as (conn, cursor):
+        for tid in obtener_todas_las_tiendas():
+            comando = f'ver_categorias_{tid}'.replace('-', '_')
+            if tid not in tiendas_con_comando:
+                cursor.execute('''INSERT INTO comandos_tienda(tid, comando) VALUES(%s, %s)''', (tid, comando))
+                conn.commit()  
+                nuevos = True
+            dispatcher.add_handler(CommandHandler(comando, en_orden_por_chat(seleccionar_categorias_tienda)))
+    if nuevos:
+        invalidar_catalogo()
 
 actualizar_comandos_tienda(dispatcher)
 
@@ -1162,41 +2047,178 @@ def mostrar_subscripciones(update, context):
                              parse_mode='HTML')
 
 
-# Definir una funcion para cada tipo de elemento a parsear
-def parsear_productos(soup, url_base):
+# Si lxml da un resultado distinto al de BeautifulSoup se desactiva para ese tipo de página
+PARSER_RAPIDO_ACTIVO = {tipo: LXML_DISPONIBLE and PARSER_HTML == 'lxml' for tipo in PARSERS}
+ESTADISTICAS_PARSER = {
+    'lxml': 0,
+    'bs4': 0,
+    'verificados': 0,
+    'diferencias': 0,
+    'errores': 0,
+}
+
+
+def parsear_pagina(tipo, data, *args):
+    rapido, referencia = PARSERS[tipo]
+    if not PARSER_RAPIDO_ACTIVO[tipo]:
+        contar_estadistica(ESTADISTICAS_PARSER, 'bs4')
+        return referencia(data, *args)
+
     try:
-        productos = []
-        thumb_setting = soup.select('div.thumbSetting')             
-        for child in thumb_setting:
-            producto = child.select('div.thumbTitle a')[0].contents[0]
-            phref = child.select('div.thumbTitle a')[0]['href']
-            pid = phref.split('&')[0].split('=')[1]
-            plink = f'{url_base}/{phref}'
-            precio = child.select('div.thumbPrice span')[0].contents[0]
-            productos.append( (producto, precio, plink, pid) )
-        return productos
+        resultado = rapido(data, *args)
     except Exception as ex:
-        print('parsear_productos', ex)    
+        # Página que lxml no sabe tratar igual que BeautifulSoup, se usa el parser de referencia
+        debug_print(f'parsear_pagina ({tipo}) con lxml: {ex}', 'error')
+        contar_estadistica(ESTADISTICAS_PARSER, 'errores')
+        contar_estadistica(ESTADISTICAS_PARSER, 'bs4')
+        return referencia(data, *args)
+
+    n = contar_estadistica(ESTADISTICAS_PARSER, 'lxml')
+    if PARSER_VERIFICAR > 0 and (n - 1) % PARSER_VERIFICAR == 0:
+        contar_estadistica(ESTADISTICAS_PARSER, 'verificados')
+        esperado = referencia(data, *args)
+        if resultado != esperado:
+            PARSER_RAPIDO_ACTIVO[tipo] = False
+            contar_estadistica(ESTADISTICAS_PARSER, 'diferencias')
+            debug_print(f'parsear_pagina: lxml difiere de BeautifulSoup en {tipo}, se usará BeautifulSoup', 'error')
+            return esperado
+    return resultado
+
+
+# Huellas de las páginas de productos ya visitadas
+# Por cada url se guardan el ETag y Last-Modified que envió el servidor, un hash del
+# fragmento de la página con el listado de productos y los productos que se obtuvieron.
+# Si el servidor responde 304 o el fragmento no cambió no se vuelve a parsear la página.
+# También se guarda el bid con el que se registraron esos productos en la BD, para no
+# volver a escribirlos mientras la página siga igual.
+LOCK_HUELLAS = threading.Lock()
+HUELLAS_PAGINAS = OrderedDict()
+ESTADISTICAS_HUELLAS = {
+    'no_modificadas': 0,
+    'iguales': 0,
+    'cambiadas': 0,
+    'escrituras_evitadas': 0,
+    'notificaciones_evitadas': 0,
+}
 
 
-def registrar_producto(**kargs):
-    try:
-        nombre = kargs['nombre']    
-        precio = kargs['precio']    
-        enlace = kargs['enlace']    
-        pid = kargs['pid']    
-        did = kargs['did']
+# Parte de la página que va desde el primer producto hasta el precio del último
+def fragmento_productos(data):
+    inicio = data.find('thumbSetting')
+    if inicio == -1:
+        return ''
+    fin = data.find('</div>', data.rfind('thumbPrice'))
+    return data[inicio:fin] if fin != -1 else data[inicio:]
+
+
+def obtener_huella(url):
+    with LOCK_HUELLAS:
+        huella = HUELLAS_PAGINAS.get(url)
+        if huella:
+            HUELLAS_PAGINAS.move_to_end(url)
+            return dict(huella)
+
+
+def guardar_huella(url, **valores):
+    with LOCK_HUELLAS:
+        huella = HUELLAS_PAGINAS.setdefault(url, {
+            'etag': None,
+            'last_modified': None,
+            'hash': None,
+            'productos': None,
+            'bid': None,
+            'hash_bid': None,
+        })
+        huella.update(valores)
+        HUELLAS_PAGINAS.move_to_end(url)
+        while len(HUELLAS_PAGINAS) > HUELLAS_TAMANO:
+            HUELLAS_PAGINAS.popitem(last=False)
+
+
+# Descarga y parsea la página si cambió desde la última visita
+# Retorna (productos, hash del listado de productos)
+def descargar_productos_con_huella(url):
+    huella = obtener_huella(url)
+    if huella and huella['productos'] is not None:
+        data, cabeceras = descargar_pagina_condicional(url, huella['etag'], huella['last_modified'])
+        if data is None:
+            contar_estadistica(ESTADISTICAS_HUELLAS, 'no_modificadas')
+            return huella['productos'], huella['hash']
+    else:
+        data, cabeceras = descargar_pagina_condicional(url)
 
-        conn, cursor = inicializar_bd() 
-        cursor.execute('''SELECT pid FROM producto WHERE pid=%s''', (pid, ))
-        result = cursor.fetchall()
-        if not result:
-            cursor.execute('''INSERT INTO producto(pid, nombre, precio, enlace, did) VALUES(%s, %s, %s, %s, %s)''',
-                           (pid, nombre, precio, enlace, did))
-            conn.commit()
-        conn.close()
+    resumen = hashlib.sha1(fragmento_productos(data).encode('utf8')).hexdigest()
+    if huella and huella['hash'] == resumen and huella['productos'] is not None:
+        contar_estadistica(ESTADISTICAS_HUELLAS, 'iguales')
+        productos = huella['productos']
+    else:
+        contar_estadistica(ESTADISTICAS_HUELLAS, 'cambiadas')
+        productos = parsear_pagina('productos', data, url)
+    guardar_huella(url, etag=cabeceras.get('ETag'), last_modified=cabeceras.get('Last-Modified'),
+                   hash=resumen, productos=productos)
+    return productos, resumen
+
+
+# Descargas en curso, para no pedir la misma página varias veces a la vez
+# Si llega una petición para una url que ya se está descargando se espera por
+# esa descarga y se comparte la lista de productos en lugar de hacer otra.
+LOCK_DESCARGAS_EN_CURSO = threading.Lock()
+DESCARGAS_EN_CURSO = {}
+ESTADISTICAS_DESCARGAS = {
+    'realizadas': 0,
+    'compartidas': 0,
+}
+
+
+# Retorna (productos, hash del listado de productos)
+def obtener_productos_de_url(url):
+    with LOCK_DESCARGAS_EN_CURSO:
+        futuro = DESCARGAS_EN_CURSO.get(url)
+        propia = futuro is None
+        if propia:
+            futuro = Future()
+            DESCARGAS_EN_CURSO[url] = futuro
+
+    if not propia:
+        contar_estadistica(ESTADISTICAS_DESCARGAS, 'compartidas')
+        return futuro.result()
+
+    try:
+        futuro.set_result(descargar_productos_con_huella(url))
     except Exception as ex:
-        print('registrar_producto:', ex)
+        futuro.set_exception(ex)
+    finally:
+        with LOCK_DESCARGAS_EN_CURSO:
+            del DESCARGAS_EN_CURSO[url]
+        contar_estadistica(ESTADISTICAS_DESCARGAS, 'realizadas')
+    return futuro.result()
+
+
+# Tiempo empleado en guardar en la BD los productos encontrados en cada búsqueda
+ESTADISTICAS_PERSISTENCIA = {
+    'lotes': 0,
+    'filas': 0,
+    'segundos': 0.0,
+}
+
+
+def registrar_productos(cursor, productos, did):
+    # Un solo INSERT para todos los productos de la página. Los que ya existen se
+    # actualizan con el nombre, precio y enlace actuales. Se ordenan por pid para que
+    # dos búsquedas en paralelo bloqueen las filas en el mismo orden.
+    filas = sorted({ pid: (pid, nombre, precio, plink, did) for nombre, precio, plink, pid in productos }.items())
+    valores = ', '.join(['(%s, %s, %s, %s, %s)'] * len(filas))
+    parametros = [ valor for _, fila in filas for valor in fila ]
+    cursor.execute(f'''INSERT INTO producto(pid, nombre, precio, enlace, did) VALUES {valores} \
+                   ON DUPLICATE KEY UPDATE nombre=VALUES(nombre), precio=VALUES(precio), enlace=VALUES(enlace)''',
+                   parametros)
+
+
+def estadisticas_persistencia():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_PERSISTENCIA)
+    segundos = estadisticas['segundos']
+    estadisticas['filas_por_segundo'] = estadisticas['filas'] / segundos if segundos else 0
+    return estadisticas
 
 
 def actualizar_resultados_busqueda(**kargs):
@@ -1209,47 +2231,185 @@ def actualizar_resultados_busqueda(**kargs):
         idchat = kargs['idchat']
         did = kargs['did']
 
-        respuesta = session.get(url, headers=HEADERS)
-        data = respuesta.content.decode('utf8')
-        soup = BeautifulSoup(data, 'html.parser')
-        productos = parsear_productos(soup, url)
-        conn, cursor = inicializar_bd()
-
-        if did == '0':
-            cursor.execute('''INSERT INTO busqueda(uid, criterio, fecha, tid) VALUES(%s, %s, %s, %s)''',
-                            (idchat, mensaje, ahora, tid) )                
-        else:
-            cursor.execute('''INSERT INTO busqueda(uid, did, fecha, tid) VALUES(%s, %s, %s, %s)''',
-                            (idchat, did, ahora, tid) )
-        bid = cursor.lastrowid
-        conn.commit()
-
-        for nombre, precio, plink, pid in productos:
-            # Solo lo adiciona a la base de datos si no existe
-            registrar_producto(nombre=nombre, precio=precio, enlace=plink, pid=pid, did=did)
-            cursor.execute('''INSERT INTO resultado(bid, pid) VALUES(%s, %s)''', (bid, pid) )
+        productos, resumen = obtener_productos_de_url(url)
+        huella = obtener_huella(url)
+        # Si los productos ya están guardados con la búsqueda anterior de esta página
+        # solo se copian sus resultados a la búsqueda nueva
+        bid_anterior = huella['bid'] if huella and huella['hash_bid'] == resumen else None
+
+        inicio = time.perf_counter()
+        # La búsqueda, sus productos y sus resultados se guardan en una sola transacción
+        with conexion_bd() as (conn, cursor):
+            if did == '0':
+                # Se guarda con la misma forma con que lo busca obtener_resultados_busqueda_en_bd
+                cursor.execute('''INSERT INTO busqueda(uid, criterio, fecha, tid) VALUES(%s, %s, %s, %s)''',
+                                (idchat, normalizar_criterio(mensaje), ahora, tid) )
+            else:
+                cursor.execute('''INSERT INTO busqueda(uid, did, fecha, tid) VALUES(%s, %s, %s, %s)''',
+                                (idchat, did, ahora, tid) )
+            bid = cursor.lastrowid
+
+            if bid_anterior:
+                cursor.execute('''INSERT INTO resultado(bid, pid) SELECT %s, pid FROM resultado WHERE bid=%s''',
+                               (bid, bid_anterior))
+            elif productos:
+                registrar_productos(cursor, productos, did)
+                cursor.executemany('''INSERT INTO resultado(bid, pid) VALUES(%s, %s)''',
+                                   [ (bid, pid) for nombre, precio, plink, pid in productos ])
             conn.commit()
+        if bid_anterior:
+            contar_estadistica(ESTADISTICAS_HUELLAS, 'escrituras_evitadas')
+        else:
+            contar_estadistica(ESTADISTICAS_PERSISTENCIA, 'lotes')
+            contar_estadistica(ESTADISTICAS_PERSISTENCIA, 'filas', 1 + 2 * len(productos))
+            contar_estadistica(ESTADISTICAS_PERSISTENCIA, 'segundos', time.perf_counter() - inicio)
+            if productos:
+                indexar_productos(productos)
+        registrar_busqueda_usuario(idchat)
+        if did == '0':
+            contar_criterio_buscado(bid, mensaje)
+        guardar_huella(url, bid=bid, hash_bid=resumen)
 
-        conn.close()
-
-        return bid
+        resultados = [ (pid, nombre, precio, plink) for nombre, precio, plink, pid in productos ]
+        return guardar_resultado_en_cache(clave_cache_resultados(mensaje, tid, did), bid, ahora, resultados)
     except Exception as e:        
         print('actualizar_resultados_busqueda:', e)
 
 
 
+# Términos más buscados
+# En memoria se lleva cuántas veces se ha buscado cada criterio y cuáles son los
+# MAS_BUSCADOS_CANTIDAD primeros, que se actualizan con cada búsqueda guardada. Cada
+# MAS_BUSCADOS_INTERVALO segundos las búsquedas nuevas de la tabla busqueda se suman en
+# la tabla mas_buscados, y al iniciar solo se leen esa tabla y las búsquedas posteriores.
+MAS_BUSCADOS_CANTIDAD = 12
+
+LOCK_MAS_BUSCADOS = threading.Lock()
+CONTEO_CRITERIOS = Counter()
+MAS_BUSCADOS = []
+MAS_BUSCADOS_CARGADO = threading.Event()
+# (bid, criterio) de las búsquedas guardadas mientras se carga el conteo
+BUSQUEDAS_SIN_CONTAR = []
+# criterio -> veces que se respondió con la foto del catálogo, que no deja fila en la
+# tabla busqueda; se suman directamente en mas_buscados en la próxima acumulación
+BUSQUEDAS_EN_FOTO = Counter()
+# La retención acumula desde su propio hilo, a la vez que el trabajo periódico
+LOCK_ACUMULAR_MAS_BUSCADOS = threading.Lock()
+
+
+def crear_tabla_mas_buscados(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS mas_buscados ( \
+                          criterio VARCHAR(255) NOT NULL PRIMARY KEY, \
+                          total INT NOT NULL, \
+                          hasta_bid INT NOT NULL)''')
+
+
+# Suma en mas_buscados las búsquedas de criterios posteriores a la última acumulada.
+# Una búsqueda toma su bid al insertarse pero se confirma al terminar la transacción, así
+# que otra con un bid mayor puede verse antes que ella. Por eso la marca solo avanza
+# hasta la última búsqueda con más de MAS_BUSCADOS_MARGEN segundos, cuando las de bid
+# menor ya se confirmaron. En la misma transacción se suman las búsquedas respondidas
+# con la foto del catálogo desde la acumulación anterior.
+def acumular_mas_buscados(context):
+    en_foto = Counter()
+    try:
+        limite = datetime.datetime.now() - datetime.timedelta(seconds=MAS_BUSCADOS_MARGEN)
+        with LOCK_ACUMULAR_MAS_BUSCADOS, conexion_bd() as (conn, cursor):
+            crear_tabla_mas_buscados(cursor)
+            cursor.execute('''SELECT COALESCE(MAX(hasta_bid), 0) FROM mas_buscados''')
+            desde = cursor.fetchone()[0]
+            cursor.execute('''SELECT COALESCE(MAX(bid), 0) FROM busqueda WHERE bid > %s and fecha < %s''',
+                           (desde, limite))
+            hasta = cursor.fetchone()[0]
+            if hasta > desde:
+                cursor.execute('''INSERT INTO mas_buscados(criterio, total, hasta_bid) \
+                                  SELECT criterio, n, %s FROM (SELECT criterio, count(uid) AS n FROM busqueda \
+                                  WHERE bid > %s and bid <= %s and criterio is not null GROUP BY criterio) AS nuevas \
+                                  ON DUPLICATE KEY UPDATE total = total + nuevas.n, hasta_bid = %s''',
+                               (hasta, desde, hasta, hasta))
+            with LOCK_MAS_BUSCADOS:
+                en_foto.update(BUSQUEDAS_EN_FOTO)
+                BUSQUEDAS_EN_FOTO.clear()
+            if en_foto:
+                cursor.executemany('''INSERT INTO mas_buscados(criterio, total, hasta_bid) VALUES(%s, %s, %s) \
+                                      ON DUPLICATE KEY UPDATE total = total + VALUES(total)''',
+                                   [ (criterio, total, desde) for criterio, total in en_foto.items() ])
+            conn.commit()
+    except Exception as ex:
+        # Las de la foto se vuelven a intentar en la próxima acumulación
+        with LOCK_MAS_BUSCADOS:
+            BUSQUEDAS_EN_FOTO.update(en_foto)
+        debug_print(f'acumular_mas_buscados: {ex}', 'error')
+
+
+def cargar_mas_buscados():
+    try:
+        conteo = Counter()
+        # bid de las búsquedas posteriores a la marca que se contaron desde la BD
+        contadas = set()
+        with conexion_bd() as (conn, cursor):
+            crear_tabla_mas_buscados(cursor)
+            cursor.execute('''SELECT criterio, total, hasta_bid FROM mas_buscados''')
+            desde = 0
+            for criterio, total, hasta_bid in cursor:
+                conteo[normalizar_criterio(criterio)] += total
+                desde = max(desde, hasta_bid)
+            cursor.execute('''SELECT bid, criterio FROM busqueda WHERE bid > %s and criterio is not null''', (desde, ))
+            for bid, criterio in cursor:
+                contadas.add(bid)
+                conteo[normalizar_criterio(criterio)] += 1
+        with LOCK_MAS_BUSCADOS:
+            # Las que se guardaron durante la carga y no se leyeron, aunque tengan un bid menor
+            for bid, criterio in BUSQUEDAS_SIN_CONTAR:
+                if bid not in contadas:
+                    conteo[criterio] += 1
+            BUSQUEDAS_SIN_CONTAR.clear()
+            CONTEO_CRITERIOS.update(conteo)
+            MAS_BUSCADOS[:] = CONTEO_CRITERIOS.most_common(MAS_BUSCADOS_CANTIDAD)
+            MAS_BUSCADOS_CARGADO.set()
+        debug_print(f'Conteo de los más buscados cargado: {len(CONTEO_CRITERIOS)} criterios')
+    except Exception as ex:
+        debug_print(f'cargar_mas_buscados: {ex}', 'error')
+
+
+# Se llama con cada búsqueda de un criterio que se guarda en la tabla busqueda
+def contar_criterio_buscado(bid, criterio):
+    criterio = normalizar_criterio(criterio)
+    with LOCK_MAS_BUSCADOS:
+        if not MAS_BUSCADOS_CARGADO.is_set():
+            BUSQUEDAS_SIN_CONTAR.append( (bid, criterio) )
+            return
+        CONTEO_CRITERIOS[criterio] += 1
+        # Los conteos solo crecen, así que solo el criterio buscado puede entrar en los primeros
+        primeros = [ (texto, total) for texto, total in MAS_BUSCADOS if texto != criterio ]
+        primeros.append( (criterio, CONTEO_CRITERIOS[criterio]) )
+        primeros.sort(key=lambda primero: primero[1], reverse=True)
+        MAS_BUSCADOS[:] = primeros[:MAS_BUSCADOS_CANTIDAD]
+
+
+# Se llama con cada búsqueda de un criterio respondida con la foto del catálogo
+def contar_criterio_en_foto(criterio):
+    contar_criterio_buscado(None, criterio)
+    with LOCK_MAS_BUSCADOS:
+        BUSQUEDAS_EN_FOTO[normalizar_criterio(criterio)] += 1
+
+
+def obtener_mas_buscados():
+    if MAS_BUSCADOS_CARGADO.is_set():
+        with LOCK_MAS_BUSCADOS:
+            return list(MAS_BUSCADOS)
+    # Mientras se carga el conteo se consulta directamente la BD
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT criterio, count(uid) as total FROM busqueda where criterio is not null group by criterio order by total desc limit %s''',
+                       (MAS_BUSCADOS_CANTIDAD, ))
+        return cursor.fetchall()
+
+
 def mas_buscados(update, context):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT criterio, count(uid) as total FROM busqueda where criterio is not null group by criterio order by total desc limit 12;''')
-    
     botones = []
-    for row in cursor:
-        texto = row[0]
-        total = row[1]
+    for texto, total in obtener_mas_buscados():
         botones.append( InlineKeyboardButton(f'{texto} ({total})', callback_data=f'mb:{texto}') )
 
-    conn.close()
-
     reply_markup = InlineKeyboardMarkup(construir_menu(botones, n_cols=3))
 
     context.bot.send_message(chat_id=update.effective_chat.id,
@@ -1257,7 +2417,7 @@ def mas_buscados(update, context):
                              reply_markup=reply_markup)
 
 
-dispatcher.add_handler(CommandHandler('mb', mas_buscados))  
+dispatcher.add_handler(CommandHandler('mb', en_orden_por_chat(mas_buscados)))  
 
 
 def enviar_foto(update, context):
@@ -1265,25 +2425,111 @@ def enviar_foto(update, context):
                photo='https://www.portalveterinaria.com/upload/thumbs/20200529101926vison.jpg',
                caption='Aquí enviando una foto de ejemplo')
 
-dispatcher.add_handler(CommandHandler('sf', enviar_foto))    
+dispatcher.add_handler(CommandHandler('sf', en_orden_por_chat(enviar_foto)))    
+
+
+# Caché compartida de resultados de búsqueda
+# Los productos encontrados para un criterio (o departamento) en una tienda le sirven
+# a cualquier usuario mientras no pase intervalo_busqueda. Se guardan en memoria las
+# CACHE_RESULTADOS_TAMANO más usadas; si no está en memoria se mira en busqueda/resultado
+# antes de volver a descargar la página.
+LOCK_CACHE_RESULTADOS = threading.Lock()
+CACHE_RESULTADOS = OrderedDict()
+ESTADISTICAS_CACHE_RESULTADOS = {
+    'aciertos_memoria': 0,
+    'aciertos_bd': 0,
+    'fallos': 0,
+    'expulsados': 0,
+}
+
 
+def normalizar_criterio(criterio):
+    return ' '.join(str(criterio).lower().split())
 
-def obtener_resultados_busqueda_en_bd(idchat, mensaje, tienda, did):
-    conn, cursor = inicializar_bd()
+
+def clave_cache_resultados(mensaje, tid, did):
     if did == '0':
-        cursor.execute('''SELECT bid, fecha FROM busqueda WHERE uid=%s and criterio=%s \
-                          and tid=%s ORDER BY fecha DESC LIMIT 1''', (idchat, mensaje, tienda))
-    else:
-        cursor.execute('''SELECT bid, fecha FROM busqueda WHERE uid=%s and did=%s \
-                          and tid=%s ORDER BY fecha DESC LIMIT 1''', (idchat, did, tienda))
-    res_busqueda = cursor.fetchone()
-    conn.close()
-    if res_busqueda:
-        return {
-            'bid': res_busqueda[0],
-            'fecha': res_busqueda[1]
-        }
-    return False
+        return ('criterio', normalizar_criterio(mensaje), tid)
+    return ('dep', str(did), tid)
+
+
+# Retorna la entrada guardada: {'bid', 'fecha', 'productos'}
+# productos es una lista de tuplas (pid, nombre, precio, enlace)
+def guardar_resultado_en_cache(clave, bid, fecha, productos):
+    entrada = {
+        'bid': bid,
+        'fecha': fecha,
+        'productos': productos,
+    }
+    with LOCK_CACHE_RESULTADOS:
+        CACHE_RESULTADOS[clave] = entrada
+        CACHE_RESULTADOS.move_to_end(clave)
+        while len(CACHE_RESULTADOS) > CACHE_RESULTADOS_TAMANO:
+            CACHE_RESULTADOS.popitem(last=False)
+            contar_estadistica(ESTADISTICAS_CACHE_RESULTADOS, 'expulsados')
+    return entrada
+
+
+# Retorna un diccionario tienda -> entrada con las tiendas que tienen un resultado con
+# menos de ttl segundos. Primero se mira en memoria y las que falten se buscan en la BD
+# todas juntas, con una consulta para las búsquedas y otra para sus productos.
+def buscar_resultados_en_cache(mensaje, tiendas, did, ttl):
+    ahora = datetime.datetime.now()
+    entradas = {}
+    with LOCK_CACHE_RESULTADOS:
+        for tid in tiendas:
+            clave = clave_cache_resultados(mensaje, tid, did)
+            entrada = CACHE_RESULTADOS.get(clave)
+            if entrada and (ahora - entrada['fecha']).total_seconds() <= ttl:
+                CACHE_RESULTADOS.move_to_end(clave)
+                contar_estadistica(ESTADISTICAS_CACHE_RESULTADOS, 'aciertos_memoria')
+                entradas[tid] = entrada
+
+    pendientes = [ tid for tid in tiendas if tid not in entradas ]
+    if pendientes:
+        desde = ahora - datetime.timedelta(seconds=ttl)
+        busquedas = obtener_resultados_busqueda_en_bd(mensaje, pendientes, did, desde)
+        productos = obtener_productos_resultados_busqueda([ res['bid'] for res in busquedas.values() ])
+        if productos is not None:
+            for tid, res_busqueda in busquedas.items():
+                clave = clave_cache_resultados(mensaje, tid, did)
+                entradas[tid] = guardar_resultado_en_cache(clave, res_busqueda['bid'], res_busqueda['fecha'],
+                                                           productos.get(res_busqueda['bid'], []))
+                contar_estadistica(ESTADISTICAS_CACHE_RESULTADOS, 'aciertos_bd')
+
+    contar_estadistica(ESTADISTICAS_CACHE_RESULTADOS, 'fallos', len(tiendas) - len(entradas))
+    return entradas
+
+
+def estadisticas_cache_resultados():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_CACHE_RESULTADOS)
+    aciertos = estadisticas['aciertos_memoria'] + estadisticas['aciertos_bd']
+    total = aciertos + estadisticas['fallos']
+    estadisticas['proporcion_aciertos'] = aciertos / total if total else 0
+    estadisticas['entradas'] = len(CACHE_RESULTADOS)
+    return estadisticas
+
+
+# Última búsqueda hecha desde la fecha indicada por cualquier usuario de un criterio
+# o departamento en cada una de las tiendas. Retorna tienda -> {'bid', 'fecha'}
+def obtener_resultados_busqueda_en_bd(mensaje, tiendas, did, desde):
+    marcadores = ', '.join(['%s'] * len(tiendas))
+    with conexion_bd() as (conn, cursor):
+        if did == '0':
+            cursor.execute(f'''SELECT tid, bid, fecha FROM busqueda WHERE criterio=%s and tid IN ({marcadores}) \
+                              and fecha >= %s ORDER BY fecha DESC''', (normalizar_criterio(mensaje), *tiendas, desde))
+        else:
+            cursor.execute(f'''SELECT tid, bid, fecha FROM busqueda WHERE did=%s and tid IN ({marcadores}) \
+                              and fecha >= %s ORDER BY fecha DESC''', (did, *tiendas, desde))
+        results = cursor.fetchall()
+    busquedas = {}
+    for tid, bid, fecha in results:
+        if tid not in busquedas:
+            busquedas[tid] = {
+                'bid': bid,
+                'fecha': fecha
+            }
+    return busquedas
 
 
 # Realiza la búsqueda de la palabra clave en tuenvio.cu
@@ -1291,6 +2537,7 @@ def obtener_resultados_busqueda_en_bd(idchat, mensaje, tienda, did):
 # nombre: nombre de usuario para los logs
 # idchat: el id de chat desde el que se invocó la búsqueda
 # buscar_en_dpto: si esta búsqueda es general en un departamento
+# Retorna una lista de tuplas (bid, tienda, en_cache, productos) en el orden de las tiendas
 # TODO: definir correctamente el nombre para esta funcion
 def obtener_soup(mensaje, nombre, idchat, buscar_en_dpto=False, tienda=False):
     try:        
@@ -1310,42 +2557,55 @@ def obtener_soup(mensaje, nombre, idchat, buscar_en_dpto=False, tienda=False):
                 for tid, nombre_tienda in obtener_tiendas(prov_id):
                     tiendas.append( tid )
 
+        intervalo_busqueda = int( obtener_ajuste_bot('intervalo_busqueda') )
+
+        # Si la foto del catálogo de la tienda es reciente se responde con ella, y si
+        # otro usuario ya hizo esta búsqueda y aún es válida se usa su resultado
+        en_disponibilidad = {}
+        for tid in tiendas:
+            productos = buscar_en_disponibilidad(mensaje, tid, did, intervalo_busqueda)
+            if productos is not None:
+                en_disponibilidad[tid] = productos
+        en_cache = buscar_resultados_en_cache(mensaje, [ tid for tid in tiendas if tid not in en_disponibilidad ],
+                                              did, intervalo_busqueda)
+
         # Se hace el procesamiento para cada tienda en cada provincia
         # si se trata de un criterio de busqueda
-        bid_results = []
-        for tienda in tiendas:            
+        def procesar_tienda(tienda):
             ahora = datetime.datetime.now()
-            
-            res_busqueda = obtener_resultados_busqueda_en_bd(idchat, mensaje, tienda, did)
-
-            se_debe_actualizar = False
-            # Si el resultado no se encuentra cacheado buscar y guardar
-            if not res_busqueda:
-                debug_print(f'Buscando: "{mensaje}" para {nombre} en {tienda}')
-                se_debe_actualizar = True            
-            # Si el resultado está cacheado
-            else:
-                delta = ahora - res_busqueda['fecha']
-                # Si aún es válido se retorna lo que hay en cache
-                if delta.total_seconds() <= int( obtener_ajuste_bot('intervalo_busqueda') ):
-                    if buscar_en_dpto:
-                        debug_print(f'Término aún en la cache, no se realiza la búsqueda.')
-                    else:
-                        debug_print(f'"{mensaje}" aún en la cache, no se realiza la búsqueda.')
-                # Si no es válido se actualiza la cache
+
+            if tienda in en_disponibilidad:
+                debug_print(f'"{mensaje}" respondido con la foto del catálogo de {tienda}.')
+                # No se guarda en la tabla busqueda porque no tiene resultados que reutilizar,
+                # pero cuenta para el límite por hora y para los más buscados como una
+                # búsqueda descargada. Como no se descargó nada no se cobra, igual que la cache.
+                registrar_busqueda_usuario(idchat)
+                if did == '0':
+                    contar_criterio_en_foto(mensaje)
+                return (None, tienda, True, en_disponibilidad[tienda])
+
+            entrada = en_cache.get(tienda)
+            if entrada:
+                if buscar_en_dpto:
+                    debug_print(f'Término aún en la cache, no se realiza la búsqueda.')
                 else:
-                    debug_print(f'Actualizando: "{mensaje}" para {nombre} en {tienda}')
-                    se_debe_actualizar = True
-
-            if se_debe_actualizar:
-                url_base = f'{URL_BASE_TUENVIO}/{tienda}'
-                url = f'{url_base}/{cadena_busqueda}'
-                bid = actualizar_resultados_busqueda(url=url, mensaje=mensaje, tienda=tienda,
-                                               ahora=ahora, idchat=idchat, did=did)
-                bid_results.append( (bid, tienda, False) )
-            else:
-                bid = res_busqueda['bid']
-                bid_results.append( (bid, tienda, True) )       
+                    debug_print(f'"{mensaje}" aún en la cache, no se realiza la búsqueda.')
+                return (entrada['bid'], tienda, True, entrada['productos'])
+
+            debug_print(f'Buscando: "{mensaje}" para {nombre} en {tienda}')
+            url_base = f'{URL_BASE_TUENVIO}/{tienda}'
+            url = f'{url_base}/{cadena_busqueda}'
+            entrada = actualizar_resultados_busqueda(url=url, mensaje=mensaje, tienda=tienda,
+                                                     ahora=ahora, idchat=idchat, did=did)
+            if entrada:
+                return (entrada['bid'], tienda, False, entrada['productos'])
+            return (None, tienda, False, [])
+
+        # Las tiendas se procesan a la vez y los resultados se recogen en el mismo
+        # orden en que se enviaron, así la demora es la de la tienda más lenta
+        procesar_tienda = con_contador_bd(procesar_tienda)
+        futuros = [ POOL_TIENDAS.submit(procesar_tienda, tienda) for tienda in tiendas ]
+        bid_results = [ futuro.result() for futuro in futuros ]
 
         return bid_results
                     
@@ -1354,241 +2614,921 @@ def obtener_soup(mensaje, nombre, idchat, buscar_en_dpto=False, tienda=False):
 
 
 
-# Busca la categoria y si existe devuelve el ID
-# Si no existe la inserta y retorna el ID
-def obtener_id_categoria(cat):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT cid FROM categoria WHERE nombre=%s''', (cat, ))
-    result = cursor.fetchone()
-    if not result:
-        cursor.execute('''INSERT INTO categoria(nombre) VALUES(%s)''', (cat, ))
-        conn.commit()
-        cursor.execute('''SELECT cid FROM categoria WHERE nombre=%s''', (cat, ))
-        cid = cursor.fetchone()[0]
-    else:
-        cid = result[0]
-    conn.close()
-    return cid
+# Menús de departamentos de las tiendas
+# Las categorías de cada tienda se guardan en memoria junto con la hora en que se
+# descargó su menú; el contenido del menú y esa hora (tabla menu_tienda) quedan en la
+# BD. Pasados MENU_TTL segundos se sigue mostrando el menú guardado mientras se
+# descarga de nuevo en segundo plano.
+POOL_MENUS = ThreadPoolExecutor(max_workers=MENU_HILOS, thread_name_prefix='menu')
+
+LOCK_MENUS = threading.Lock()
+# tid -> {'categorias': [nombre], 'actualizado': time.monotonic() o None, 'refrescando': bool}
+MENUS_TIENDAS = {}
+ESTADISTICAS_MENUS = {
+    'aciertos': 0,
+    'cargados_bd': 0,
+    'descargados': 0,
+    'refrescos': 0,
+    'errores': 0,
+}
 
 
-def existe_departamento_en_categoria(did, cid):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT did FROM departamento WHERE did=%s and cid=%s''', (did, cid))
-    result = cursor.fetchall()
-    conn.close()
-    return len(result)
+# Las categorías son compartidas por todas las tiendas. Los menús se guardan de uno en
+# uno para que dos que se descargan a la vez no inserten la misma categoría dos veces
+# ni uno deje de ver la que el otro aún no ha confirmado.
+LOCK_CATEGORIAS = threading.Lock()
 
 
-def registrar_categoria_en_tienda(tid, cid):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT tid FROM tienda_categoria WHERE tid=%s and cid=%s''', (tid, cid))
-    result = cursor.fetchall()
-    if not result:
-        cursor.execute('''INSERT INTO tienda_categoria(tid, cid) VALUES(%s, %s)''', (tid, cid))
-        conn.commit()
-    conn.close()  
+def crear_tabla_menu_tienda(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS menu_tienda ( \
+                          tid VARCHAR(64) NOT NULL PRIMARY KEY, \
+                          actualizado DATETIME NOT NULL)''')
+
+
+# Convierte la fecha guardada de la última descarga al reloj de MENUS_TIENDAS
+def hora_descarga_menu(fecha):
+    if fecha is None:
+        return None
+    return time.monotonic() - (datetime.datetime.now() - fecha).total_seconds()
+
+
+# Retorna (nombre -> cid, si se creó alguna) creando las categorías que no existan, en
+# la transacción del cursor. Debe llamarse con LOCK_CATEGORIAS adquirido.
+def obtener_ids_categorias(cursor, nombres):
+    marcadores = ', '.join(['%s'] * len(nombres))
+    cursor.execute(f'''SELECT cid, nombre FROM categoria WHERE nombre IN ({marcadores})''', tuple(nombres))
+    categorias = { nombre: cid for cid, nombre in cursor }
+    nuevas = [ (nombre, ) for nombre in nombres if nombre not in categorias ]
+    if nuevas:
+        cursor.executemany('''INSERT IGNORE INTO categoria(nombre) VALUES(%s)''', nuevas)
+        cursor.execute(f'''SELECT cid, nombre FROM categoria WHERE nombre IN ({marcadores})''', tuple(nombres))
+        categorias = { nombre: cid for cid, nombre in cursor }
+    return categorias, bool(nuevas)
 
 
 # deps es un diccionario donde para cada categoria de la tienda
-# se listan los departamentos asociados
+# se listan los departamentos asociados. Todo el menú se aplica en una transacción: se
+# crean las categorías y los departamentos nuevos, se asocian las categorías a la
+# tienda, se quitan de la tienda las que ya no tiene y se guarda la hora de la descarga.
 def actualizar_departamentos_en_categoria(tid, deps):
     try:
-        conn, cursor = inicializar_bd()
-        for cat in deps:
-            cid = obtener_id_categoria(cat)
-            registrar_categoria_en_tienda(tid, cid)
-            for did, nombre in deps[cat].items():
-                if not existe_departamento_en_categoria(did, cid):
-                    cursor.execute('''INSERT INTO departamento(did, nombre, cid) VALUES(%s, %s, %s)''', (did, nombre, cid))                    
-                    conn.commit()
-                    registrar_categoria_en_tienda(tid, cid)
-        conn.close()
+        nombres = list(deps)
+        with LOCK_CATEGORIAS, conexion_bd() as (conn, cursor):
+            # CREATE TABLE confirma lo anterior, así que va antes de empezar a escribir
+            crear_tabla_menu_tienda(cursor)
+            categorias, nuevas = obtener_ids_categorias(cursor, nombres)
+            cursor.execute('''SELECT cid FROM tienda_categoria WHERE tid=%s''', (tid, ))
+            asociadas = { cid for (cid, ) in cursor }
+            cids = { categorias[nombre] for nombre in nombres }
+            if cids - asociadas:
+                cursor.executemany('''INSERT IGNORE INTO tienda_categoria(tid, cid) VALUES(%s, %s)''',
+                                   [ (tid, cid) for cid in cids - asociadas ])
+            if asociadas - cids:
+                cursor.executemany('''DELETE FROM tienda_categoria WHERE tid=%s and cid=%s''',
+                                   [ (tid, cid) for cid in asociadas - cids ])
+
+            departamentos = [ (did, nombre, categorias[cat]) for cat in nombres for did, nombre in deps[cat].items() ]
+            nuevos = []
+            if departamentos:
+                marcadores = ', '.join(['%s'] * len(departamentos))
+                cursor.execute(f'''SELECT did FROM departamento WHERE did IN ({marcadores})''',
+                               tuple(did for did, nombre, cid in departamentos))
+                existentes = { str(did) for (did, ) in cursor }
+                # Un departamento que ya existe (aunque sea en otra categoría) no se toca
+                nuevos = [ dep for dep in departamentos if str(dep[0]) not in existentes ]
+                if nuevos:
+                    cursor.executemany('''INSERT IGNORE INTO departamento(did, nombre, cid) VALUES(%s, %s, %s)''', nuevos)
+            cursor.execute('''INSERT INTO menu_tienda(tid, actualizado) VALUES(%s, %s) \
+                              ON DUPLICATE KEY UPDATE actualizado = VALUES(actualizado)''',
+                           (tid, datetime.datetime.now()))
+            conn.commit()
+        if nuevas or nuevos or cids != asociadas:
+            invalidar_catalogo()
+        return True
     except Exception as ex:
         print('actualizar_departamentos_en_categoria', ex)
+        return False
+
 
+# Retorna (categorías, hora de la última descarga en el reloj de MENUS_TIENDAS o None)
+def cargar_categorias_tienda_bd(tid):
+    with conexion_bd() as (conn, cursor):
+        crear_tabla_menu_tienda(cursor)
+        cursor.execute('''SELECT nombre FROM tienda_categoria JOIN categoria WHERE tienda_categoria.cid=categoria.cid and tid=%s''', (tid,))
+        categorias = [ nombre for (nombre, ) in cursor ]
+        cursor.execute('''SELECT actualizado FROM menu_tienda WHERE tid=%s''', (tid, ))
+        fila = cursor.fetchone()
+    return categorias, hora_descarga_menu(fila[0] if fila else None)
+
+
+# Descarga el menú de la tienda y lo guarda en la BD y en memoria
+def descargar_menu_tienda(tid):
+    try:
+        data = descargar_pagina(f'{URL_BASE_TUENVIO}/{tid}')
+        deps = parsear_pagina('menu', data)
+        if deps and actualizar_departamentos_en_categoria(tid, deps):
+            with LOCK_MENUS:
+                MENUS_TIENDAS[tid] = {
+                    'categorias': list(deps),
+                    'actualizado': time.monotonic(),
+                    'refrescando': False,
+                }
+            contar_estadistica(ESTADISTICAS_MENUS, 'descargados')
+            return True
+    except Exception as ex:
+        debug_print(f'descargar_menu_tienda {tid}: {ex}', 'error')
+    contar_estadistica(ESTADISTICAS_MENUS, 'errores')
+    # Se seguirá mostrando el menú anterior y se intentará de nuevo en el próximo uso
+    with LOCK_MENUS:
+        if tid in MENUS_TIENDAS:
+            MENUS_TIENDAS[tid]['refrescando'] = False
+    return False
+
+
+# Retorna las categorías de la tienda. Si no están en memoria se leen de la BD y si la
+# tienda aún no tiene menú se descarga en el momento. Cuando el menú está vencido se
+# descarga en segundo plano y mientras tanto se usa el guardado.
+def obtener_menu_tienda(tid):
+    with LOCK_MENUS:
+        menu = MENUS_TIENDAS.get(tid)
+    if menu is None:
+        categorias, actualizado = cargar_categorias_tienda_bd(tid)
+        if not categorias:
+            descargar_menu_tienda(tid)
+            with LOCK_MENUS:
+                menu = MENUS_TIENDAS.get(tid)
+            return menu['categorias'] if menu else []
+        contar_estadistica(ESTADISTICAS_MENUS, 'cargados_bd')
+        with LOCK_MENUS:
+            # Sin la hora de la última descarga el menú se refresca enseguida
+            menu = MENUS_TIENDAS.setdefault(tid, {
+                'categorias': categorias,
+                'actualizado': actualizado,
+                'refrescando': False,
+            })
+    else:
+        contar_estadistica(ESTADISTICAS_MENUS, 'aciertos')
+
+    refrescar = False
+    with LOCK_MENUS:
+        if not menu['refrescando'] and (menu['actualizado'] is None or
+                                        time.monotonic() - menu['actualizado'] > MENU_TTL):
+            menu['refrescando'] = True
+            refrescar = True
+    if refrescar:
+        contar_estadistica(ESTADISTICAS_MENUS, 'refrescos')
+        POOL_MENUS.submit(descargar_menu_tienda, tid)
+    return menu['categorias']
+
+
+# Al iniciar se cargan de una vez los menús guardados en la BD y se descargan los que
+# no hay o están vencidos, hasta MENU_HILOS a la vez
+def precargar_menus():
+    try:
+        with conexion_bd() as (conn, cursor):
+            crear_tabla_menu_tienda(cursor)
+            cursor.execute('''SELECT tid, nombre FROM tienda_categoria JOIN categoria WHERE tienda_categoria.cid=categoria.cid''')
+            guardados = {}
+            for tid, nombre in cursor:
+                guardados.setdefault(tid, []).append(nombre)
+            cursor.execute('''SELECT tid, actualizado FROM menu_tienda''')
+            descargados = { tid: hora_descarga_menu(actualizado) for tid, actualizado in cursor }
+        ahora = time.monotonic()
+        vigentes = { tid for tid, actualizado in descargados.items()
+                     if tid in guardados and ahora - actualizado <= MENU_TTL }
+        with LOCK_MENUS:
+            for tid, categorias in guardados.items():
+                MENUS_TIENDAS.setdefault(tid, {
+                    'categorias': categorias,
+                    'actualizado': descargados.get(tid),
+                    'refrescando': tid not in vigentes,
+                })
+        for tid in obtener_todas_las_tiendas():
+            if tid not in vigentes:
+                POOL_MENUS.submit(descargar_menu_tienda, tid)
+    except Exception as ex:
+        debug_print(f'precargar_menus: {ex}', 'error')
+
+
+def estadisticas_menus():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_MENUS)
+    ahora = time.monotonic()
+    with LOCK_MENUS:
+        menus = list(MENUS_TIENDAS.values())
+    estadisticas['tiendas'] = len(menus)
+    estadisticas['vencidos'] = sum(1 for menu in menus if menu['actualizado'] is None or
+                                   ahora - menu['actualizado'] > MENU_TTL)
+    return estadisticas
 
 
 # Obtiene las categorias y departamentos de la tienda actual
 def parsear_menu_departamentos(idchat):
     try:
         tienda = obtener_ajustes_usuario(idchat)['tid']
-
-        conn, cursor = inicializar_bd()
-        # Si no se le ha generado menu a la tienda o el que existe aun es valido
-        cursor.execute('''select departamento.did, departamento.nombre from departamento join \
-                       categoria join tienda_categoria where departamento.cid = categoria.cid \
-                       and tienda_categoria.cid = categoria.cid and tienda_categoria.tid=%s''', (tienda, ))
-        results = cursor.fetchall()
-        conn.close()
-        if not results:
-            respuesta = session.get(f'{URL_BASE_TUENVIO}/{tienda}', headers=HEADERS)
-            data = respuesta.content.decode('utf8')
-            soup = BeautifulSoup(data, 'html.parser')
-            ahora = datetime.datetime.now()
-            
-            deps = {}
-            navbar = soup.select('.mainNav .navbar .nav > li:not(:first-child)')
-            for child in navbar:
-                cat = child.select('a')[0].contents[0]
-                deps[cat] = {}
-                for d in child.select('div > ul > li'):
-                    d_id = d.select('a')[0]['href'].split('=')[1]
-                    d_nombre = d.select('a')[0].contents[0]
-                    deps[cat][d_id] = d_nombre
-            
-            actualizar_departamentos_en_categoria(tienda, deps)
-            # TODO: Incorporar la cache
+        obtener_menu_tienda(tienda)
     except Exception as ex:
         print('parsear_menu_departamentos', ex)
 
 
-
+# Retorna (productos, hash del listado) de la primera tienda de la provincia que los tenga
 def hay_productos_en_provincia(criterio, prov_id):
     tiendas = obtener_tiendas(prov_id)
     for tid, nombre in tiendas:
         url = f'{URL_BASE_TUENVIO}/{tid}/Search.aspx?keywords=%22{criterio}%22&depPid=0'
-        respuesta = session.get(url, headers=HEADERS)
-        data = respuesta.content.decode('utf8')
-        soup = BeautifulSoup(data, 'html.parser')
-        productos = parsear_productos(soup, url)
+        productos, resumen = obtener_productos_de_url(url)
         if productos:
-            return productos
+            return productos, resumen
     else:
         return False
 
 
+# Autómata de Aho-Corasick para encontrar varios patrones en un texto de una sola pasada
+# Retorna (transiciones, fallos, salidas), las salidas son los índices de los patrones
+def construir_automata(patrones):
+    transiciones = [{}]
+    fallos = [0]
+    salidas = [set()]
+    for i, patron in enumerate(patrones):
+        estado = 0
+        for c in patron:
+            if c not in transiciones[estado]:
+                transiciones.append({})
+                fallos.append(0)
+                salidas.append(set())
+                transiciones[estado][c] = len(transiciones) - 1
+            estado = transiciones[estado][c]
+        salidas[estado].add(i)
+
+    cola = deque(transiciones[0].values())
+    while cola:
+        estado = cola.popleft()
+        for c, siguiente in transiciones[estado].items():
+            cola.append(siguiente)
+            fallo = fallos[estado]
+            while fallo and c not in transiciones[fallo]:
+                fallo = fallos[fallo]
+            fallos[siguiente] = transiciones[fallo].get(c, 0)
+            salidas[siguiente] |= salidas[fallos[siguiente]]
+    return transiciones, fallos, salidas
+
+
+def buscar_patrones(automata, texto):
+    transiciones, fallos, salidas = automata
+    encontrados = set()
+    estado = 0
+    for c in texto:
+        while estado and c not in transiciones[estado]:
+            estado = fallos[estado]
+        estado = transiciones[estado].get(c, 0)
+        if salidas[estado]:
+            encontrados |= salidas[estado]
+    return encontrados
+
+
+# Los nombres y criterios se comparan sin tildes, en minúsculas y con un espacio delante
+# de cada palabra, para que un criterio coincida solo desde el comienzo de una palabra
+def texto_para_rastreo(texto):
+    return ''.join(f' {palabra}' for palabra in palabras_de(texto))
+
+
+# Retorna tid -> lista de did de los departamentos conocidos de cada tienda
+def obtener_departamentos_tiendas(tiendas):
+    departamentos = { tid: [] for tid in tiendas }
+    if tiendas:
+        marcadores = ', '.join(['%s'] * len(tiendas))
+        with conexion_bd() as (conn, cursor):
+            cursor.execute(f'''SELECT tienda_categoria.tid, departamento.did FROM departamento join \
+                               categoria join tienda_categoria where departamento.cid = categoria.cid \
+                               and tienda_categoria.cid = categoria.cid and tienda_categoria.tid IN ({marcadores})''',
+                           tuple(tiendas))
+            for tid, did in cursor:
+                departamentos[tid].append(did)
+    return departamentos
+
+
+# Hilos propios para los recorridos de departamentos, así no le quitan a las búsquedas
+# de los usuarios los hilos de POOL_TIENDAS
+POOL_ESCANEO = ThreadPoolExecutor(max_workers=ESCANEO_HILOS, thread_name_prefix='escaneo')
+
+
+def descargar_productos_rastreo(url):
+    try:
+        productos, resumen = obtener_productos_de_url(url)
+        contar_estadistica(ESTADISTICAS_ESCANEO, 'paginas_rastreadas')
+        return productos
+    except Exception as ex:
+        debug_print(f'descargar_productos_rastreo {url}: {ex}', 'error')
+
+
+# Recorre los departamentos de las tiendas de la provincia y busca todos los criterios
+# en los nombres de los productos. Igual que hay_productos_en_provincia, para cada
+# criterio retorna (productos, hash del listado) de la primera tienda que los tenga.
+# Las tiendas de las que no se conocen los departamentos se consultan con búsquedas.
+def rastrear_departamentos_provincia(prov_id, criterios):
+    criterios = list(criterios)
+    automata = construir_automata([ texto_para_rastreo(criterio) for criterio in criterios ])
+    tiendas = [ tid for tid, nombre in obtener_tiendas(prov_id) ]
+    departamentos = obtener_departamentos_tiendas(tiendas)
+    resultado = {}
+    for tid in tiendas:
+        if not departamentos[tid]:
+            for criterio in criterios:
+                if criterio not in resultado:
+                    url = f'{URL_BASE_TUENVIO}/{tid}/Search.aspx?keywords=%22{criterio}%22&depPid=0'
+                    productos, resumen = obtener_productos_de_url(url)
+                    if productos:
+                        resultado[criterio] = (productos, resumen)
+            continue
+
+        urls = [ f'{URL_BASE_TUENVIO}/{tid}/Products?depPid={did}' for did in departamentos[tid] ]
+        por_criterio = {}
+        vistos = set()
+        for productos in POOL_ESCANEO.map(descargar_productos_rastreo, urls):
+            for producto in productos or []:
+                # Un producto puede aparecer en más de un departamento
+                if producto[3] in vistos:
+                    continue
+                vistos.add(producto[3])
+                for i in buscar_patrones(automata, texto_para_rastreo(producto[0])):
+                    por_criterio.setdefault(criterios[i], []).append(producto)
+        for criterio, productos in por_criterio.items():
+            if criterio not in resultado:
+                resumen = hashlib.sha1(repr(productos).encode('utf8')).hexdigest()
+                resultado[criterio] = (productos, resumen)
+    return resultado
+
+
+# Recorrido del catálogo en segundo plano
+# Cada RASTREO_INTERVALO segundos se descargan todos los departamentos de cada tienda
+# y se guarda en memoria qué productos tiene disponibles y a qué precio. Las búsquedas
+# de los usuarios se responden con esa foto mientras sea más reciente que el
+# intervalo de búsqueda, sin descargar nada de tuenvio.cu.
+POOL_RASTREO = ThreadPoolExecutor(max_workers=RASTREO_HILOS, thread_name_prefix='rastreo')
+
+Disponible = namedtuple('Disponible', ['pid', 'nombre', 'precio', 'enlace', 'texto', 'visto'])
+
+LOCK_DISPONIBILIDAD = threading.Lock()
+# tid -> {'fecha', 'duracion', 'productos': {pid: Disponible}, 'departamentos': {did: [pid]}}
+DISPONIBILIDAD = {}
+ESTADISTICAS_RASTREO = {
+    'recorridos': 0,
+    'tiendas': 0,
+    'fallidas': 0,
+    'aciertos': 0,
+}
+
+
+# Descarga todos los departamentos de la tienda y actualiza su foto. Si falla alguno
+# se mantiene la foto anterior, para no dar por agotados productos que no se vieron.
+def rastrear_tienda(tid):
+    inicio = time.monotonic()
+    ahora = datetime.datetime.now()
+    try:
+        obtener_menu_tienda(tid)
+        departamentos = obtener_departamentos_tiendas([tid])[tid]
+        urls = [ f'{URL_BASE_TUENVIO}/{tid}/Products?depPid={did}' for did in departamentos ]
+        listados = list(POOL_RASTREO.map(descargar_productos_rastreo, urls))
+        if not departamentos or any(productos is None for productos in listados):
+            contar_estadistica(ESTADISTICAS_RASTREO, 'fallidas')
+            debug_print(f'No se pudo rastrear la tienda {tid}', 'error')
+            return
+
+        disponibles = {}
+        por_departamento = {}
+        for did, productos in zip(departamentos, listados):
+            por_departamento[did] = [ pid for nombre, precio, plink, pid in productos ]
+            for nombre, precio, plink, pid in productos:
+                if pid not in disponibles:
+                    disponibles[pid] = Disponible(pid, nombre, precio, plink, texto_para_rastreo(nombre), ahora)
+            indexar_productos(productos)
+        with LOCK_DISPONIBILIDAD:
+            DISPONIBILIDAD[tid] = {
+                'fecha': ahora,
+                'duracion': time.monotonic() - inicio,
+                'productos': disponibles,
+                'departamentos': por_departamento,
+            }
+        contar_estadistica(ESTADISTICAS_RASTREO, 'tiendas')
+    except Exception as ex:
+        contar_estadistica(ESTADISTICAS_RASTREO, 'fallidas')
+        debug_print(f'rastrear_tienda {tid}: {ex}', 'error')
+
+
+def rastrear_catalogo(context):
+    debug_print('Rastreando el catálogo de todas las tiendas')
+    for tid in obtener_todas_las_tiendas():
+        rastrear_tienda(tid)
+    contar_estadistica(ESTADISTICAS_RASTREO, 'recorridos')
+
+
+# Retorna la lista de (pid, nombre, precio, enlace) de la tienda según la foto del
+# catálogo, o None si no hay foto de la tienda o tiene más de ttl segundos
+def buscar_en_disponibilidad(mensaje, tid, did, ttl):
+    with LOCK_DISPONIBILIDAD:
+        foto = DISPONIBILIDAD.get(tid)
+    if not foto or (datetime.datetime.now() - foto['fecha']).total_seconds() > ttl:
+        return None
+
+    if did == '0':
+        texto = texto_para_rastreo(mensaje)
+        if not texto:
+            return None
+        encontrados = [ p for p in foto['productos'].values() if texto in p.texto ]
+    else:
+        if did not in foto['departamentos']:
+            return None
+        encontrados = [ foto['productos'][pid] for pid in foto['departamentos'][did] ]
+    contar_estadistica(ESTADISTICAS_RASTREO, 'aciertos')
+    return [ (p.pid, p.nombre, p.precio, p.enlace) for p in encontrados ]
+
+
+# Retorna por cada tienda (nombre, edad de la foto, duración del recorrido, productos)
+def estadisticas_disponibilidad():
+    ahora = datetime.datetime.now()
+    with LOCK_DISPONIBILIDAD:
+        fotos = list(DISPONIBILIDAD.items())
+    return [ (obtener_nombre_tienda(tid) or tid, (ahora - foto['fecha']).total_seconds(),
+              foto['duracion'], len(foto['productos'])) for tid, foto in fotos ]
+
+
+# Muestra a los administradores la edad de la foto de cada tienda
+def estado_rastreo(update, context):
+    try:
+        idchat = update.effective_chat.id
+        if idchat in SUPER_ADMINS:
+            fotos = estadisticas_disponibilidad()
+            if fotos:
+                texto_respuesta = '<b>Rastreo del catálogo</b>\n\n'
+                for nombre, edad, duracion, productos in sorted(fotos):
+                    texto_respuesta += f'🏬 {nombre}: hace {edad:.0f} s, recorrida en {duracion:.1f} s, {productos} productos\n'
+            else:
+                texto_respuesta = 'Aún no se ha rastreado ninguna tienda.'
+            context.bot.send_message(chat_id=idchat,
+                                     text=texto_respuesta,
+                                     parse_mode='HTML')
+    except Exception as ex:
+        debug_print(f'estado_rastreo: {ex}', 'error')
+
+
+dispatcher.add_handler(CommandHandler('rastreo', en_orden_por_chat(estado_rastreo)))
+
+
 # Reduce el credito en monto al usuario
 def deducir_credito_usuario(context, uid, monto = 1):
-    conn, cursor = inicializar_bd()
-    ahora = datetime.datetime.now()
-    debug_print(f'Deduciendo {monto} crédito al usuario {uid}')
-    cursor.execute('''UPDATE usuario SET credito = credito - %s WHERE uid = %s and credito > 0''', (monto, uid))
-    cursor.execute('''INSERT INTO operacion_credito(uid, descripcion, tipo, monto, fecha) VALUES(%s, %s, %s, %s, %s)''',
-                    (uid, 'Deducción por búsqueda', 'débito', monto, ahora))
-    conn.commit()    
-    conn.close()
-    if obtener_credito_usuario(uid) == 0:
-        context.bot.send_message(chat_id=uid, 
-                                 text='Su crédito se ha agotado, por favor, recargue 👍.',
-                                 parse_mode='HTML')
+    # Durante un mensaje el débito se guarda al terminar, junto con los demás
+    sesion = sesion_actual(uid)
+    if sesion:
+        sesion['credito'] = max(sesion['credito'] - monto, 0)
+        sesion['debitos'].append(monto)
+        return
+    if debitar_credito(uid, [monto]) == 0:
+        enviar_mensaje(uid, 'Su crédito se ha agotado, por favor, recargue 👍.', PRIORIDAD_RESPUESTA, parse_mode='HTML')
         debug_print(f'Agotado el crédito del usuario {uid}')
 
 
 
-def esta_en_turno_de_escaneo(uid, criterio, prov_id):
+# Búsquedas programadas de las subscripciones
+# Cada grupo (criterio, provincia) se busca una sola vez cuando le toca a alguno de sus
+# subscritos, el crédito y el nombre de los usuarios se leen en una consulta y todas
+# las deducciones de crédito y fechas de último escaneo se guardan en una transacción
+# antes de enviar las notificaciones.
+ESTADISTICAS_ESCANEO = {
+    'ciclos': 0,
+    'grupos': 0,
+    'busquedas': 0,
+    'notificados': 0,
+    'mensajes': 0,
+    'productos_notificados': 0,
+    'productos_repetidos': 0,
+    'paginas_rastreadas': 0,
+    'segundos': 0.0,
+    'ultimo_ciclo': 0.0,
+}
+
+
+# Productos de la lista que la subscripción no ha visto o que cambiaron de precio
+# Retorna tuplas (producto, precio, enlace, pid, precio anterior o None)
+def productos_nuevos(subscripcion, productos):
+    nuevos = []
+    for producto, precio, plink, pid in productos:
+        anterior = subscripcion['vistos'].get(pid)
+        if anterior != precio:
+            nuevos.append( (producto, precio, plink, pid, anterior) )
+    return nuevos
+
+
+# Lo visto por cada subscripción se guarda en la tabla subscripcion_vistos como JSON
+# {pid: precio}, para no notificar de nuevo todo el listado al reiniciar el bot
+def crear_tabla_subscripcion_vistos(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS subscripcion_vistos ( \
+                          sid INT NOT NULL PRIMARY KEY, \
+                          vistos MEDIUMTEXT NOT NULL)''')
+
+
+# vistos: sid -> {pid: precio}
+def guardar_vistos_subscripciones(vistos):
     try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT ultimo_escaneo, frecuencia FROM subscripcion WHERE uid=%s and criterio=%s and prov_id=%s''',
-                        (uid, criterio, prov_id))
-        (ultimo_escaneo, frecuencia) = cursor.fetchone()
-        conn.close()
-        ttrans = (datetime.datetime.now() - ultimo_escaneo).total_seconds()
-        return ttrans >= frecuencia
+        with conexion_bd() as (conn, cursor):
+            cursor.executemany('''INSERT INTO subscripcion_vistos(sid, vistos) VALUES(%s, %s) \
+                                  ON DUPLICATE KEY UPDATE vistos = VALUES(vistos)''',
+                               [ (sid, json.dumps(productos)) for sid, productos in vistos.items() ])
+            conn.commit()
     except Exception as ex:
-        debug_print(f'esta_en_turno_de_escaneo: {ex}', 'error')
+        debug_print(f'guardar_vistos_subscripciones: {ex}', 'error')
+
+
+# Resumen de notificaciones para los administradores, se envía cada DIGESTO_INTERVALO
+LOCK_DIGESTO = threading.Lock()
+DIGESTO_ADMINS = []
+
+
+def agregar_al_digesto(texto):
+    with LOCK_DIGESTO:
+        DIGESTO_ADMINS.append(texto)
+
+
+def enviar_digesto_admins(context):
+    with LOCK_DIGESTO:
+        lineas = list(DIGESTO_ADMINS)
+        DIGESTO_ADMINS.clear()
+    if not lineas:
+        return
+    # Los mensajes de Telegram no pueden pasar de 4096 caracteres
+    mensajes = [f'<b>Resumen de notificaciones ({len(lineas)})</b>\n']
+    for linea in lineas:
+        if len(mensajes[-1]) + len(linea) + 1 > 4000:
+            mensajes.append('')
+        mensajes[-1] += f'\n{linea}'
+    for admin in SUPER_ADMINS:
+        for texto in mensajes:
+            enviar_mensaje(admin, texto, PRIORIDAD_RESUMEN, parse_mode='HTML')
+
+
+# Retorna uid -> {'credito', 'nombre'} para los usuarios indicados
+def obtener_usuarios_subscritos(uids):
+    usuarios = { uid: {'credito': 0.0, 'nombre': 'Desconocido'} for uid in uids }
+    if uids:
+        marcadores = ', '.join(['%s'] * len(uids))
+        with conexion_bd() as (conn, cursor):
+            cursor.execute(f'''SELECT uid, credito, nombre FROM usuario WHERE uid IN ({marcadores})''', tuple(uids))
+            for uid, credito, nombre in cursor:
+                usuarios[uid] = {
+                    'credito': float(credito or 0),
+                    'nombre': nombre or 'Desconocido',
+                }
+                guardar_credito_en_cache(uid, credito)
+    return usuarios
+
+
+# Guarda en una transacción lo cobrado y escaneado en un ciclo, con un débito por
+# usuario, y actualiza en memoria los saldos que quedaron
+# deducciones: lista de (uid, monto), escaneos: lista de sid
+def registrar_escaneos(deducciones, escaneos, ahora):
+    montos = Counter()
+    for uid, monto in deducciones:
+        montos[uid] += monto
+    marcadores = ', '.join(['%s'] * len(montos))
+    with conexion_bd() as (conn, cursor):
+        cursor.executemany('''UPDATE usuario SET credito = GREATEST(credito - %s, 0) WHERE uid = %s and credito > 0''',
+                           [ (monto, uid) for uid, monto in montos.items() ])
+        cursor.executemany('''INSERT INTO operacion_credito(uid, descripcion, tipo, monto, fecha) VALUES(%s, %s, %s, %s, %s)''',
+                           [ (uid, 'Deducción por búsqueda', 'débito', monto, ahora) for uid, monto in deducciones ])
+        cursor.executemany('''UPDATE subscripcion SET ultimo_escaneo = %s WHERE sid = %s''',
+                           [ (ahora, sid) for sid in escaneos ])
+        cursor.execute(f'''SELECT uid, credito FROM usuario WHERE uid IN ({marcadores})''', tuple(montos))
+        saldos = cursor.fetchall()
+        conn.commit()
+    contar_estadistica(ESTADISTICAS_CREDITOS, 'debitos', len(montos))
+    for uid, credito in saldos:
+        guardar_credito_en_cache(uid, credito)
 
 
-def actualizar_ultimo_escaneo(uid, criterio, prov_id):
-    conn, cursor = inicializar_bd()
-    debug_print(f'Actualizando último escaneo para {uid}')
+# Escanea los grupos (criterio, prov_id) indicados por el planificador
+def notificar_subscritos(claves):
+    inicio = time.perf_counter()
     ahora = datetime.datetime.now()
-    cursor.execute('''UPDATE subscripcion SET ultimo_escaneo = %s WHERE uid = %s and criterio = %s and prov_id = %s''', 
-                    (ahora, uid, criterio, prov_id))
-    conn.commit()
-    conn.close()
-
-
-# A partir de la lista de ID de usuarios separada por coma retorna aquellos 
-# a los que se les puede efectuar la busqueda
-def obtener_usuarios_listos_para_escaneo(uids, criterio, prov_id):
-    listos = []
-    for uid in uids.split(','):
-        if obtener_credito_usuario(uid) > 0 and esta_en_turno_de_escaneo(uid, criterio, prov_id):
-            listos.append(uid)
-    return listos
-
-
-def obtener_nombre_usuario(uid):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT nombre FROM usuario WHERE uid=%s''', (uid, ))
-    result = cursor.fetchone()
-    if result:
-        return result[0]
-    conn.close() 
-    return 'Desconocido'
+    with COND_PLANIFICADOR:
+        grupos = { clave: list(GRUPOS_PROGRAMADOS.get(clave, {}).values()) for clave in claves }
+    usuarios = obtener_usuarios_subscritos({ subscripcion['uid'] for subscripciones in grupos.values()
+                                             for subscripcion in subscripciones })
+
+    # Crédito de cada usuario según se va cobrando en este ciclo
+    saldos = { uid: usuario['credito'] for uid, usuario in usuarios.items() }
+
+    # En modo departamentos cada provincia se recorre una sola vez en el ciclo, buscando
+    # a la vez los criterios de todos sus grupos
+    rastreos = {}
+
+    def buscar_productos_grupo(criterio, prov_id):
+        if ESCANEO_MODO != 'departamentos':
+            return hay_productos_en_provincia(criterio, prov_id)
+        if prov_id not in rastreos:
+            # Si el recorrido falla no se repite para los demás grupos de la provincia
+            rastreos[prov_id] = {}
+            criterios = { criterio_grupo for criterio_grupo, prov_grupo in grupos if prov_grupo == prov_id }
+            rastreos[prov_id] = rastrear_departamentos_provincia(prov_id, criterios)
+        return rastreos[prov_id].get(criterio, False)
+
+    deducciones = []
+    escaneos = []
+    encontrados = []
+    for (criterio, prov_id), subscripciones in grupos.items():
+        nombre_provincia = obtener_nombre_provincia(prov_id)
+        listos = [ subscripcion for subscripcion in subscripciones
+                   if saldos[subscripcion['uid']] > 0 and proximo_escaneo(subscripcion) <= ahora ]
+        if not listos:
+            debug_print(f'Procesados todos los usuarios subscritos a {criterio} en {nombre_provincia}.')
+            continue
+
+        # El costo de la búsqueda se reparte entre los usuarios en turno
+        debug_print(f'Ejecutando búsqueda programada de {criterio} en {nombre_provincia} para {len(listos)} usuarios')
+        monto = 1 / len(listos)
+        for subscripcion in listos:
+            saldos[subscripcion['uid']] -= monto
+            deducciones.append( (subscripcion['uid'], monto) )
+            escaneos.append(subscripcion['sid'])
+
+        productos = resumen = False
+        try:
+            encontrado = buscar_productos_grupo(criterio, prov_id)
+            if encontrado:
+                productos, resumen = encontrado
+        except ConnectionResetError:
+            debug_print('Error de conexión al localizar productos para notificar', 'error')
+        except Exception as ex:
+            debug_print(f'Error desconocido al localizar productos para notificar, se obtuvo {ex}', 'error')
+        contar_estadistica(ESTADISTICAS_ESCANEO, 'busquedas')
+        if productos:
+            encontrados.append( (criterio, nombre_provincia, subscripciones, listos, productos, resumen) )
+
+    if deducciones:
+        registrar_escaneos(deducciones, escaneos, ahora)
+        with COND_PLANIFICADOR:
+            for sid in escaneos:
+                clave = GRUPO_DE_SUBSCRIPCION.get(sid)
+                if clave:
+                    GRUPOS_PROGRAMADOS[clave][sid]['ultimo_escaneo'] = ahora
+
+    for uid in { uid for uid, monto in deducciones }:
+        if saldos[uid] <= 0:
+            enviar_mensaje(uid, 'Su crédito se ha agotado, por favor, recargue 👍.', parse_mode='HTML')
+            contar_estadistica(ESTADISTICAS_ESCANEO, 'mensajes')
+            debug_print(f'Agotado el crédito del usuario {uid}')
+
+    vistos_cambiados = {}
+    for criterio, nombre_provincia, subscripciones, listos, productos, resumen in encontrados:
+        for subscripcion in subscripciones:
+            uid = subscripcion['uid']
+            # No se repite la notificación si el listado es el mismo que ya se le envió
+            if subscripcion['huella'] == resumen:
+                contar_estadistica(ESTADISTICAS_HUELLAS, 'notificaciones_evitadas')
+                continue
+            # Solo se notifican los productos nuevos o con otro precio
+            nuevos = productos_nuevos(subscripcion, productos)
+            contar_estadistica(ESTADISTICAS_ESCANEO, 'productos_repetidos', len(productos) - len(nuevos))
+            if not nuevos:
+                # Los que se agotaron salen de lo visto, para notificarlos si vuelven
+                subscripcion['vistos'] = { pid: precio for producto, precio, plink, pid in productos }
+                subscripcion['huella'] = resumen
+                vistos_cambiados[subscripcion['sid']] = subscripcion['vistos']
+                contar_estadistica(ESTADISTICAS_HUELLAS, 'notificaciones_evitadas')
+                continue
+            # Los que pagaron esta búsqueda siempre reciben el resultado
+            if subscripcion in listos or saldos[uid] > 0:
+                texto_respuesta = f'Atención: Se encontró <b>{criterio}</b> en <b>{nombre_provincia}</b>.\n\n'
+                i = 1
+                for producto, precio, plink, pid, anterior in nuevos:
+                    cambio = f' (antes {anterior})' if anterior is not None else ''
+                    texto_respuesta += f'{i}. 📦 {producto} --> {precio}{cambio} <a href="{plink}">ver producto</a>\n'
+                    i += 1
+                enviar_mensaje(uid, texto_respuesta, parse_mode='HTML')
+                # Lo visto es el listado actual, si un producto se agota y vuelve se notifica otra vez
+                subscripcion['vistos'] = { pid: precio for producto, precio, plink, pid in productos }
+                subscripcion['huella'] = resumen
+                vistos_cambiados[subscripcion['sid']] = subscripcion['vistos']
+                contar_estadistica(ESTADISTICAS_ESCANEO, 'notificados')
+                contar_estadistica(ESTADISTICAS_ESCANEO, 'mensajes')
+                contar_estadistica(ESTADISTICAS_ESCANEO, 'productos_notificados', len(nuevos))
+                texto_debug_info = f'Notificado {uid} ({usuarios[uid]["nombre"]}) sobre criterio {criterio} en {nombre_provincia}'
+                debug_print(texto_debug_info, 'estado')
+                agregar_al_digesto(f'{texto_debug_info}: {len(nuevos)} productos')
+            else:
+                enviar_mensaje(uid, 'Su crédito de operaciones se ha agotado, por favor, envíe cualquier donación '
+                                    'para continuar usando los servicios de búsqueda y subscripción.',
+                               parse_mode='HTML')
+                contar_estadistica(ESTADISTICAS_ESCANEO, 'mensajes')
+            # Activar esta llamada segun ajuste del sistema, para que se elimine la subscripcion
+            # una vez encontrado el criterio
+            #desactivar_notificacion(uid, criterio, prov_id)
+
+    if vistos_cambiados:
+        guardar_vistos_subscripciones(vistos_cambiados)
+
+    segundos = time.perf_counter() - inicio
+    contar_estadistica(ESTADISTICAS_ESCANEO, 'ciclos')
+    contar_estadistica(ESTADISTICAS_ESCANEO, 'grupos', len(grupos))
+    contar_estadistica(ESTADISTICAS_ESCANEO, 'segundos', segundos)
+    with LOCK_ESTADISTICAS:
+        ESTADISTICAS_ESCANEO['ultimo_ciclo'] = segundos
+    debug_print(f'Ciclo de subscripciones: {len(grupos)} grupos, {len(escaneos)} escaneos en {segundos:.2f} s')
+
+
+# Planificador de las búsquedas programadas
+# Las subscripciones activas se mantienen en memoria agrupadas por (criterio, prov_id).
+# Cada grupo tiene una entrada en un montículo con la fecha de su próximo escaneo
+# (el menor ultimo_escaneo + frecuencia de sus subscripciones) y el hilo planificador
+# duerme hasta que vence la primera. Las altas, bajas y activaciones de subscripciones
+# actualizan el montículo en el momento, sin consultar la BD en cada ciclo.
+COND_PLANIFICADOR = threading.Condition()
+GRUPOS_PROGRAMADOS = {}       # (criterio, prov_id) -> {sid: subscripcion}
+GRUPO_DE_SUBSCRIPCION = {}    # sid -> (criterio, prov_id)
+PROXIMO_ESCANEO = {}          # (criterio, prov_id) -> fecha de su entrada vigente en el montículo
+MONTICULO_ESCANEOS = []       # (fecha, (criterio, prov_id)), las entradas que no son vigentes se ignoran
+
+
+# Si el usuario no tenía crédito cuando le tocaba se vuelve a intentar en reintento
+def proximo_escaneo(subscripcion):
+    proximo = subscripcion['ultimo_escaneo'] + datetime.timedelta(seconds=subscripcion['frecuencia'])
+    if subscripcion['reintento'] and subscripcion['reintento'] > proximo:
+        return subscripcion['reintento']
+    return proximo
+
+
+# Debe llamarse con COND_PLANIFICADOR adquirido
+def reprogramar_grupo(clave):
+    subscripciones = GRUPOS_PROGRAMADOS.get(clave)
+    if not subscripciones:
+        GRUPOS_PROGRAMADOS.pop(clave, None)
+        PROXIMO_ESCANEO.pop(clave, None)
+        return
+    proximo = min(proximo_escaneo(subscripcion) for subscripcion in subscripciones.values())
+    if PROXIMO_ESCANEO.get(clave) != proximo:
+        PROXIMO_ESCANEO[clave] = proximo
+        heapq.heappush(MONTICULO_ESCANEOS, (proximo, clave))
+        COND_PLANIFICADOR.notify()
+
+
+# vistos: el JSON guardado en subscripcion_vistos, si lo hay
+def programar_subscripcion(sid, uid, criterio, prov_id, ultimo_escaneo, frecuencia, fecha, vistos=None):
+    with COND_PLANIFICADOR:
+        clave = (criterio, prov_id)
+        GRUPOS_PROGRAMADOS.setdefault(clave, {})[sid] = {
+            'sid': sid,
+            'uid': uid,
+            'ultimo_escaneo': ultimo_escaneo or fecha,
+            'frecuencia': frecuencia,
+            'fecha': fecha,
+            'reintento': None,
+            'huella': None,
+            'vistos': json.loads(vistos) if vistos else {},
+        }
+        GRUPO_DE_SUBSCRIPCION[sid] = clave
+        reprogramar_grupo(clave)
 
 
-def notificar_subscritos(context):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT criterio, prov_id, group_concat(uid) as uids FROM subscripcion WHERE estado=%s group by criterio asc, prov_id''', ('activa', ))
-    for (criterio, prov_id, uids) in cursor:
-        nombre_provincia = obtener_nombre_provincia(prov_id)
-        busqueda_realizada = productos = alguien_tiene_credito = False
-        listos = obtener_usuarios_listos_para_escaneo(uids, criterio, prov_id)
-        for uid in listos:
-            debug_print(f'Ejecutando búsqueda programada de {criterio} para {uid}')
-            deducir_credito_usuario(context, uid, 1 / len(listos))
-            actualizar_ultimo_escaneo(uid, criterio, prov_id)
-            alguien_tiene_credito = True
-            # Si no ha sido obtenido para otro usuario buscarlo
-            if not busqueda_realizada:     
-                try:      
-                    productos = hay_productos_en_provincia(criterio, prov_id)
-                except ConnectionResetError:
-                    debug_print('Error de conexión al localizar productos para notificar', 'error')
-                except Exception as ex:
-                    debug_print(f'Error desconocido al localizar productos para notificar, se obtuvo {ex}', 'error')
-                busqueda_realizada = True      
-            if productos:
-                for uid in uids.split(','):
-                    if obtener_credito_usuario(uid) > 0:
-                        texto_respuesta = f'Atención: Se encontró <b>{criterio}</b> en <b>{nombre_provincia}</b>.\n\n'
-                        i = 1
-                        for producto, precio, plink, pid in productos:
-                            texto_respuesta += f'{i}. 📦 {producto} --> {precio} <a href="{plink}">ver producto</a>\n'
-                            i += 1          
-                        context.bot.send_message(chat_id=uid, text=texto_respuesta, parse_mode='HTML')
-                        nombre_usuario = obtener_nombre_usuario(uid)
-                        texto_debug_info = f'Notificado {uid} ({nombre_usuario}) sobre criterio {criterio} en {nombre_provincia}'
-                        debug_print(texto_debug_info, 'estado')
-                        # Temporal para informar que alguien encontró producto como subscrito
-                        for admin in SUPER_ADMINS:
-                            context.bot.send_message(chat_id=admin, text=texto_debug_info, parse_mode='HTML')
-                    else:
-                        context.bot.send_message(chat_id=uid,
-                                                 text=f'Su crédito de operaciones se ha agotado, por favor, envíe cualquier donación para continuar usando los servicios de búsqueda y subscripción.', 
-                                                 parse_mode='HTML')
-                    # Activar esta llamada segun ajuste del sistema, para que se elimine la subscripcion
-                    # una vez encontrado el criterio
-                    #desactivar_notificacion(uid, criterio, prov_id)
+def desprogramar_subscripciones(sids):
+    with COND_PLANIFICADOR:
+        claves = set()
+        for sid in sids:
+            clave = GRUPO_DE_SUBSCRIPCION.pop(sid, None)
+            if clave:
+                del GRUPOS_PROGRAMADOS[clave][sid]
+                claves.add(clave)
+        for clave in claves:
+            reprogramar_grupo(clave)
 
+
+# Retorna los sid programados que cumplen la condición
+def buscar_subscripciones_programadas(condicion):
+    with COND_PLANIFICADOR:
+        return [ sid for subscripciones in GRUPOS_PROGRAMADOS.values()
+                 for sid, subscripcion in subscripciones.items() if condicion(subscripcion) ]
+
+
+def desprogramar_subscripciones_usuario(uid, criterio=None, prov_id=None):
+    with COND_PLANIFICADOR:
+        if criterio is None:
+            sids = buscar_subscripciones_programadas(lambda subscripcion: str(subscripcion['uid']) == str(uid))
+        else:
+            sids = [ sid for sid, subscripcion in GRUPOS_PROGRAMADOS.get((criterio, prov_id), {}).items()
+                     if str(subscripcion['uid']) == str(uid) ]
+        desprogramar_subscripciones(sids)
+
+
+# Al recibir crédito las subscripciones del usuario vuelven a su turno normal
+def reactivar_subscripciones_usuario(uid):
+    with COND_PLANIFICADOR:
+        for clave, subscripciones in GRUPOS_PROGRAMADOS.items():
+            cambios = False
+            for subscripcion in subscripciones.values():
+                if str(subscripcion['uid']) == str(uid) and subscripcion['reintento']:
+                    subscripcion['reintento'] = None
+                    cambios = True
+            if cambios:
+                reprogramar_grupo(clave)
+
+
+# Carga las subscripciones activas, todas o solo la indicada
+def cargar_subscripciones_programadas(sid=None):
+    columnas = '''subscripcion.sid, uid, criterio, prov_id, ultimo_escaneo, frecuencia, fecha, vistos \
+                  FROM subscripcion LEFT JOIN subscripcion_vistos ON subscripcion_vistos.sid = subscripcion.sid'''
+    with conexion_bd() as (conn, cursor):
+        crear_tabla_subscripcion_vistos(cursor)
+        if sid is None:
+            cursor.execute(f'''SELECT {columnas} WHERE estado=%s''', ('activa', ))
         else:
-            if not alguien_tiene_credito:
-                debug_print(f'Procesados todos los usuarios subscritos a {criterio} en {nombre_provincia}.')
-    conn.close()
+            cursor.execute(f'''SELECT {columnas} WHERE estado=%s and subscripcion.sid=%s''', ('activa', sid))
+        subscripciones = cursor.fetchall()
+    for subscripcion in subscripciones:
+        programar_subscripcion(*subscripcion)
+
+
+# Espera hasta que venza al menos un grupo y retorna las claves de los vencidos
+def esperar_grupos_vencidos():
+    with COND_PLANIFICADOR:
+        while True:
+            while MONTICULO_ESCANEOS and PROXIMO_ESCANEO.get(MONTICULO_ESCANEOS[0][1]) != MONTICULO_ESCANEOS[0][0]:
+                heapq.heappop(MONTICULO_ESCANEOS)
+            if not MONTICULO_ESCANEOS:
+                COND_PLANIFICADOR.wait()
+                continue
+            espera = (MONTICULO_ESCANEOS[0][0] - datetime.datetime.now()).total_seconds()
+            if espera > 0:
+                COND_PLANIFICADOR.wait(espera)
+                continue
+
+            ahora = datetime.datetime.now()
+            claves = []
+            while MONTICULO_ESCANEOS and MONTICULO_ESCANEOS[0][0] <= ahora:
+                proximo, clave = heapq.heappop(MONTICULO_ESCANEOS)
+                if PROXIMO_ESCANEO.get(clave) == proximo:
+                    del PROXIMO_ESCANEO[clave]
+                    claves.append(clave)
+            return claves
+
+
+def planificador_escaneos():
+    while True:
+        claves = esperar_grupos_vencidos()
+        try:
+            notificar_subscritos(claves)
+        except Exception as ex:
+            debug_print(f'planificador_escaneos: {ex}', 'error')
+        finally:
+            # Las subscripciones que siguen en turno (sin crédito o con error) se
+            # reintentan cuando pase de nuevo su frecuencia
+            ahora = datetime.datetime.now()
+            with COND_PLANIFICADOR:
+                for clave in claves:
+                    for subscripcion in GRUPOS_PROGRAMADOS.get(clave, {}).values():
+                        if proximo_escaneo(subscripcion) <= ahora:
+                            subscripcion['reintento'] = ahora + datetime.timedelta(seconds=subscripcion['frecuencia'])
+                    reprogramar_grupo(clave)
+
+
+HILO_PLANIFICADOR = threading.Thread(target=planificador_escaneos, name='planificador_escaneos', daemon=True)
+
+
+def iniciar_planificador_escaneos():
+    cargar_subscripciones_programadas()
+    HILO_PLANIFICADOR.start()
+
+
+def estadisticas_planificador():
+    with COND_PLANIFICADOR:
+        proximo = min(PROXIMO_ESCANEO.values(), default=None)
+        return {
+            'subscripciones': len(GRUPO_DE_SUBSCRIPCION),
+            'grupos': len(GRUPOS_PROGRAMADOS),
+            'proximo': max(0, (proximo - datetime.datetime.now()).total_seconds()) if proximo else None,
+        }
 
 
 def obtener_producto_segun_pid(pid):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT nombre, precio, enlace FROM producto WHERE pid=%s''', (pid, ))
-    result = cursor.fetchone()
-    conn.close()
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''SELECT nombre, precio, enlace FROM producto WHERE pid=%s''', (pid, ))
+        result = cursor.fetchone()
     return( pid, result[0], result[1], result[2] )
 
 
-def obtener_productos_resultado_busqueda(bid):
+# Productos de una o varias búsquedas en una sola consulta
+# Retorna bid -> lista de tuplas (pid, nombre, precio, enlace)
+def obtener_productos_resultados_busqueda(bids):
     try:
-        conn, cursor = inicializar_bd()
-        productos = []
-        cursor.execute('''SELECT pid FROM busqueda JOIN resultado WHERE busqueda.bid = resultado.bid \
-                            and busqueda.bid=%s''', (bid, ))
-        for (pid, ) in cursor:
-            productos.append(obtener_producto_segun_pid(pid))
+        productos = { bid: [] for bid in bids }
+        if bids:
+            marcadores = ', '.join(['%s'] * len(bids))
+            with conexion_bd() as (conn, cursor):
+                cursor.execute(f'''SELECT resultado.bid, producto.pid, producto.nombre, producto.precio, producto.enlace \
+                                   FROM resultado JOIN producto ON producto.pid = resultado.pid \
+                                   WHERE resultado.bid IN ({marcadores})''', tuple(bids))
+                for bid, pid, nombre, precio, enlace in cursor:
+                    productos[bid].append( (pid, nombre, precio, enlace) )
 
-        conn.close()
         return productos
     except Exception as ex:
-        print('obtener_productos_resultado_busqueda', ex)                                  
+        print('obtener_productos_resultados_busqueda', ex)
+
 
 
 # Buscar los productos en la provincia seleccionada
@@ -1610,18 +3550,15 @@ def enviar_mensaje_productos_encontrados(update, context, palabras=False, dep=Fa
             if not palabras:
                 palabras = update.message.text
             bid_results = obtener_soup(palabras, nombre, idchat)
-        conn, cursor = inicializar_bd()    
-        for bid, tienda, en_cache in bid_results:
+        for bid, tienda, en_cache, productos in bid_results:
             if not en_cache:  
                 deducir_credito_usuario(context, idchat)       
             nombre_provincia = obtener_nombre_provincia(prov)
             nombre_tienda = obtener_nombre_tienda(tienda)
             
-            productos = obtener_productos_resultado_busqueda(bid)
             texto_respuesta_tid = ''
             if productos:
                 for pid, producto, precio, plink in productos:
-                    dispatcher.add_handler( CommandHandler(f'subscribirse_a_{pid}', sub_a), 1)                       
                     texto_respuesta_tid += f'📦{producto} --> {precio} <a href="{plink}">ver producto</a> o /subscribirse_a_{pid}\n'
                 if dep:
                     nombre_dep = obtener_nombre_departamento(did)                
@@ -1646,17 +3583,7 @@ def enviar_mensaje_productos_encontrados(update, context, palabras=False, dep=Fa
 
 
 def es_comando_valido(comando):
-    comandos_validos = [
-        '/subscribirse_a_',
-        '/eliminar_',
-        '/credito_',
-        '/cambiar_frec_',
-        '/activar_'
-    ]
-    for com_val in comandos_validos:
-        if comando.startswith(com_val):
-            return True
-    return False
+    return separar_comando_con_id(comando) is not None
 
 
 # No procesar comandos incorrectos
@@ -1667,15 +3594,17 @@ def desconocido(update, context):
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=texto_respuesta)
 
-dispatcher.add_handler(MessageHandler(Filters.command, desconocido))
+dispatcher.add_handler(MessageHandler(Filters.command, en_orden_por_chat(desconocido)))
 
 
 def existe_registro_usuario(idchat):
     try:
-        conn, cursor = inicializar_bd()
-        cursor.execute('''SELECT * FROM usuario WHERE uid=%s''', (idchat, ))
-        result = len(cursor.fetchall())
-        cursor.close()
+        sesion = sesion_actual(idchat)
+        if sesion:
+            return sesion['registrado']
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT * FROM usuario WHERE uid=%s''', (idchat, ))
+            result = len(cursor.fetchall())
         return result
     except Exception as ex:
         print('existe_registro_usuario', ex)
@@ -1683,11 +3612,11 @@ def existe_registro_usuario(idchat):
 
 def registrar_usuario(update, context):
     try:
-        conn, cursor = inicializar_bd()
         idchat = update.effective_chat.id
         nombre = update.effective_user.username
-        cursor.execute('''INSERT INTO usuario(uid, nombre) VALUES(%s, %s)''', (idchat, nombre))
-        conn.commit()
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''INSERT INTO usuario(uid, nombre) VALUES(%s, %s)''', (idchat, nombre))
+            conn.commit()
     except Exception as ex:
         print('registrar_usuario', ex)
 
@@ -1747,13 +3676,182 @@ def registrar_usuario(update, context):
     # 4. Enviar el mensaje con la respuesta
 
 
+# Índice invertido de los nombres de productos para el listado de "📦 Productos"
+# Cada palabra (sin tildes y en minúsculas) apunta a los pid que la contienen y a la
+# lista de esos productos ordenada como se muestran: (largo del nombre, nombre, pid). Se
+# guarda también una lista ordenada de las palabras para buscar por prefijo. Se carga de
+# la tabla producto en segundo plano al arrancar y se actualiza con cada búsqueda guardada.
+# Mientras no termine de cargarse se sigue usando el LIKE sobre la tabla.
+LOCK_INDICE_PRODUCTOS = threading.Lock()
+INDICE_PRODUCTOS = {}           # palabra -> set de pid
+ENTRADAS_INDICE = {}            # palabra -> lista ordenada de (largo del nombre, nombre, pid)
+PALABRAS_INDICE = []            # palabras del índice ordenadas
+PRODUCTOS_INDEXADOS = {}        # pid -> (nombre, precio, palabras)
+INDICE_CARGADO = threading.Event()
+ESTADISTICAS_INDICE = {
+    'consultas': 0,
+    'segundos': 0.0,
+}
+
+
+def normalizar_texto(texto):
+    texto = unicodedata.normalize('NFKD', str(texto).lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+def palabras_de(texto):
+    return re.findall(r'\w+', normalizar_texto(texto))
+
+
+# Debe llamarse con LOCK_INDICE_PRODUCTOS adquirido
+def indexar_producto(pid, nombre, precio):
+    pid = str(pid)
+    anterior = PRODUCTOS_INDEXADOS.get(pid)
+    if anterior and anterior[0] == nombre:
+        # Solo cambió el precio: el producto sigue en el mismo lugar de cada lista
+        PRODUCTOS_INDEXADOS[pid] = (nombre, precio, anterior[2])
+        return
+    palabras = frozenset(palabras_de(nombre))
+    if anterior:
+        entrada = (len(anterior[0]), anterior[0], pid)
+        for palabra in anterior[2]:
+            entradas = ENTRADAS_INDICE[palabra]
+            del entradas[bisect.bisect_left(entradas, entrada)]
+            INDICE_PRODUCTOS[palabra].discard(pid)
+            if not entradas:
+                del INDICE_PRODUCTOS[palabra]
+                del ENTRADAS_INDICE[palabra]
+                del PALABRAS_INDICE[bisect.bisect_left(PALABRAS_INDICE, palabra)]
+    entrada = (len(nombre), nombre, pid)
+    for palabra in palabras:
+        if palabra not in INDICE_PRODUCTOS:
+            INDICE_PRODUCTOS[palabra] = set()
+            ENTRADAS_INDICE[palabra] = []
+            bisect.insort(PALABRAS_INDICE, palabra)
+        INDICE_PRODUCTOS[palabra].add(pid)
+        bisect.insort(ENTRADAS_INDICE[palabra], entrada)
+    PRODUCTOS_INDEXADOS[pid] = (nombre, precio, palabras)
+
+
+# productos: lista de tuplas (nombre, precio, enlace, pid) como las de parsear_productos
+def indexar_productos(productos):
+    with LOCK_INDICE_PRODUCTOS:
+        for nombre, precio, plink, pid in productos:
+            indexar_producto(pid, nombre, precio)
+
+
+def cargar_indice_productos():
+    try:
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT pid, nombre, precio FROM producto''')
+            for pid, nombre, precio in cursor:
+                with LOCK_INDICE_PRODUCTOS:
+                    indexar_producto(pid, nombre, precio)
+        INDICE_CARGADO.set()
+        debug_print(f'Índice de productos cargado: {len(PRODUCTOS_INDEXADOS)} productos')
+    except Exception as ex:
+        debug_print(f'cargar_indice_productos: {ex}', 'error')
+
+
+# Palabras del índice que comienzan con buscada. Las palabras más cortas que
+# INDICE_PREFIJO_MINIMO solo se buscan completas, y un prefijo abarca como mucho
+# INDICE_PREFIJO_MAXIMO palabras. Debe llamarse con LOCK_INDICE_PRODUCTOS adquirido.
+def palabras_con_prefijo(buscada):
+    if len(buscada) < INDICE_PREFIJO_MINIMO:
+        return [buscada] if buscada in INDICE_PRODUCTOS else []
+    palabras = []
+    j = bisect.bisect_left(PALABRAS_INDICE, buscada)
+    while j < len(PALABRAS_INDICE) and PALABRAS_INDICE[j].startswith(buscada) and \
+            len(palabras) < INDICE_PREFIJO_MAXIMO:
+        palabras.append(PALABRAS_INDICE[j])
+        j += 1
+    return palabras
+
+
+# pid de los productos con alguna de las palabras, sin copiar el set si es una sola.
+# Debe llamarse con LOCK_INDICE_PRODUCTOS adquirido.
+def productos_con_palabras(palabras):
+    if len(palabras) == 1:
+        return INDICE_PRODUCTOS[palabras[0]]
+    return set().union(*( INDICE_PRODUCTOS[palabra] for palabra in palabras ))
+
+
+# Retorna hasta limite tuplas (pid, nombre, precio) cuyos nombres tienen palabras que
+# comienzan con cada una de las palabras buscadas. Primero los que tienen más palabras
+# exactas y luego los de nombre más corto.
+# Se recorren en orden las listas de la palabra buscada con menos productos, quedándose
+# con los que tienen también el resto de las palabras, hasta tener limite productos con
+# todas las palabras exactas que hay en el índice. Si son pocos los que tienen todas
+# las palabras sale más barato ordenarlos directamente.
+def buscar_en_indice_productos(texto, limite=10):
+    inicio = time.perf_counter()
+    buscadas = list(dict.fromkeys(palabras_de(texto)))
+    resultado = []
+    with LOCK_INDICE_PRODUCTOS:
+        prefijos = [ palabras_con_prefijo(buscada) for buscada in buscadas ]
+        if buscadas and all(prefijos):
+            # De la palabra buscada con menos productos a la de más
+            terminos = sorted(( sum(len(INDICE_PRODUCTOS[palabra]) for palabra in palabras), palabras )
+                              for palabras in prefijos)
+            tamano, palabras = terminos[0]
+            listas = [ ENTRADAS_INDICE[palabra] for palabra in palabras ]
+            entradas = listas[0] if len(listas) == 1 else heapq.merge(*listas)
+            if len(terminos) > 1:
+                candidatos = productos_con_palabras(palabras)
+                for _, otras in terminos[1:]:
+                    candidatos = candidatos & productos_con_palabras(otras)
+                if len(candidatos) ** 2 < limite * tamano:
+                    entradas = sorted(( len(PRODUCTOS_INDEXADOS[pid][0]), PRODUCTOS_INDEXADOS[pid][0], pid )
+                                      for pid in candidatos)
+                else:
+                    entradas = ( entrada for entrada in entradas if entrada[2] in candidatos )
+
+            exactas_posibles = sum(buscada in INDICE_PRODUCTOS for buscada in buscadas)
+            # Productos encontrados según la cantidad de palabras exactas, cada grupo en orden
+            grupos = [ [] for _ in range(exactas_posibles + 1) ]
+            anterior = None
+            for entrada in entradas:
+                # Un producto con dos palabras del mismo prefijo sale dos veces seguidas
+                if entrada == anterior:
+                    continue
+                anterior = entrada
+                palabras = PRODUCTOS_INDEXADOS[entrada[2]][2]
+                grupo = grupos[sum(buscada in palabras for buscada in buscadas)]
+                grupo.append(entrada)
+                if grupo is grupos[-1] and len(grupo) == limite:
+                    break
+            for grupo in reversed(grupos):
+                for largo, nombre, pid in grupo[:limite - len(resultado)]:
+                    resultado.append( (pid, nombre, PRODUCTOS_INDEXADOS[pid][1]) )
+    contar_estadistica(ESTADISTICAS_INDICE, 'consultas')
+    contar_estadistica(ESTADISTICAS_INDICE, 'segundos', time.perf_counter() - inicio)
+    return resultado
+
+
+def estadisticas_indice_productos():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_INDICE)
+    consultas = estadisticas['consultas']
+    estadisticas['ms_por_consulta'] = 1000 * estadisticas['segundos'] / consultas if consultas else 0
+    with LOCK_INDICE_PRODUCTOS:
+        estadisticas['productos'] = len(PRODUCTOS_INDEXADOS)
+        estadisticas['palabras'] = len(INDICE_PRODUCTOS)
+    estadisticas['cargado'] = INDICE_CARGADO.is_set()
+    return estadisticas
+
+
+threading.Thread(target=cargar_indice_productos, name='cargar_indice_productos', daemon=True).start()
+
+
 def enviar_listado_productos_segun_criterio(update, context, palabra):
     idchat = update.effective_chat.id
-    conn, cursor = inicializar_bd()
-    criterio = '%'.join(palabra.split())
-    criterio = f'%{criterio}%'
-    cursor.execute('''SELECT pid, nombre, precio FROM producto WHERE nombre like %s limit 10''', (criterio, ))
-    result = cursor.fetchall()
+    if INDICE_CARGADO.is_set():
+        result = buscar_en_indice_productos(palabra)
+    else:
+        criterio = '%'.join(palabra.split())
+        criterio = f'%{criterio}%'
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT pid, nombre, precio FROM producto WHERE nombre like %s limit 10''', (criterio, ))
+            result = cursor.fetchall()
     if result:
         mensaje = f'Algunos de los productos que contienen <b>{palabra}</b>\n\n'
         for (pid, nombre, precio) in result:
@@ -1764,17 +3862,9 @@ def enviar_listado_productos_segun_criterio(update, context, palabra):
                                  text='No hay productos que coincidan con el criterio enviado en nuestra base de datos', 
                                  parse_mode='HTML')
 
-    conn.close()
-
 
 def obtener_frecuencias():
-    conn, cursor = inicializar_bd()
-    frecuencias = []
-    cursor.execute('''SELECT frecuencia, texto FROM frecuencia_escaneo''')
-    for frec in cursor:
-        frecuencias.append( frec )
-    conn.close()  
-    return frecuencias
+    return list(obtener_catalogo()['frecuencias'].items())
 
 
 def generar_teclado_frecuencias_subscripcion(update, context, ajustes, palabra):
@@ -1827,21 +3917,250 @@ def procesar_categorias(update, context, ajustes):
 
 
 
+# Límite de búsquedas por hora
+# Cada usuario tiene en memoria una cola con la hora de sus búsquedas de la última
+# hora, cargada de la BD al iniciar. Comprobar el límite solo descarta de la cola las
+# búsquedas que salieron de la ventana y compara su longitud con el límite de su tipo.
+VENTANA_BUSQUEDAS = 3600
+
+LOCK_BUSQUEDAS_USUARIOS = threading.Lock()
+BUSQUEDAS_USUARIOS = {}
+ESTADISTICAS_LIMITES = {
+    'comprobaciones': 0,
+    'rechazadas': 0,
+}
+
+
+def cargar_busquedas_usuarios():
+    try:
+        desde = datetime.datetime.now() - datetime.timedelta(seconds=VENTANA_BUSQUEDAS)
+        with conexion_bd() as (conn, cursor):
+            cursor.execute('''SELECT uid, fecha FROM busqueda WHERE fecha >= %s and uid IS NOT NULL ORDER BY fecha''', (desde, ))
+            with LOCK_BUSQUEDAS_USUARIOS:
+                for uid, fecha in cursor:
+                    BUSQUEDAS_USUARIOS.setdefault(uid, deque()).append(fecha.timestamp())
+    except Exception as ex:
+        debug_print(f'cargar_busquedas_usuarios: {ex}', 'error')
+
+
+def registrar_busqueda_usuario(uid):
+    with LOCK_BUSQUEDAS_USUARIOS:
+        BUSQUEDAS_USUARIOS.setdefault(uid, deque()).append(time.time())
+
+
 def numero_busquedas_ultima_hora(idchat):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''SELECT * FROM busqueda WHERE timestampdiff(SECOND, fecha, now()) < 3600 and uid=%s''', (idchat, ))
-    result = cursor.fetchall()
-    conn.close()
-    if result:
-        return len(result)    
-    return 0
+    limite = time.time() - VENTANA_BUSQUEDAS
+    with LOCK_BUSQUEDAS_USUARIOS:
+        busquedas = BUSQUEDAS_USUARIOS.get(idchat)
+        if not busquedas:
+            return 0
+        while busquedas and busquedas[0] < limite:
+            busquedas.popleft()
+        if not busquedas:
+            del BUSQUEDAS_USUARIOS[idchat]
+        return len(busquedas)
+
+
+# Búsquedas por hora permitidas según el tipo de usuario, None si no tiene límite
+def limite_busquedas_por_hora(tipo):
+    if tipo == 'vip':
+        return LIMITE_BUSQUEDAS_VIP or None
+    return int( obtener_ajuste_bot('max_busquedas_por_hora') )
+
+
+# Como siempre, solo se rechaza la búsqueda si el usuario pasó del límite de su tipo y
+# además no dispone de crédito
+def rebasa_limite_busquedas(idchat, tipo, credito):
+    contar_estadistica(ESTADISTICAS_LIMITES, 'comprobaciones')
+    limite = limite_busquedas_por_hora(tipo)
+    if limite is not None and credito == 0 and numero_busquedas_ultima_hora(idchat) > limite:
+        contar_estadistica(ESTADISTICAS_LIMITES, 'rechazadas')
+        return True
+    return False
+
+
+def estadisticas_limites():
+    estadisticas = copiar_estadisticas(ESTADISTICAS_LIMITES)
+    estadisticas['usuarios'] = len(BUSQUEDAS_USUARIOS)
+    return estadisticas
+
+
+cargar_busquedas_usuarios()
 
 
 def actualizar_estado_subscripciones(context):
-    conn, cursor = inicializar_bd()
-    cursor.execute('''UPDATE subscripcion SET estado = %s WHERE timestampdiff(SECOND, fecha, now()) > 86400''', ('expirada', ))
-    conn.commit()
-    conn.close()  
+    with conexion_bd() as (conn, cursor):
+        cursor.execute('''UPDATE subscripcion SET estado = %s WHERE timestampdiff(SECOND, fecha, now()) > 86400''', ('expirada', ))
+        conn.commit()
+    limite = datetime.datetime.now() - datetime.timedelta(seconds=86400)
+    desprogramar_subscripciones(buscar_subscripciones_programadas(lambda subscripcion: subscripcion['fecha'] < limite))
+
+
+# Retención de búsquedas y del log
+# Cada RETENCION_INTERVALO segundos se borran las filas con fecha anterior a la que fija
+# la política de cada tabla, en lotes de RETENCION_LOTE y con una pausa entre ellos para
+# no acaparar la BD. Con RETENCION_ARCHIVO las filas se guardan antes en ese directorio
+# en ficheros JSON por líneas comprimidos. Si una tabla sin dependientes está
+# particionada por rango de fecha se borran sus particiones vencidas completas.
+POLITICAS_RETENCION = {
+    'busqueda': {
+        'dias': RETENCION_BUSQUEDA_DIAS,
+        'clave': 'bid',
+        'dependientes': ['resultado'],
+    },
+    'log': {
+        'dias': RETENCION_LOG_DIAS,
+        'clave': 'lid',
+        'dependientes': [],
+    },
+}
+ESTADISTICAS_RETENCION = {
+    'ejecuciones': 0,
+    'particiones': 0,
+    'archivadas': 0,
+    'bytes': 0,
+    'ultima_ejecucion': 0.0,
+}
+FILAS_RETENIDAS = {
+    'busqueda': 0,
+    'resultado': 0,
+    'log': 0,
+}
+
+
+# Bytes que ocupa en promedio una fila de cada tabla según MySQL
+def tamano_filas_tablas(cursor, tablas):
+    marcadores = ', '.join(['%s'] * len(tablas))
+    cursor.execute(f'''SELECT table_name, avg_row_length FROM information_schema.tables \
+                       WHERE table_schema = DATABASE() and table_name IN ({marcadores})''', tuple(tablas))
+    return { tabla: int(tamano or 0) for tabla, tamano in cursor }
+
+
+# Añade al archivo del día de la tabla las filas que retorna la consulta
+def archivar_filas(cursor, tabla, consulta, parametros=()):
+    cursor.execute(consulta, parametros)
+    columnas = cursor.column_names
+    # Si el directorio no existiera fallaría cada ejecución y no se borraría nada
+    os.makedirs(RETENCION_ARCHIVO, exist_ok=True)
+    ruta = os.path.join(RETENCION_ARCHIVO, f'{tabla}-{datetime.date.today():%Y%m%d}.jsonl.gz')
+    filas = 0
+    with gzip.open(ruta, 'at', encoding='utf8') as archivo:
+        for fila in cursor:
+            archivo.write(json.dumps(dict(zip(columnas, fila)), default=str, ensure_ascii=False) + '\n')
+            filas += 1
+    contar_estadistica(ESTADISTICAS_RETENCION, 'archivadas', filas)
+    return filas
+
+
+# Particiones de la tabla cuyo límite superior no pasa de la fecha indicada. Se entienden
+# las particiones RANGE sobre TO_DAYS() o UNIX_TIMESTAMP() y RANGE COLUMNS sobre fechas.
+def particiones_vencidas(cursor, tabla, limite):
+    cursor.execute('''SELECT partition_name, partition_method, partition_expression, partition_description \
+                      FROM information_schema.partitions WHERE table_schema = DATABASE() and table_name = %s \
+                      and partition_name IS NOT NULL ORDER BY partition_ordinal_position''', (tabla, ))
+    vencidas = []
+    for nombre, metodo, expresion, descripcion in cursor.fetchall():
+        expresion = (expresion or '').lower()
+        try:
+            if metodo == 'RANGE' and 'to_days' in expresion:
+                # TO_DAYS cuenta desde el año 0 y toordinal desde el año 1
+                vencida = int(descripcion) <= limite.toordinal() + 365
+            elif metodo == 'RANGE' and 'unix_timestamp' in expresion:
+                vencida = int(descripcion) <= limite.timestamp()
+            elif metodo == 'RANGE COLUMNS':
+                vencida = datetime.datetime.fromisoformat(descripcion.strip("'")) <= limite
+            else:
+                vencida = False
+        except ValueError:
+            # MAXVALUE u otro límite que no es una fecha
+            vencida = False
+        if vencida:
+            vencidas.append(nombre)
+    return vencidas
+
+
+# La búsqueda guardada de una página ya no existe, la próxima se guardará completa
+def olvidar_busquedas_en_huellas(bids):
+    bids = set(bids)
+    with LOCK_HUELLAS:
+        for huella in HUELLAS_PAGINAS.values():
+            if huella['bid'] in bids:
+                huella['bid'] = huella['hash_bid'] = None
+
+
+# Borra las filas de la tabla anteriores a limite y retorna cuántas se borraron de cada
+# tabla. tope es la mayor clave que se puede borrar, None para no limitarla.
+def aplicar_politica_retencion(tabla, politica, limite, tope=None):
+    clave = politica['clave']
+    dependientes = politica['dependientes']
+    borradas = Counter()
+
+    if not dependientes:
+        with conexion_bd() as (conn, cursor):
+            for particion in particiones_vencidas(cursor, tabla, limite):
+                if RETENCION_ARCHIVO:
+                    archivar_filas(cursor, tabla, f'''SELECT * FROM {tabla} PARTITION ({particion})''')
+                cursor.execute(f'''SELECT count(*) FROM {tabla} PARTITION ({particion})''')
+                borradas[tabla] += cursor.fetchone()[0]
+                cursor.execute(f'''ALTER TABLE {tabla} DROP PARTITION {particion}''')
+                contar_estadistica(ESTADISTICAS_RETENCION, 'particiones')
+                debug_print(f'Retención: borrada la partición {particion} de {tabla}')
+
+    condicion_tope = f' and {clave} <= %s' if tope is not None else ''
+    while True:
+        with conexion_bd() as (conn, cursor):
+            cursor.execute(f'''SELECT {clave} FROM {tabla} WHERE fecha < %s{condicion_tope} ORDER BY {clave} LIMIT %s''',
+                           (limite, *([tope] if tope is not None else []), RETENCION_LOTE))
+            claves = [ valor for (valor, ) in cursor ]
+            if not claves:
+                break
+            marcadores = ', '.join(['%s'] * len(claves))
+            for dependiente in dependientes:
+                if RETENCION_ARCHIVO:
+                    archivar_filas(cursor, dependiente, f'''SELECT * FROM {dependiente} WHERE {clave} IN ({marcadores})''', tuple(claves))
+                cursor.execute(f'''DELETE FROM {dependiente} WHERE {clave} IN ({marcadores})''', tuple(claves))
+                borradas[dependiente] += cursor.rowcount
+            if RETENCION_ARCHIVO:
+                archivar_filas(cursor, tabla, f'''SELECT * FROM {tabla} WHERE {clave} IN ({marcadores})''', tuple(claves))
+            cursor.execute(f'''DELETE FROM {tabla} WHERE {clave} IN ({marcadores})''', tuple(claves))
+            borradas[tabla] += cursor.rowcount
+            conn.commit()
+        if tabla == 'busqueda':
+            olvidar_busquedas_en_huellas(claves)
+        if len(claves) < RETENCION_LOTE:
+            break
+        time.sleep(RETENCION_PAUSA_MS / 1000)
+    return borradas
+
+
+def aplicar_retencion(context):
+    inicio = time.perf_counter()
+    ahora = datetime.datetime.now()
+    try:
+        with conexion_bd() as (conn, cursor):
+            tamanos = tamano_filas_tablas(cursor, list(FILAS_RETENIDAS))
+        for tabla, politica in POLITICAS_RETENCION.items():
+            if politica['dias'] <= 0:
+                continue
+            limite = ahora - datetime.timedelta(days=politica['dias'])
+            tope = None
+            if tabla == 'busqueda':
+                # Antes de borrar búsquedas se suman en mas_buscados y solo se borran las sumadas
+                acumular_mas_buscados(context)
+                with conexion_bd() as (conn, cursor):
+                    cursor.execute('''SELECT COALESCE(MAX(hasta_bid), 0) FROM mas_buscados''')
+                    tope = cursor.fetchone()[0]
+            borradas = aplicar_politica_retencion(tabla, politica, limite, tope)
+            for tabla_borrada, filas in borradas.items():
+                contar_estadistica(FILAS_RETENIDAS, tabla_borrada, filas)
+                contar_estadistica(ESTADISTICAS_RETENCION, 'bytes', filas * tamanos.get(tabla_borrada, 0))
+            if any(borradas.values()):
+                debug_print(f'Retención de {tabla}: ' + ', '.join(f'{filas} filas de {t}' for t, filas in borradas.items()))
+        contar_estadistica(ESTADISTICAS_RETENCION, 'ejecuciones')
+    except Exception as ex:
+        debug_print(f'aplicar_retencion: {ex}', 'error')
+    with LOCK_ESTADISTICAS:
+        ESTADISTICAS_RETENCION['ultima_ejecucion'] = time.perf_counter() - inicio
 
 
 # Procesar mensajes de texto que no son comandos
@@ -1849,58 +4168,76 @@ def procesar_palabra(update, context):
     try:
         palabra = update.message.text
         idchat = update.effective_chat.id
-        if existe_registro_usuario(idchat):
-            ajustes = obtener_ajustes_usuario(idchat)
-            if ajustes:
-                if palabra == BOTONES['PROVINCIAS']:        
-                    generar_teclado_provincias(update, context)
-                elif palabra == BOTONES['AYUDA']:
-                    ayuda(update, context)
-                elif palabra == BOTONES['INICIO']:
-                    iniciar_aplicacion(update, context)
-                elif palabra == BOTONES['INFO']:
-                    mostrar_informacion_usuario(update, context)
-                elif palabra == BOTONES['SUBS']:
-                    generar_teclado_opciones_subscripcion(update, context)
-                elif palabra == BOTONES['MAS_BUSCADOS']:
-                    mas_buscados(update, context)
-                elif palabra == BOTONES['PRODUCTOS']:
-                    context.bot.send_message(chat_id=idchat,
-                             text='Envíe una o varias palabras y recibirá un listado con los productos registrados relacionados.')
-                    RESPUESTA_PENDIENTE[idchat] = 'prod:list'
-                elif palabra == BOTONES['ACERCA_DE']:
-                    context.bot.send_message(chat_id=idchat,
-                                            text='<b>Reportes de errores y sugerencias a:</b>\n\n @disnelr\n+53 56963700\ndisnelrr@gmail.com',
-                                            parse_mode='HTML')
-                elif obtener_credito_usuario(idchat) > 0:
-                    if palabra == BOTONES['CATEGORIAS']:
-                        procesar_categorias(update, context, ajustes)
-                    elif idchat in RESPUESTA_PENDIENTE:
-                        procesar_respuesta_pendiente(update, context, ajustes, palabra)                
-                    else:
-                        if numero_busquedas_ultima_hora(idchat) > int( obtener_ajuste_bot('max_busquedas_por_hora') ) and obtener_credito_usuario(idchat) == 0:
-                            debug_print(f'Usuario {idchat} rebasó búsquedas máximas por hora y no dispone de crédito.')
-                            context.bot.send_message(chat_id=idchat, 
-                                            text=f'Ha rebasado el número de búsquedas permitidas en una hora. Intente más tarde.')
-                        else:
-                            enviar_mensaje_productos_encontrados(update, context)
+        with sesion_usuario(idchat) as sesion:
+            procesar_palabra_en_sesion(update, context, sesion, palabra)
+    except Exception as ex:
+        print('procesar_palabra', ex)
+
+
+def procesar_palabra_en_sesion(update, context, sesion, palabra):
+    idchat = update.effective_chat.id
+    if sesion['registrado']:
+        ajustes = obtener_ajustes_usuario(idchat)
+        if ajustes:
+            if palabra == BOTONES['PROVINCIAS']:        
+                generar_teclado_provincias(update, context)
+            elif palabra == BOTONES['AYUDA']:
+                ayuda(update, context)
+            elif palabra == BOTONES['INICIO']:
+                iniciar_aplicacion(update, context)
+            elif palabra == BOTONES['INFO']:
+                mostrar_informacion_usuario(update, context)
+            elif palabra == BOTONES['SUBS']:
+                generar_teclado_opciones_subscripcion(update, context)
+            elif palabra == BOTONES['MAS_BUSCADOS']:
+                mas_buscados(update, context)
+            elif palabra == BOTONES['PRODUCTOS']:
+                context.bot.send_message(chat_id=idchat,
+                                         text='Envíe una o varias palabras y recibirá un listado con los productos '
+                                              'registrados relacionados.')
+                RESPUESTA_PENDIENTE[idchat] = 'prod:list'
+            elif palabra == BOTONES['ACERCA_DE']:
+                context.bot.send_message(chat_id=idchat,
+                                         text='<b>Reportes de errores y sugerencias a:</b>\n\n @disnelr\n'
+                                              '+53 56963700\ndisnelrr@gmail.com',
+                                         parse_mode='HTML')
+            elif sesion['credito'] > 0:
+                if palabra == BOTONES['CATEGORIAS']:
+                    procesar_categorias(update, context, ajustes)
+                elif idchat in RESPUESTA_PENDIENTE:
+                    procesar_respuesta_pendiente(update, context, ajustes, palabra)                
                 else:
-                    context.bot.send_message(chat_id=idchat, 
-                                     text=f'🎩 Bot en mantenimiento. Gracias por su apoyo.')
+                    if rebasa_limite_busquedas(idchat, sesion['tipo'], sesion['credito']):
+                        debug_print(f'Usuario {idchat} rebasó búsquedas máximas por hora y no dispone de crédito.')
+                        context.bot.send_message(chat_id=idchat,
+                                                 text='Ha rebasado el número de búsquedas permitidas en una hora. '
+                                                      'Intente más tarde.')
+                    else:
+                        enviar_mensaje_productos_encontrados(update, context)
             else:
-                context.bot.send_message(chat_id=idchat, 
-                                        text=f'Sus datos no han sido registrados. Pulse /start para registrarlos.')
+                context.bot.send_message(chat_id=idchat,
+                                         text='🎩 Bot en mantenimiento. Gracias por su apoyo.')
         else:
-            registrar_usuario(update, context)
-            context.bot.send_message(chat_id=idchat, 
-                                     text=f'Sus datos han sido registrados. Ahora pruebe seleccionar una provincia.')
-    except Exception as ex:
-        print('procesar_palabra', ex)
+            context.bot.send_message(chat_id=idchat,
+                                     text='Sus datos no han sido registrados. Pulse /start para registrarlos.')
+    else:
+        registrar_usuario(update, context)
+        context.bot.send_message(chat_id=idchat,
+                                 text='Sus datos han sido registrados. Ahora pruebe seleccionar una provincia.')
+
 
+dispatcher.add_handler(MessageHandler(Filters.text, en_orden_por_chat(procesar_palabra)))
 
-dispatcher.add_handler(MessageHandler(Filters.text, procesar_palabra))
+# El enviador usa updater.bot, así que arranca cuando ya existe el updater. Los mensajes
+# encolados antes esperan en COLA_SALIDA.
+iniciar_enviador_mensajes()
+atexit.register(detener_enviador_mensajes)
 
-updater.start_polling(allowed_updates=[])
+if MODO_BOT == 'webhook':
+    updater.start_webhook(listen=WEBHOOK_ESCUCHA, port=WEBHOOK_PUERTO, url_path=WEBHOOK_RUTA)
+    updater.bot.set_webhook(f'{WEBHOOK_URL}/{WEBHOOK_RUTA}')
+else:
+    updater.start_polling(allowed_updates=[])
 
 
 # Sección de trabajos cronometrados
@@ -1909,12 +4246,42 @@ updater.start_polling(allowed_updates=[])
 # Si es vacio entonces ya no esta disponible
 def parsear_detalles_producto(tid, pid):
     check_url = f'{URL_BASE_TUENVIO}/{tid}/Item?ProdPid={pid}'
-    respuesta = session.get(check_url, headers=HEADERS)    
-    data = respuesta.content.decode('utf8')
+    data = descargar_pagina(check_url)
     soup = BeautifulSoup(data, 'html.parser')
     return soup.select('.product-details')
 
 
+# Los trabajos de job_queue se ejecutan uno tras otro en un solo hilo. Los que pueden
+# tardar minutos se lanzan en un hilo propio para no retrasar a los demás, y si la
+# ejecución anterior aún no ha terminado se omite la nueva.
+LOCK_HILOS_TRABAJOS = threading.Lock()
+HILOS_TRABAJOS = {}
+
+
+def en_hilo_propio(funcion):
+    @wraps(funcion)
+    def lanzar(context):
+        nombre = funcion.__name__
+        with LOCK_HILOS_TRABAJOS:
+            hilo = HILOS_TRABAJOS.get(nombre)
+            if hilo and hilo.is_alive():
+                debug_print(f'{nombre} aún está en curso, se omite esta ejecución')
+                return
+            hilo = threading.Thread(target=funcion, args=(context, ), name=nombre, daemon=True)
+            HILOS_TRABAJOS[nombre] = hilo
+            hilo.start()
+    return lanzar
+
+
 job_queue = updater.job_queue
-job_queue.run_repeating(notificar_subscritos, int(obtener_ajuste_bot('intervalo_busqueda_subscripcion')) )
+iniciar_planificador_escaneos()
+threading.Thread(target=precargar_menus, name='precargar_menus', daemon=True).start()
+threading.Thread(target=cargar_mas_buscados, name='cargar_mas_buscados', daemon=True).start()
+job_queue.run_repeating(enviar_digesto_admins, DIGESTO_INTERVALO)
+job_queue.run_repeating(conciliar_creditos, CREDITO_CONCILIACION)
+job_queue.run_repeating(acumular_mas_buscados, MAS_BUSCADOS_INTERVALO)
+if RETENCION_INTERVALO > 0:
+    job_queue.run_repeating(en_hilo_propio(aplicar_retencion), RETENCION_INTERVALO, first=60)
+if RASTREO_INTERVALO > 0:
+    job_queue.run_repeating(en_hilo_propio(rastrear_catalogo), RASTREO_INTERVALO, first=10)
 #job_queue.run_repeating(actualizar_estado_subscripciones, int(obtener_ajuste_bot('intervalo_busqueda_subscripcion')) / 2)
\ No newline at end of file